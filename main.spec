@@ -49,6 +49,9 @@ hiddenimports = [
     'fsm',
     'log',
     'twistedmain',
+    'server',
+    'client',
+    'loadtest',
 ]
 
 # Collect all submodules from engine, gui, ai packages
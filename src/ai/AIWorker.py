@@ -0,0 +1,114 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Unit AI in a separate process.
+
+Running Exhaustive in a thread keeps the reactor responsive, but the GIL
+still serializes the AI with rendering. AIWorker runs it in a worker
+process instead:
+- the scenario is pickled and sent once, when the worker starts
+- each turn only sends what changed since the last one: the battle state
+  of the units that changed (see Unit.battleState) and, if units moved,
+  who stands where
+- the chosen turn comes back as a UnitTurn.asTuple() tuple
+
+Each AIWorker owns one process, so several AI clients think in parallel.
+"""
+
+import logging
+import multiprocessing
+import pickle
+from concurrent import futures
+from engine import Unit
+
+logger = logging.getLogger('ai')
+
+class AIWorker(object):
+    def __init__(self, scenario):
+        self._scenario = scenario
+        self._sentStates = {}
+        self._sentOccupancy = None
+        for u in scenario.units():
+            self._sentStates[u.unitID] = u.battleState()
+        self._sentOccupancy = self._occupancy()
+        # Spawn rather than fork: the parent has a GUI and a reactor
+        # running, which a forked child must not inherit.
+        context = multiprocessing.get_context('spawn')
+        self._executor = futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=context,
+            initializer=_initWorker, initargs=(pickle.dumps(scenario),))
+
+    def _occupancy(self):
+        return sorted((x, y, u.unitID) for ((x, y), u)
+                      in self._scenario.map().grid.occupants())
+
+    def delta(self):
+        """@return: (unit state changes, occupancy or None) since the last
+        call, and remember the current state as sent."""
+        changes = {}
+        for u in self._scenario.units():
+            state = u.battleState()
+            changed = Unit.stateDelta(self._sentStates[u.unitID], state)
+            if changed:
+                changes[u.unitID] = changed
+                self._sentStates[u.unitID] = state
+        occupancy = self._occupancy()
+        if occupancy == self._sentOccupancy:
+            occupancy = None
+        else:
+            self._sentOccupancy = occupancy
+        return (changes, occupancy)
+
+    def calc(self, unit, budget=None):
+        """Start working out unit's turn.
+
+        @return: a concurrent.futures.Future for a UnitTurn.asTuple()
+        tuple."""
+        (changes, occupancy) = self.delta()
+        return self._executor.submit(_calc, changes, occupancy,
+                                     unit.unitID, budget)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+### Worker process side
+
+_scenario = None
+_units = {}
+
+def _initWorker(pickledScenario):
+    global _scenario
+    _scenario = pickle.loads(pickledScenario)
+    for u in _scenario.units():
+        _units[u.unitID] = u
+
+def _calc(changes, occupancy, unitID, budget):
+    from ai import UnitAI
+    for (changedID, state) in changes.items():
+        _units[changedID].setBattleState(state, _units.get)
+    if occupancy != None:
+        squares = _scenario.map().squares
+        for ((x, y), u) in _scenario.map().grid.occupants():
+            squares[x][y].unit = None
+        for (x, y, occupantID) in occupancy:
+            squares[x][y].unit = _units[occupantID]
+    unitAI = UnitAI.Exhaustive(_units[unitID])
+    return unitAI.calc(_scenario.battle(), budget).asTuple()
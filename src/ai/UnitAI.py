@@ -34,6 +34,8 @@ The AI generates all possible turn combinations for each unit:
 2. Attack-then-move: Use ability from current position, then move (NEW in 2025-10-01)
 3. Attack-only: Use ability without moving
 4. Move-only: Move without using abilities
+TurnGenerator produces these lazily, per ability, and skips move targets and
+ability targets that are too far from any unit the ability could affect.
 
 Performance Optimization (2025-10-01):
 The HealWeakest and DamageWeakest evaluators were optimized from O(targets × turns)
@@ -59,6 +61,7 @@ import random
 import copy
 import logging
 import traceback
+import numpy
 from engine import Battle as Battle
 from engine import Faction as Faction
 from engine import Ability
@@ -94,26 +97,237 @@ class TemporaryUnitPosition:
 
     def __enter__(self):
         """Move unit to new position on map."""
+        grid = self.map_.grid
+        self.old_version = grid.occupancyVersion
+        self.old_key = grid.occupancyKey()
+        # Remember who was where, in case unit is a copy of the unit that
+        # is really on the map
+        self.old_occupant = self.map_.squares[self.old_x][self.old_y].unit
+        self.new_occupant = self.map_.squares[self.new_x][self.new_y].unit
         # Remove unit from old position
         self.map_.squares[self.old_x][self.old_y].unit = None
         # Place unit at new position
         self.map_.squares[self.new_x][self.new_y].unit = self.unit
         # Update unit's position
         self.unit.setPosn(self.new_x, self.new_y, self.new_z)
+        self.new_version = grid.occupancyVersion
+        # Moving the same unit to the same square from the same starting
+        # arrangement always gives the same arrangement, whatever version
+        # number it gets
+        grid.nameOccupancy((self.old_key, self.unit.unitID,
+                            (self.old_x, self.old_y),
+                            (self.new_x, self.new_y)))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Restore unit to original position on map."""
-        # Remove unit from temporary position
-        self.map_.squares[self.new_x][self.new_y].unit = None
-        # Restore unit to original position
-        self.map_.squares[self.old_x][self.old_y].unit = self.unit
+        grid = self.map_.grid
+        untouched = grid.occupancyVersion == self.new_version
+        # Put back whoever was on the temporary and original squares
+        self.map_.squares[self.new_x][self.new_y].unit = self.new_occupant
+        self.map_.squares[self.old_x][self.old_y].unit = self.old_occupant
         # Restore unit's original coordinates
         self.unit.setPosn(self.old_x, self.old_y, self.old_z)
+        # If nothing else touched the map meanwhile, it is back to the
+        # occupancy it had on entry, and caches built for it still hold.
+        if untouched:
+            grid.resetOccupancyVersion(self.old_version)
+            if self.old_key != self.old_version:
+                grid.nameOccupancy(self.old_key)
         # Don't suppress exceptions
         return False
 
 
+class TurnGenerator(object):
+    """Lazily generates the turns Exhaustive chooses from.
+
+    Instead of trying every ability on every square in range from every
+    move target, it first works out how far each square is from the
+    nearest unit an ability could affect (a reverse range lookup from the
+    units' positions). Move targets and ability targets too far away for
+    the ability's range and area of effect to reach anybody are skipped
+    without calling hasEffect; the rest are looked up in
+    Ability.effectMask.
+
+    Act-first turns are generated once per ability target, without a
+    move; retreat() picks where to go afterwards for the turn chosen.
+
+    Turns are generated per ability, only when asked for, and kept once
+    complete, so several evaluators can walk the same turns without
+    generating them twice.
+
+    If a deadline (a time.time() value) is given, generation stops once it
+    passes and expired is set; the cheapest turns of each ability (acting
+    from where the unit stands) come first, then moves closest to the
+    units the ability could affect."""
+    def __init__(self, battle, unit, moveTargets, abilities, deadline=None):
+        self._map = battle.map()
+        self._unit = unit
+        self._copy = copy.copy(unit)
+        self._moveTargets = list(moveTargets)
+        self._abilities = list(abilities)
+        self._turns = {}
+        self._nearest = {}
+        self._deadline = deadline
+        self.expired = False
+        self.considered = 0
+
+    def _timeUp(self):
+        if self._deadline != None and time.time() > self._deadline:
+            self.expired = True
+        return self.expired
+
+    def __iter__(self):
+        for turn in self.actionTurns():
+            yield turn
+        for turn in self.moveTurns():
+            yield turn
+
+    def actionTurns(self, abilityFilter=None):
+        """Yield the turns that use an ability, optionally only those
+        abilities for which abilityFilter(ability) is true."""
+        for ability in self._abilities:
+            if abilityFilter != None and not abilityFilter(ability):
+                continue
+            turns = self._turns.get(ability.abilityID)
+            if turns != None:
+                for turn in turns:
+                    yield turn
+                continue
+            if self._timeUp():
+                return
+            turns = []
+            for turn in self._generate(ability):
+                turns.append(turn)
+                yield turn
+            if not self.expired:
+                self._turns[ability.abilityID] = turns
+
+    def moveTurns(self):
+        """Yield the move-only turns."""
+        if self._unit.hasMove():
+            for mt in self._moveTargets:
+                yield Battle.UnitTurn(Battle.UnitTurn.MOVE_FIRST, mt)
+
+    def retreat(self):
+        """@return: the move target farthest from the nearest hostile
+        unit, for hit-and-run tactics after acting, or None if the unit
+        is no safer anywhere else. Ties go to the nearest square."""
+        u = self._unit
+        if not u.hasMove():
+            return None
+        nearest = self._nearestUnits(Ability.HOSTILE)
+        (x, y) = u.posn()
+        best = None
+        bestKey = (nearest[x, y], 0)
+        for mt in self._moveTargets:
+            key = (nearest[mt[0], mt[1]],
+                   -(abs(mt[0] - x) + abs(mt[1] - y)))
+            if key > bestKey:
+                (best, bestKey) = (mt, key)
+        return best
+
+    def _nearestUnits(self, targetType):
+        """@return: an [x, y] array of the Manhattan distance from each
+        square to the nearest other unit of targetType."""
+        result = self._nearest.get(targetType)
+        if result is not None:
+            return result
+        u = self._unit
+        posns = []
+        for ((x, y), t) in self._map.grid.occupants():
+            if t.unitID == u.unitID:
+                continue
+            if (targetType == Ability.FRIENDLY_AND_HOSTILE or
+                (targetType == Ability.FRIENDLY and
+                 Faction.friendly(u.faction(), t.faction())) or
+                (targetType == Ability.HOSTILE and
+                 Faction.hostile(u.faction(), t.faction()))):
+                posns.append((x, y))
+        (w, h) = (self._map.width, self._map.height)
+        result = numpy.full((w, h), w + h, dtype=numpy.int32)
+        xs = numpy.arange(w).reshape((w, 1))
+        ys = numpy.arange(h).reshape((1, h))
+        for (x, y) in posns:
+            numpy.minimum(result, abs(xs - x) + abs(ys - y), out=result)
+        self._nearest[targetType] = result
+        return result
+
+    def _generate(self, ability):
+        u = self._copy
+        map_ = self._map
+        if u.sp() < ability.cost() or not ability.correctWeapon(u.weapon()):
+            # affectedUnits would come back empty everywhere
+            return
+
+        rangeReach = ability.rangeObject().maxDistance(u)
+        aoeReach = ability.aoeObject().maxDistance(u)
+        if rangeReach == None or aoeReach == None:
+            near = lambda posn, reach, unitPosn: True
+            closeness = lambda posn: 0
+        else:
+            nearest = self._nearestUnits(ability.targetType())
+            # The unit itself can be affected by its friendly abilities
+            canAffectSelf = ability.targetType() != Ability.HOSTILE
+            def near(posn, reach, unitPosn):
+                if nearest[posn[0], posn[1]] <= reach:
+                    return True
+                return (canAffectSelf and
+                        abs(posn[0] - unitPosn[0]) +
+                        abs(posn[1] - unitPosn[1]) <= reach)
+            closeness = lambda posn: nearest[posn[0], posn[1]]
+            rangeReach += aoeReach
+
+        # Masks from effectMask as nested lists, which index faster
+        effectRows = {}
+        def targets(unitPosn):
+            result = []
+            if not near(unitPosn, rangeReach, unitPosn):
+                return result
+            # Where the ability would affect anybody, over the whole map
+            # at once; the mask only changes when who can be hit does.
+            effect = ability.effectMask(map_, u)
+            if effect is not None:
+                key = id(effect)
+                if key not in effectRows:
+                    effectRows[key] = (effect, effect.tolist())
+                effect = effectRows[key][1]
+            for abilityTarget in ability.range(map_, u):
+                self.considered += 1
+                if not near(abilityTarget, aoeReach, unitPosn):
+                    continue
+                if effect is None:
+                    hit = ability.hasEffect(map_, u, abilityTarget)
+                else:
+                    hit = effect[abilityTarget[0]][abilityTarget[1]]
+                if hit:
+                    result.append(abilityTarget)
+            return result
+
+        # Act-first turns, once per target. Where to move afterwards
+        # doesn't change what the ability does, so it is left to
+        # retreat() for the turn that gets chosen.
+        if u.hasAct():
+            for abilityTarget in targets(u.posn()):
+                yield Battle.UnitTurn(Battle.UnitTurn.ACT_FIRST,
+                                      None, ability, abilityTarget)
+
+        # Move-then-act turns, most promising moves first. Turns are only
+        # handed out once the unit is back where it started, so callers
+        # see the map as it really is.
+        if u.hasMove() and u.hasAct():
+            for mt in sorted(self._moveTargets, key=closeness):
+                if self._timeUp():
+                    return
+                (mtx, mty) = mt
+                with TemporaryUnitPosition(map_, u, mtx, mty,
+                                           map_.squares[mtx][mty].z):
+                    found = targets(mt)
+                for abilityTarget in found:
+                    yield Battle.UnitTurn(Battle.UnitTurn.MOVE_FIRST,
+                                          mt, ability, abilityTarget)
+
+
 class Base(object):
     """Base is the base class of all unit AIs. By default, it
     returns a no-op action. Override the calc() method to change its
@@ -125,13 +339,14 @@ class Base(object):
     def result(self):
         return self._result
         
-    def __call__(self):
+    def __call__(self, battle, budget=None):
+        """Work out the unit's turn in battle. budget is the number of
+        seconds the AI may spend on it; None means as long as it takes."""
         startTime = time.time()
         name = self.__class__.__name__ + ' unit AI'
         logger.debug(name + " started for " + str(self._unit))
         try:
-            b = Battle.get()
-            self._result = self.calc(b)
+            self._result = self.calc(battle, budget=budget)
             logger.debug("Result: " + str(self._result))
         except Exception as e:
             self._result = Battle.UnitTurn()
@@ -141,18 +356,37 @@ class Base(object):
         timeElapsed = time.time() - startTime
         logger.debug("%s finished (%.2fs elasped)" % (name, timeElapsed))
 
-    def calc(self, battle, unit):
+    def calc(self, battle, unit=None, budget=None):
         """@return an instance of Battle.UnitTurn."""
         return Battle.UnitTurn()
             
 
 class TurnEvaluator(object):
+    # Cheap evaluators don't need any ability turns. Under a time budget
+    # they are run first, so there is always a turn to fall back on.
+    cheap = False
+
     def __call__(self, unit, map_, turns):
         if len(turns) == 0:
             return Battle.UnitTurn()
         else:
             return turns[0]
 
+    def actionTurns(self, turns, abilityFilter):
+        """The turns using an ability abilityFilter accepts. turns may be
+        a TurnGenerator, in which case only those turns get generated."""
+        if isinstance(turns, TurnGenerator):
+            return turns.actionTurns(abilityFilter)
+        return [t for t in turns
+                if t.action() != None and abilityFilter(t.action())]
+
+    def moveTurns(self, turns):
+        """The turns that move without acting."""
+        if isinstance(turns, TurnGenerator):
+            return turns.moveTurns()
+        return [t for t in turns
+                if t.moveTarget() != None and t.action() == None]
+
 class HealWeakest(TurnEvaluator):
     def __call__(self, battle, unit, turns):
         map_ = battle.map()
@@ -166,27 +400,16 @@ class HealWeakest(TurnEvaluator):
                 t.hp() < t.mhp()):
                 targets.append(t)
         targets.sort(key=lambda t: t.hp())
+        if not targets:
+            return []
         
         # Get all turns that heal the weakest possible target
 
         # Optimized: Build lookup dictionary mapping targets to turns that can heal them
         # This reduces complexity from O(targets * turns) to O(targets + turns)
         target_to_turns = {}
-        for turn in turns:
+        for turn in self.actionTurns(turns, self.heals):
             action = turn.action()
-            if action == None:
-                continue
-            # FIXME: more general way of filtering abilities
-            # FIXME: we don't consider FRIENDLY_AND_HOSTILE yet
-            if action.targetType() != Ability.FRIENDLY:
-                continue
-            heals = False
-            for e in action.effects():
-                if issubclass(e.__class__, Effect.Healing):
-                    heals = True
-                    break
-            if not heals:
-                continue
 
             # Safely simulate unit position for range calculations
             if turn.moveTarget() != None:
@@ -213,6 +436,16 @@ class HealWeakest(TurnEvaluator):
                 return target_to_turns[target]
         return []
 
+    def heals(self, ability):
+        # FIXME: more general way of filtering abilities
+        # FIXME: we don't consider FRIENDLY_AND_HOSTILE yet
+        if ability.targetType() != Ability.FRIENDLY:
+            return False
+        for e in ability.effects():
+            if issubclass(e.__class__, Effect.Healing):
+                return True
+        return False
+
 
 class DamageWeakest(TurnEvaluator):
     def __call__(self, battle, unit, turns):
@@ -224,31 +457,16 @@ class DamageWeakest(TurnEvaluator):
             if t.alive() and Faction.hostile(unit.faction(), t.faction()):
                 targets.append(t)
         targets.sort(key=lambda t: t.hp())
+        if not targets:
+            return []
         
         # Get all turns that hit the weakest possible target
 
         # Optimized: Build lookup dictionary mapping targets to turns that can damage them
         # This reduces complexity from O(targets * turns) to O(targets + turns)
         target_to_turns = {}
-        for turn in turns:
+        for turn in self.actionTurns(turns, self.damages):
             action = turn.action()
-            if action == None:
-                continue
-            # FIXME: more general way of filtering abilities
-            # FIXME: we don't consider FRIENDLY_AND_HOSTILE yet
-            if action.targetType() != Ability.HOSTILE:
-                continue
-            doesDamage = False
-            for e in action.effects():
-                if (issubclass(e.__class__, Effect.Damage) or
-                    issubclass(e.__class__, Effect.DrainLife) or
-                    issubclass(e.__class__,
-                               Effect.HealFriendlyDamageHostile)):
-                    doesDamage = True
-                    break
-            if not doesDamage:
-                continue
-
             affected = action.affectedUnits(map_,
                                             unit,
                                             turn.actionTarget())
@@ -263,28 +481,48 @@ class DamageWeakest(TurnEvaluator):
             if target in target_to_turns:
                 bestTurns = target_to_turns[target]
                 # We have some candidate turns, now evaluate them to
-                # see which does the most total damage
-                maxDamage = 0.1
-                newBestTurns = []
+                # see which does the most total damage. Every (turn,
+                # affected unit, damage effect) is estimated in one batch.
                 unitCopy = copy.copy(unit)
-                for turn in bestTurns:
+                affectedCache = {}
+                rowTurns = []
+                rowEffects = []
+                rowPosns = []
+                rowTargets = []
+                for (i, turn) in enumerate(bestTurns):
                     if turn.moveTarget() != None:
                         (mtx, mty) = turn.moveTarget()
                     else:
-                        (mtx, mty) = unitCopy.posn()
-                    unitCopy.setPosn(mtx, mty, map_.squares[mtx][mty].z)
+                        (mtx, mty) = unit.posn()
+                    mtz = map_.squares[mtx][mty].z
                     action = turn.action()
-                    damage = 0
-                    affected = action.affectedUnits(map_,
-                                                    unitCopy,
-                                                    turn.actionTarget())
-                    for target in affected:
-                        for e in action.effects():
-                            if issubclass(e.__class__, Effect.Damage):
-                                (att, df) = e.calcAttackAndDefense(unitCopy,
-                                                                   target)
-                                dmg = e.estimateDamage(att, df)
-                                damage += dmg
+                    key = (action.abilityID, tuple(turn.actionTarget()))
+                    if action.aoeObject().sourcePositionMatters:
+                        key += (mtx, mty)
+                    affected = affectedCache.get(key)
+                    if affected == None:
+                        unitCopy.setPosn(mtx, mty, mtz)
+                        affected = action.affectedUnits(map_,
+                                                        unitCopy,
+                                                        turn.actionTarget())
+                        affectedCache[key] = affected
+                    damageEffects = [e for e in action.effects()
+                                     if issubclass(e.__class__, Effect.Damage)]
+                    for t in affected:
+                        for e in damageEffects:
+                            rowTurns.append(i)
+                            rowEffects.append(e)
+                            rowPosns.append((mtx, mty, mtz))
+                            rowTargets.append(t)
+                damages = Effect.estimateDamages(unitCopy, rowEffects,
+                                                 rowPosns, rowTargets)
+                totals = [0] * len(bestTurns)
+                for (i, dmg) in zip(rowTurns, damages.tolist()):
+                    totals[i] += dmg
+
+                maxDamage = 0.1
+                newBestTurns = []
+                for (turn, damage) in zip(bestTurns, totals):
                     if damage > maxDamage:
                         maxDamage = damage
                         newBestTurns = [turn]
@@ -308,7 +546,21 @@ class DamageWeakest(TurnEvaluator):
                 break  # Found turns for weakest target, exit target loop
         return []
 
+    def damages(self, ability):
+        # FIXME: more general way of filtering abilities
+        # FIXME: we don't consider FRIENDLY_AND_HOSTILE yet
+        if ability.targetType() != Ability.HOSTILE:
+            return False
+        for e in ability.effects():
+            if (issubclass(e.__class__, Effect.Damage) or
+                issubclass(e.__class__, Effect.DrainLife) or
+                issubclass(e.__class__, Effect.HealFriendlyDamageHostile)):
+                return True
+        return False
+
 class MoveToWeakest(TurnEvaluator):
+    cheap = True
+
     def __call__(self, battle, unit, turns):
         map_ = battle.map()
 
@@ -325,18 +577,14 @@ class MoveToWeakest(TurnEvaluator):
         targets.sort(key=lambda t: t.hp())
 
         # Get as close as possible to the weakest target
-        map_.fillDistances(unit, targets[0].posn())
+        search = map_.fillDistances(unit, targets[0].posn())
         bestDistance = 1000000
         bestTurns = []
-        for turn in turns:
+        for turn in self.moveTurns(turns):
             move = turn.moveTarget()
-            action = turn.action()
-            if move == None or action != None:
+            distance = search.distance(move[0], move[1])
+            if distance == None:
                 continue
-            search = map_.squares[move[0]][move[1]].search
-            if search == None:
-                continue
-            distance = search[0]
             if distance < bestDistance:
                 bestDistance = distance
                 bestTurns = [turn]
@@ -349,6 +597,7 @@ class Exhaustive(Base):
         Base.__init__(self, unit)
         self._turnEvaluators = [HealWeakest(), DamageWeakest(),
                                 MoveToWeakest()]
+        self.queryCache = None
     
     def allAbilities(self):
         abilities = []
@@ -360,61 +609,9 @@ class Exhaustive(Base):
 
     def generateAllTurns(self, battle, moveTargets, abilities):
         startTime = time.time()
-        u = copy.copy(self._unit)
-        map_ = battle.map()
-        result = []
-        turnsConsidered = 0
-
-        # This calculates all move-then-attack turns.
-        if u.hasMove() and u.hasAct():
-            logger.debug('Considering move-attack turns')
-            for mt in moveTargets:
-                (mtx, mty) = mt
-
-                # Use context manager to safely simulate unit position
-                with TemporaryUnitPosition(map_, u, mtx, mty, map_.squares[mtx][mty].z):
-                    for ability in abilities:
-                        for abilityTarget in ability.range(map_, u):
-                            turnsConsidered += 1
-                            if ability.hasEffect(map_, u, abilityTarget):
-                                result.append(Battle.UnitTurn
-                                              (Battle.UnitTurn.MOVE_FIRST,
-                                               mt, ability, abilityTarget))
-                            
-        # This calculates all attack-then-move turns.
-        # This enables hit-and-run tactics: attack from current position, then retreat.
-        # Useful for ranged units that want to maintain distance, or for attacking
-        # then moving to cover/safety.
-        if u.hasMove() and u.hasAct():
-            logger.debug('Considering attack-move turns')
-            for ability in abilities:
-                for abilityTarget in ability.range(map_, u):
-                    turnsConsidered += 1
-                    if ability.hasEffect(map_, u, abilityTarget):
-                        # After attacking, consider all possible move destinations
-                        for mt in moveTargets:
-                            result.append(Battle.UnitTurn
-                                          (Battle.UnitTurn.ACT_FIRST,
-                                           mt, ability, abilityTarget))
-
-        # This calculates all just-act turns (no movement).
-        if u.hasAct():
-            logger.debug('Considering act-only turns')
-            for ability in abilities:
-                for abilityTarget in ability.range(map_, u):
-                    turnsConsidered += 1
-                    if ability.hasEffect(map_, u, abilityTarget):
-                        result.append(Battle.UnitTurn
-                                      (Battle.UnitTurn.ACT_FIRST,
-                                       None, ability, abilityTarget))
-
-        # This calculates all just-move turns.
-        if u.hasMove():
-            logger.debug('Considering move-only turns')
-            for mt in moveTargets:
-                result.append(Battle.UnitTurn(Battle.UnitTurn.MOVE_FIRST,
-                                              mt))
-                turnsConsidered += 1
+        turns = TurnGenerator(battle, self._unit, moveTargets, abilities)
+        result = list(turns)
+        turnsConsidered = turns.considered + len(moveTargets)
 
         if turnsConsidered == 0:
             logger.debug('No turns considered')
@@ -427,8 +624,8 @@ class Exhaustive(Base):
                            (time.time() - startTime))))
         return result
 
-    def calc(self, battle):
-        turn = self.getTurn(battle)
+    def calc(self, battle, budget=None):
+        turn = self.getTurn(battle, budget)
         facing = self.getFacing(battle, turn.moveTarget())
         return Battle.UnitTurn(turn.turnOrder(),
                                turn.moveTarget(),
@@ -478,7 +675,29 @@ class Exhaustive(Base):
             else:
                 return Constants.N
 
-    def getTurn(self, battle):
+    def getTurn(self, battle, budget=None):
+        """Ask each evaluator in turn for its best turns and pick one from
+        the first that has any.
+
+        With a budget (in seconds), this is an anytime search: cheap
+        evaluators run first, and once the budget is spent the best turn
+        found so far is returned.
+
+        Range and area of effect queries are memoized for the length of
+        the turn; the cache is kept as queryCache afterwards, so its hit
+        and miss counts can be looked at."""
+        with Ability.QueryCache() as cache:
+            turn = self._chooseTurn(battle, budget)
+        self.queryCache = cache
+        logger.debug('%s: query cache %d hits, %d misses' %
+                     (self._unit, cache.hits, cache.misses))
+        return turn
+
+    def _chooseTurn(self, battle, budget):
+        startTime = time.time()
+        deadline = None
+        if budget != None:
+            deadline = startTime + budget
         abilities = self.allAbilities()
         logger.debug('Abilities: ' + str(abilities))
 
@@ -486,18 +705,86 @@ class Exhaustive(Base):
         moveTargets.append(self._unit.posn())
         logger.debug('Move targets: ' + str(len(moveTargets)))
 
-        allTurns = self.generateAllTurns(battle, moveTargets, abilities)
+        # Evaluators pull only the turns they are interested in
+        turns = TurnGenerator(battle, self._unit, moveTargets, abilities,
+                              deadline)
+        results = {}
+        if deadline != None:
+            for evaluator in self._turnEvaluators:
+                if evaluator.cheap:
+                    results[evaluator] = self.evaluate(evaluator, battle,
+                                                       turns)
+        result = []
         for evaluator in self._turnEvaluators:
-            startTime = time.time()
-            logger.debug('Trying evaluator %s' % evaluator.__class__.__name__)
-            result = evaluator(battle, self._unit, allTurns)
-            logger.debug('Evaluator finished ' +
-                         '(%d actions returned, %.2fs elapsed)' %
-                         (len(result), (time.time() - startTime)))
+            if evaluator not in results:
+                if turns.expired:
+                    break
+                results[evaluator] = self.evaluate(evaluator, battle, turns)
+            result = results[evaluator]
             if result:
-                return random.choice(result)
+                break
+        if not result:
+            # Out of time: settle for what the cheap evaluators found
+            for evaluator in self._turnEvaluators:
+                if results.get(evaluator):
+                    result = results[evaluator]
+                    break
+
+        if budget != None:
+            elapsed = time.time() - startTime
+            if turns.expired:
+                logger.info('%s: %.2fs time budget hit after %d turns '
+                            'considered (%.2fs elapsed)' %
+                            (self._unit, budget, turns.considered, elapsed))
+            else:
+                logger.info('%s: finished within %.2fs time budget '
+                            '(%.2fs elapsed)' % (self._unit, budget, elapsed))
+        if result:
+            turn = random.choice(result)
+            if (turn.turnOrder() == Battle.UnitTurn.ACT_FIRST and
+                turn.moveTarget() == None):
+                turn = Battle.UnitTurn(Battle.UnitTurn.ACT_FIRST,
+                                       turns.retreat(), turn.action(),
+                                       turn.actionTarget())
+            return turn
         return Battle.UnitTurn()
 
+    def evaluate(self, evaluator, battle, turns):
+        startTime = time.time()
+        logger.debug('Trying evaluator %s' % evaluator.__class__.__name__)
+        result = evaluator(battle, self._unit, turns)
+        logger.debug('Evaluator finished ' +
+                     '(%d actions returned, %.2fs elapsed)' %
+                     (len(result), (time.time() - startTime)))
+        return result
+
+
+class Scripted(Exhaustive):
+    """A cheap, predictable AI for load testing: walk towards the nearest
+    enemy and use the first ability that does anything from there.
 
+    It sends the same kinds of commands as Exhaustive, but thinks in
+    milliseconds, so the server rather than the AI is what gets tested."""
+    def getTurn(self, battle, budget=None):
+        u = self._unit
+        targets = [t.posn() for t in battle.units()
+                   if t.alive() and Faction.hostile(u.faction(), t.faction())]
+        if not targets:
+            return Battle.UnitTurn()
 
+        def distance(posn):
+            return min(abs(posn[0] - x) + abs(posn[1] - y)
+                       for (x, y) in targets)
 
+        moveTargets = []
+        if u.hasMove():
+            moveTargets = battle.map().reachable(u)
+        best = min(moveTargets + [u.posn()], key=distance)
+
+        if u.hasAct():
+            turns = TurnGenerator(battle, u, [best], self.allAbilities())
+            for turn in turns.actionTurns():
+                return turn
+        if best == u.posn():
+            return Battle.UnitTurn()
+        return Battle.UnitTurn(Battle.UnitTurn.MOVE_FIRST, best)
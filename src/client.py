@@ -0,0 +1,362 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Game clients that need no display: GameClient talks to a GameServer,
+and AIClient plays a faction with the unit AI. The player's own client,
+with the game window, is twistedmain.InteractiveClient.
+"""
+
+from twisted.internet import reactor, defer
+from twisted.internet import threads
+from twisted.spread import pb
+from twisted.cred import credentials
+
+import logging
+import main
+
+clientLog = logging.getLogger('gcli')
+
+import engine.netsupport
+import engine.Map
+import engine.Battle
+import ai.UnitAI
+import ai.AIWorker
+import fsm
+from server import Access, loginName
+
+
+class GameClient(pb.Referenceable):
+    """Client interface. Handles talking to the server but doesn't
+    take any real actions or start any GUI."""
+    def __init__(self, server, serverPort, username, session=None):
+        self.server = server
+        self.serverPort = serverPort
+        self.username = username
+        # The session to join; None for any that is waiting for players
+        self.session = session
+        self.perspective = None
+        self.accessLevel = Access.OBSERVER
+        self.name = None
+        self.faction = None
+        self.scenario = None
+        # unit ID -> version of the last unitDelta applied
+        self.unitVersions = {}
+        self.start()
+        self.unit = None # FIXME: remove
+
+    def start(self):
+        # Start connection to the PB server
+        factory = pb.PBClientFactory()
+        reactor.connectTCP(self.server,
+                           self.serverPort,
+                           factory)
+        # log in with username and blank password
+        # Ensure both username and password are properly encoded for Python 3
+        username = loginName(self.username, self.session)
+        password = ""
+        if isinstance(username, str):
+            username = username.encode('utf-8')
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        c = credentials.UsernamePassword(username, password)
+        df = factory.login(c, self)
+        df.addCallback(self.gotPerspective)
+        df.addErrback(lambda e: self.error(e, "logging in to %s" %
+                                           self.server))
+
+    # Methods starting with remote_ can be called by the server.
+    def remote_startGame(self, scenario):
+        self.scenario = scenario
+        self.unitVersions = {}
+        for u in scenario.units():
+            scenario.map().squares[u.x()][u.y()].unit = u
+
+    def remote_chat(self, username, message):
+        pass
+
+    def remote_serverMessage(self, message):
+        pass
+
+    def remote_unitBeginTurn(self, unitID):
+        if self.scenario is None:
+            return
+        self.unit = self.scenario.unitFromID(unitID)
+
+    def remote_unitDelta(self, unitID, version, delta):
+        """The battle fields of a unit that changed since the previous
+        version (see Unit.battleState)."""
+        if self.scenario is None:
+            return
+        if version != self.unitVersions.get(unitID, 0) + 1:
+            # We've missed an update; the delta is no good to us
+            clientLog.warning("Unit %d is out of sync (got version %d, "
+                              "have %d), resyncing" %
+                              (unitID, version,
+                               self.unitVersions.get(unitID, 0)))
+            df = self.remote('unitResync', unitID)
+            df.addCallback(lambda result: self.unitResynced(unitID, *result))
+            return
+        self.applyUnitState(unitID, version, delta)
+
+    def unitResynced(self, unitID, version, state):
+        # Later deltas may have overtaken the resync
+        if version >= self.unitVersions.get(unitID, 0):
+            self.applyUnitState(unitID, version, state)
+
+    def applyUnitState(self, unitID, version, state):
+        unit = self.scenario.unitFromID(unitID)
+        unit.setBattleState(state, self.scenario.unitFromID)
+        self.unitVersions[unitID] = version
+        if not unit.alive():
+            self.scenario.map().squares[unit.x()][unit.y()].unit = None
+
+    # FIXME: for sanity's sake, need to send unitIDs with all of these
+    # so that the right unit is guaranteed to be affected even if
+    # lagmonster happens - I think this is fixed now, 2006-Mar-25
+    def remote_unitMoveActCancel(self, move, act, cancel):
+        pass
+
+    def remote_unitMoved(self, x, y):
+        # Actually move the unit on our map
+        m = self.scenario.map()
+        m.squares[self.unit.x()][self.unit.y()].unit = None
+        m.squares[x][y].unit = self.unit
+        # FIXME: we should set the unit posn here but that screws up
+        # the GUI
+
+    def remote_unitSetFacing(self, facing):
+        self.unit.setFacing(facing)
+
+    def remote_actionResolved(self, abilityID, actionResults, unitDeltas):
+        """The active unit used an ability.
+
+        @param actionResults: unit ID -> the effect results on that unit.
+        @param unitDeltas: (unit ID, version, delta) for each unit the
+        action changed, as remote_unitDelta takes them."""
+        for (unitID, version, delta) in unitDeltas:
+            self.remote_unitDelta(unitID, version, delta)
+
+    def remote_broadcast(self, data):
+        """A message the server encoded once for all its clients (see
+        GameSession.broadcast)."""
+        (methodName, args) = engine.netsupport.decodeMessage(data)
+        return getattr(self, 'remote_' + methodName)(*args)
+
+    # Utility function for calling a remote method on the server. Adds
+    # a sensible errback.
+    def remote(self, methodName, *args):
+        df = self.perspective.callRemote(methodName, *args)
+        op = "%s%s" % (methodName, str(args))
+        df.addErrback(self.error, op)
+        return df
+
+    def error(self, failure, op=""):
+        """Handle network errors with appropriate logging and recovery."""
+        errorMsg = str(failure.getErrorMessage())
+        clientLog.error(f'Network error in {op}: {errorMsg}')
+
+        # Check if this is a fatal error that requires shutdown
+        from twisted.internet import error as twisted_errors
+        fatal_errors = (
+            twisted_errors.ConnectionRefusedError,
+            twisted_errors.ConnectionLost,
+            twisted_errors.ConnectionDone,
+        )
+
+        # Only stop reactor for fatal connection errors
+        if failure.check(*fatal_errors):
+            clientLog.critical(f'Fatal network error: {errorMsg}. Shutting down.')
+            if reactor.running:
+                reactor.stop()
+        else:
+            # Log non-fatal errors but continue running
+            clientLog.warning(f'Non-fatal network error in {op}, continuing...')
+
+    def gotPerspective(self, perspective):
+        """Called after a successful login to the server."""
+        self.perspective = perspective
+        df = self.remote('info', main.__version__)
+        df.addCallback(self.gotInfo)
+
+    def gotInfo(self, xxx_todo_changeme):
+        (name, accessLevel, faction, session) = xxx_todo_changeme
+        self.name = name
+        self.faction = faction
+        self.accessLevel = accessLevel
+        self.session = session
+        df = self.chooseScenario()
+        # Loading the scenario can put its map in our map cache (when the
+        # server runs in this process), so wait for it before saying
+        # which maps we have
+        if df == None:
+            self.sendReady()
+        else:
+            df.addCallback(lambda result: self.sendReady())
+
+    def chooseScenario(self):
+        """Called once logged in. A client that sets the scenario does it
+        here, returning the Deferred from its setScenario call."""
+        return None
+
+    def sendReady(self):
+        # Before readyForGame, so the server knows which maps we have by
+        # the time it sends the scenario
+        self.remote('haveMaps', engine.Map.mapCache.hashes())
+        self.remote('readyForGame')
+
+
+### AI Client
+
+class AIFSM(fsm.FSM):
+    def __init__(self, aiClient):
+        fsm.FSM.__init__(self, ['disabled', 'begin', 'calc'])
+        for s in self.states:
+            self.addEntryHook(s, getattr(self, "enter_" + s, self.doNothing))
+        self.aiClient = aiClient
+        self.unit = None
+        self.turn = None
+        
+    def enter_begin(self, oldState, unitID):
+        self.unit = self.aiClient.scenario.unitFromID(unitID)
+        if self.unit is None:
+            clientLog.error(f"AI cannot find unit with ID {unitID}")
+            return
+
+    def enter_calc(self, oldState, xxx_todo_changeme2):
+        (move, act, cancel) = xxx_todo_changeme2
+        if self.unit is None:
+            clientLog.error("AI unit is None, cannot calculate turn")
+            return
+        self.unit.setMoveActCancel(move, act, cancel)
+        budget = self.aiClient.budget
+        worker = self.aiClient.worker
+        if worker != None:
+            df = self.calcInWorker(worker, budget)
+        else:
+            df = self.calcInThread(budget)
+        df.addCallback(self.executeTurn)
+
+    def calcInThread(self, budget):
+        unitAI = self.aiClient.unitAI(self.unit)
+        return threads.deferToThread(unitAI.calc,
+                                     self.aiClient.scenario.battle(),
+                                     budget)
+
+    def calcInWorker(self, worker, budget):
+        df = defer.Deferred()
+        def done(future):
+            reactor.callFromThread(finished, future)
+        def finished(future):
+            try:
+                turn = engine.Battle.UnitTurn.fromTuple(future.result())
+            except Exception as e:
+                # Don't leave the unit hanging: think in-process instead
+                clientLog.error(f"AI worker failed ({e}), using a thread")
+                self.aiClient.stopWorker()
+                self.calcInThread(budget).chainDeferred(df)
+                return
+            df.callback(turn)
+        worker.calc(self.unit, budget).add_done_callback(done)
+        return df
+
+    def executeTurn(self, turn):
+        self.turn = turn
+        if turn.turnOrder() == engine.Battle.UnitTurn.MOVE_FIRST:
+            self.sendMove(turn)
+            self.sendAct(turn)
+        else:
+            self.sendAct(turn)
+            self.sendMove(turn)
+        facing = turn.facing()
+        if facing == None:
+            # No enemy to face: stay as we are
+            facing = self.unit.facing()
+        self.aiClient.remote('unitFacing', facing)
+
+    def sendMove(self, turn):
+        if turn.moveTarget() != None:
+            self.aiClient.remote('unitMove', *turn.moveTarget())
+
+    def sendAct(self, turn):
+        if turn.action() != None:
+            self.aiClient.remote('unitAct', turn.action().abilityID,
+                                 *turn.actionTarget())
+
+    def doNothing(self, *args):
+        pass
+
+# FIXME: clean up AIclient, don't need AIFSM class
+class AIClient(GameClient):
+    """AI client -- just sends moves to the server when needed.
+
+    @param budget: seconds the AI may think about each turn (None: as long
+    as it takes).
+    @param useWorker: think in a worker process (see AIWorker) rather than
+    a thread."""
+
+    # The unit AI used when thinking in a thread
+    unitAI = ai.UnitAI.Exhaustive
+
+    def __init__(self, server, serverPort, session=None, budget=None,
+                 useWorker=True, username="AI"):
+        self.budget = budget
+        self.useWorker = useWorker
+        GameClient.__init__(self, server, serverPort, username, session)
+        self.fsm = AIFSM(self)
+        self.worker = None
+
+    def remote_startGame(self, scenario):
+        GameClient.remote_startGame(self, scenario)
+        if self.useWorker and self.worker == None:
+            # Think in another process so the GUI keeps its frame rate
+            try:
+                self.worker = ai.AIWorker.AIWorker(scenario)
+            except Exception as e:
+                clientLog.error(f"Couldn't start AI worker process: {e}")
+            else:
+                reactor.addSystemEventTrigger('before', 'shutdown',
+                                              self.stopWorker)
+
+    def stopWorker(self):
+        if self.worker != None:
+            self.worker.close()
+            self.worker = None
+    
+    def remote_unitBeginTurn(self, unitID):
+        GameClient.remote_unitBeginTurn(self, unitID)
+        if self.unit is not None:
+            self.fsm.trans('begin', unitID)
+    
+    def remote_unitMoveActCancel(self, move, act, cancel):
+        if self.fsm.state == 'begin':
+            self.fsm.trans('calc', (move, act, cancel))
+
+    def remote_unitMoved(self, x, y):
+        GameClient.remote_unitMoved(self, x, y)
+        self.unit.setPosn(x, y, self.scenario.map().squares[x][y].z)
+        self.remote('readyToDisplay')
+
+    def remote_unitSetFacing(self, facing):
+        GameClient.remote_unitSetFacing(self, facing)
+        self.remote('readyToDisplay')
+
+    def remote_actionResolved(self, *args):
+        GameClient.remote_actionResolved(self, *args)
+        self.remote('readyToDisplay')
@@ -17,6 +17,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import threading
+import numpy
 from engine import Faction
 from engine import Equipment as Equipment
 from twisted.spread import pb
@@ -33,6 +35,67 @@ ACTION = 0
 # of the user's weapon.
 WEAPON_SOUND = 0
 
+# Kinds of QueryCache entries
+_RANGE = 0
+_AOE = 1
+_AFFECTED = 2
+
+class QueryCache(object):
+    """Memoizes Ability.range, Ability.aoe and Ability.affectedUnits for
+    the length of a with block, e.g. one AI turn:
+
+        with QueryCache() as cache:
+            ...
+        logger.debug('%d hits, %d misses' % (cache.hits, cache.misses))
+
+    Results are keyed by ability, source unit ID and position, target
+    position and map version: the terrain version for range and aoe,
+    which only look at heights, and the occupancy key for affectedUnits
+    (see MapGrid.occupancyKey), so that the same temporary move made by
+    different evaluators shares its results. The source unit's stats (SP, weapon, faction) are
+    assumed not to change inside the block, and results are shared, so
+    callers must not modify them.
+
+    A cache is only active in the thread that entered it: the AI runs in
+    threads of its own, and the game's queries must never see its cache."""
+    _active = threading.local()
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._results = {}
+        self._previous = None
+
+    def current():
+        """@return: the cache active in this thread, or None."""
+        return getattr(QueryCache._active, 'cache', None)
+
+    def __enter__(self):
+        self._previous = QueryCache.current()
+        QueryCache._active.cache = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        QueryCache._active.cache = self._previous
+        self._previous = None
+        self._results = {}
+        return False
+
+    def get(self, key):
+        """@return: the result stored for key, or None."""
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self._results[key] = result
+        return result
+
+    current = staticmethod(current)
+
 class Ability(pb.Copyable, pb.RemoteCopy):
     nextID = 0
     get = {}
@@ -69,11 +132,23 @@ class Ability(pb.Copyable, pb.RemoteCopy):
         return self._targetType
 
     def range(self, map, sourceUnit):
-        return self._range(map, sourceUnit, sourceUnit.posn3d())
+        cache = QueryCache.current()
+        if cache is None:
+            return self._range(map, sourceUnit, sourceUnit.posn3d())
+        posn = sourceUnit.posn3d()
+        key = (_RANGE, self.abilityID, sourceUnit.unitID, posn, None,
+               map.grid.terrainVersion)
+        result = cache.get(key)
+        if result is None:
+            result = cache.put(key, self._range(map, sourceUnit, posn))
+        return result
 
     def rangeObject(self):
         return self._range
 
+    def aoeObject(self):
+        return self._aoe
+
     def requiredWeapons(self):
         return self._requiredWeapons
 
@@ -83,7 +158,15 @@ class Ability(pb.Copyable, pb.RemoteCopy):
             z = map.squares[x][y].z
         else:
             (x, y, z) = posn
-        return self._aoe(map, sourceUnit, (x, y, z))
+        cache = QueryCache.current()
+        if cache is None:
+            return self._aoe(map, sourceUnit, (x, y, z))
+        key = (_AOE, self.abilityID, sourceUnit.unitID, sourceUnit.posn3d(),
+               (x, y, z), map.grid.terrainVersion)
+        result = cache.get(key)
+        if result is None:
+            result = cache.put(key, self._aoe(map, sourceUnit, (x, y, z)))
+        return result
 
     def correctWeapon(self, weapon):
         if not self._requiredWeapons:
@@ -94,6 +177,18 @@ class Ability(pb.Copyable, pb.RemoteCopy):
         return len(self.affectedUnits(map, sourceUnit, posn)) > 0
 
     def affectedUnits(self, map, sourceUnit, posn):
+        cache = QueryCache.current()
+        if cache is None:
+            return self._affectedUnits(map, sourceUnit, posn)
+        key = (_AFFECTED, self.abilityID, sourceUnit.unitID,
+               sourceUnit.posn3d(), tuple(posn), map.grid.occupancyKey())
+        result = cache.get(key)
+        if result is None:
+            result = cache.put(key, self._affectedUnits(map, sourceUnit,
+                                                        posn))
+        return result
+
+    def _affectedUnits(self, map, sourceUnit, posn):
         if sourceUnit.sp() < self._cost:
             return []
         if not self.correctWeapon(sourceUnit.weapon()):
@@ -119,6 +214,57 @@ class Ability(pb.Copyable, pb.RemoteCopy):
                       Faction.hostile(sourceUnit.faction(), t.faction())):
                     result.append(t)                    
         return result
+
+    # Batch versions of hasEffect and affectedUnits, for the AI. Instead
+    # of walking the area of effect square by square for every target,
+    # they look up where the ability would affect anybody in a mask over
+    # the whole map, worked out once from the occupancy arrays.
+
+    def targetMask(self, map, sourceUnit):
+        """@return: a boolean [x, y] array, True on the squares holding a
+        unit the ability would affect if it reached them."""
+        factions = map.grid.factions()
+        if self._targetType == FRIENDLY:
+            factions = [f for f in factions
+                        if Faction.friendly(sourceUnit.faction(), f)]
+        elif self._targetType == HOSTILE:
+            factions = [f for f in factions
+                        if Faction.hostile(sourceUnit.faction(), f)]
+        return map.grid.occupiedBy(factions)
+
+    def effectMask(self, map, sourceUnit):
+        """@return: a boolean [x, y] array, True where hasEffect is, or
+        None if the area of effect depends on where the source unit
+        stands (see Range.sourcePositionMatters)."""
+        if self._aoe.sourcePositionMatters:
+            return None
+        grid = map.grid
+        if (sourceUnit.sp() < self._cost or
+            not self.correctWeapon(sourceUnit.weapon())):
+            return grid.noHits()
+        # Area of effect ranges don't look at the target square either
+        offsets = self._aoe.offsets(sourceUnit, None)
+        return grid.aoeHits(offsets, self._aoe.zdiff(sourceUnit),
+                            self.targetMask(map, sourceUnit))
+
+    def hasEffectMask(self, map, sourceUnit, posns):
+        """@return: a list saying, for each (x, y) in posns, whether
+        hasEffect would be true there."""
+        mask = self.effectMask(map, sourceUnit)
+        if mask is None:
+            return [self.hasEffect(map, sourceUnit, posn) for posn in posns]
+        if not len(posns):
+            return []
+        posns = numpy.asarray(posns, dtype=numpy.intp).reshape(-1, 2)
+        return mask[posns[:, 0], posns[:, 1]].tolist()
+
+    def affectedUnitsBatch(self, map, sourceUnit, posns):
+        """@return: for each (x, y) in posns, the list affectedUnits would
+        return there. Only targets that affect anybody are looked at
+        square by square."""
+        return [self.affectedUnits(map, sourceUnit, posn) if hit else []
+                for (posn, hit) in zip(posns, self.hasEffectMask(
+                    map, sourceUnit, posns))]
     
     def effects(self):
         return self._effects
@@ -19,51 +19,131 @@
 
 import time
 from engine import Faction
-import sound as Sound
 import threading
 import logging
 import fsm as FSM
 from engine import Effect
+from engine import Ability
 import constants as Constants
 from twisted.spread import pb
-import gui
+from engine import Display
 
 logger = logging.getLogger('batt')
 
-def get():
-    return _battle
+# A unit whose CT reaches this takes a turn
+READY_CT = 1000
 
-_battle = None
+def ticksUntilReady(ct, speed):
+    """@return: the number of CT charging ticks, at least one, until a
+    unit with the given CT and speed reaches READY_CT."""
+    return max(1, -((ct - READY_CT) // speed))
+
+def doneCT(ct):
+    """@return: a unit's CT once it has ended its turn."""
+    return min(ct - 500, 500)
 
 class Battle(pb.Copyable, pb.RemoteCopy):
     def __init__(self, endingConditions, units, map):
-        global _battle
-        _battle = self
         self._units = units
         self._steps = 0
         self._turns = 0
         self.unitQueue = []
+        self._census = Faction.Census()
+        self._unitsByID = {}
         for u in self._units:
             u.battleInit()
+            self._census.add(u)
+            self._unitsByID[u.unitID] = u
         self.activeUnit = None
         self._oldUnitPosn = (0, 0)
         self.endingConditions = endingConditions
         self._map = map
+        # Terrain doesn't change during a battle: build the connectivity
+        # for every jump value in play up front.
+        for jump in set(u.jump() for u in self._units):
+            map.grid.steps(jump)
 
     def units(self):
         return self._units
+
+    def unitFromID(self, unitID):
+        """@return: the unit with the given ID, or None."""
+        return self._unitsByID.get(unitID)
+
+    def census(self):
+        """@return: the Faction.Census of the units alive."""
+        return self._census
+
+    def turns(self):
+        """@return: the number of unit turns begun so far."""
+        return self._turns
         
     def map(self):
         return self._map
 
     def _step(self):
-        self._steps += 1
+        """Charge CT until a unit is ready to act.
+
+        Speeds only change between turns, so rather than adding speed to
+        every CT one tick at a time, work out how many ticks the first
+        unit needs and charge them all at once. The units that are ready
+        then are the same, in the same order, as ticking would give.
+
+        @return: the units that are ready, in roster order; empty if no
+        unit is alive to charge."""
+        ticks = self._ticksUntilReady()
+        if ticks == None:
+            return []
+        self._steps += ticks
         self._statusCheck()
         self._slowActionCharging()
         self._slowActionResolution()
-        self._ctCharging()
+        self._ctCharging(ticks)
         return self._activeTimeResolution()
 
+    def _ticksUntilReady(self, cts=None):
+        """@param cts: the CT of each unit, in roster order, if not their
+        current CTs.
+        @return: the number of CT charging ticks, at least one, after
+        which the first living unit reaches READY_CT; None if no unit is
+        alive."""
+        result = None
+        for (i, u) in enumerate(self._units):
+            if u.alive():
+                ct = u.ct() if cts == None else cts[i]
+                ticks = ticksUntilReady(ct, u.speed())
+                if result == None or ticks < result:
+                    result = ticks
+        return result
+
+    def forecastTurnOrder(self, n):
+        """@return: the next n units to take a turn (fewer if nobody is
+        alive), without changing any CT.
+
+        The forecast assumes each turn, including the active unit's, ends
+        without moving or acting; moving and acting cost CT, so they can
+        only push a unit later. The unit ready soonest is first; if the
+        active unit will be ready again that soon, it appears too."""
+        units = self._units
+        cts = [u.ct() for u in units]
+        queue = [units.index(u) for u in self.unitQueue if u.active()]
+        if self.activeUnit != None:
+            i = units.index(self.activeUnit)
+            cts[i] = doneCT(cts[i])
+        result = []
+        while len(result) < n:
+            if not queue:
+                ticks = self._ticksUntilReady(cts)
+                if ticks == None:
+                    break
+                for (i, u) in enumerate(units):
+                    cts[i] = cts[i] + u.speed() * ticks if u.alive() else 0
+                queue = [i for (i, ct) in enumerate(cts) if ct >= READY_CT]
+            i = queue.pop(0)
+            result.append(units[i])
+            cts[i] = doneCT(cts[i])
+        return result
+
     # Check time-dependent status effect
     def _statusCheck(self):
         pass
@@ -77,22 +157,23 @@ class Battle(pb.Copyable, pb.RemoteCopy):
         pass
 
     # CT charging
-    def _ctCharging(self):
+    def _ctCharging(self, ticks=1):
         for u in self._units:
             if u.alive():
-                u.setCT(u.ct() + u.speed())
+                u.setCT(u.ct() + u.speed() * ticks)
             else:
                 u.setCT(0)
 
     # AT resolution
     def _activeTimeResolution(self):
-        ready = [u for u in self._units if u.ct() >= 1000]
+        ready = [u for u in self._units if u.ct() >= READY_CT]
         return ready
 
     def unitMoved(self, x, y):
         u = self.activeUnit
         if not u.hasMove():
             return False
+        # Cached by the map: usually already computed for the GUI or AI
         r = self._map.reachable(u)
         if not (x, y) in r:
             return False
@@ -184,14 +265,11 @@ class Battle(pb.Copyable, pb.RemoteCopy):
         if u == None:
             return False
         self.activeUnit = None
-        u.setCT(u.ct() - 500)
-        u.setCT(min(u.ct(), 500))
+        u.setCT(doneCT(u.ct()))
         return True
 
     def status(self):
-        endingCondition = LastTeamStanding()
-        result = endingCondition(self)
-        return result
+        return LAST_TEAM_STANDING(self)
 #         for i in range(0, len(self.endingConditions)):
 #             c = self.endingConditions[i]
 #             if c(self):
@@ -203,8 +281,11 @@ class Battle(pb.Copyable, pb.RemoteCopy):
         active = [u for u in self._units if u.active()]
         self._turns += 1
         self.unitQueue = [u for u in self.unitQueue if u.active()]
-        while not self.unitQueue:
+        if not self.unitQueue:
             self.unitQueue = self._step()
+            if not self.unitQueue:
+                logger.error('No unit is alive to take a turn')
+                return None
         u = self.unitQueue.pop(0)
         self.activeUnit = u
         u.readyTurn()
@@ -224,8 +305,7 @@ class Battle(pb.Copyable, pb.RemoteCopy):
             damage = int(damage)
             damage = min(u.mhp() - u.hp(), damage)
             u.damageHP(-damage, Effect.HEALING)
-            ud = gui.ScenarioGUI.get().unitDisplayer(u)
-            ud.addAnimation(gui.Sprite.DamageDisplayer(damage, gui.Sprite.BENEFICIAL, 0.5))
+            Display.damage(u, damage, Display.BENEFICIAL, 0.5)
 
         # Poison effect
         if u.statusEffects().has(Effect.Status.POISON):
@@ -234,8 +314,10 @@ class Battle(pb.Copyable, pb.RemoteCopy):
             damage = int(damage)
             damage = min(u.hp(), damage)
             u.damageHP(damage, Effect.PHYSICAL)
-            ud = gui.ScenarioGUI.get().unitDisplayer(u)
-            ud.addAnimation(gui.Sprite.DamageDisplayer(damage, gui.Sprite.NEGATIVE, 0.5))
+            if not u.alive():
+                # The body stays on its square but no longer blocks anyone
+                self._map.grid.occupancyChanged()
+            Display.damage(u, damage, Display.NEGATIVE, 0.5)
 
         return u
             
@@ -275,6 +357,23 @@ class UnitTurn(object):
     def facing(self):
         return self._facing
 
+    def asTuple(self):
+        """@return: the turn as a tuple of plain values, with the action
+        given by ability ID."""
+        abilityID = None
+        if self._action != None:
+            abilityID = self._action.abilityID
+        return (self._turnOrder, self._moveTarget, abilityID,
+                self._actionTarget, self._facing)
+
+    def fromTuple(t):
+        (turnOrder, moveTarget, abilityID, actionTarget, facing) = t
+        action = None
+        if abilityID != None:
+            action = Ability.Ability.get[abilityID]
+        return UnitTurn(turnOrder, moveTarget, action, actionTarget, facing)
+    fromTuple = staticmethod(fromTuple)
+
     def __repr__(self):
         return self.__str__()
 
@@ -303,9 +402,8 @@ class DefeatAllEnemies(EndingCondition):
     def __call__(self, battle):
         """@return: True iff all enemy units have been rendered
         inactive."""
-        active = [u for u in battle.units() if u.active()]
-        for u in active:
-            if Faction.hostile(Faction.PLAYER_FACTION, u.faction()):
+        for f in battle.census().factions():
+            if Faction.hostile(Faction.PLAYER_FACTION, f):
                 return False
         return True
 
@@ -316,23 +414,20 @@ class PlayerDefeated(EndingCondition):
     def __call__(self, battle):
         """@return: True iff all the player's units have been rendered
         inactive."""
-        active = [u for u in battle.units() if u.active()]
-        for u in active:
-            if Faction.playerControlled(u.faction()):
+        for f in battle.census().factions():
+            if Faction.playerControlled(f):
                 return False
         return True
 
 
 class LastTeamStanding(EndingCondition):
     def __call__(self, battle):
-        teamRemaining = None
-        active = [u for u in battle.units() if u.active()]
-        for u in active:
-            if teamRemaining == None:
-                teamRemaining = u.faction()
-            elif teamRemaining != u.faction():
-                return -1
-        return teamRemaining
+        factions = battle.census().factions()
+        if len(factions) > 1:
+            return -1
+        if factions:
+            return factions[0]
+        return None
         
 PLAYER_DEFEATED = PlayerDefeated()
 DEFEAT_ALL_ENEMIES = DefeatAllEnemies()
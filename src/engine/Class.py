@@ -103,6 +103,7 @@ class Class(pb.Copyable, pb.RemoteCopy):
     # Called when the unit equips this class
     def equip(self, u):
         u._class = self
+        u.invalidateStats()
 
     def spriteRoot(self):
         return self._spriteRoot
@@ -0,0 +1,47 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Hooks for showing what the engine does on its own.
+
+Most of a battle reaches the players as messages from the server, but a
+few things happen inside the engine with no message of their own: regen
+and poison at the start of a turn, a defender stepping in front of an
+attack. The engine reports those here instead of calling into the GUI, so
+that it runs the same with or without a display. ScenarioGUI registers
+itself when it starts; a headless server never does, and the calls do
+nothing.
+"""
+
+# Kinds of damage display, as used by gui.Sprite.DamageDisplayer
+BENEFICIAL = 0
+NEUTRAL = 1
+NEGATIVE = 2
+
+_damageDisplay = None
+
+def setDamageDisplay(callback):
+    """Have callback(unit, amount, kind, delay) show damage numbers (or
+    text) over units. None turns the display off."""
+    global _damageDisplay
+    _damageDisplay = callback
+
+def damage(unit, amount, kind=NEUTRAL, delay=0.0):
+    if _damageDisplay is not None:
+        _damageDisplay(unit, amount, kind, delay)
@@ -17,13 +17,11 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-import resources as Resources
-from gui import Sprite
-from gui import ScenarioGUI
 import random
 import math
+import numpy
 from engine import Faction
-from gui import GLUtil
+from engine import Display
 import constants as Constants
 from twisted.spread import pb
 
@@ -146,16 +144,115 @@ class Effect(pb.Copyable, pb.RemoteCopy):
             for u in target.defenders():
                 # Defender must be alive and adjacent to intercept
                 if u.alive() and u.posn() in adjacent and random.random() > 0.3:
-                    ud = ScenarioGUI.get().unitDisplayer(target)
-                    ud.addAnimation(Sprite.DamageDisplayer("Defended", Sprite.NEUTRAL))
+                    Display.damage(target, "Defended", Display.NEUTRAL)
                     return u
         return target
 
+# Facing -> (forward x, forward y) for the rear/front tests of
+# Effect.attackIsFromRear and attackIsFromFront
+_FACING_VECTORS = {Constants.N: (0, -1),
+                   Constants.S: (0, 1),
+                   Constants.W: (-1, 0),
+                   Constants.E: (1, 0)}
+
+def estimateDamages(source, effects, sourcePosns, targets):
+    """Batched effect.estimateDamage(*effect.calcAttackAndDefense(source,
+    target)) for many (effect, source position, target) rows at once.
+
+    @param source: the attacking unit; its position is taken from
+    sourcePosns instead of source.posn3d().
+    @param effects: the Effect of each row.
+    @param sourcePosns: the (x, y, z) the attack is made from, per row.
+    @param targets: the target unit of each row.
+    @return: a NumPy array of the estimated damage of each row, equal to
+    what the per-row calls return.
+    """
+    n = len(effects)
+    if n == 0:
+        return numpy.zeros(0)
+
+    # Per-target and per-effect values, fetched once each
+    targetIndex = {}
+    targetStats = []
+    rowTarget = numpy.empty(n, dtype=numpy.intp)
+    for (i, t) in enumerate(targets):
+        j = targetIndex.get(id(t))
+        if j == None:
+            j = len(targetStats)
+            targetIndex[id(t)] = j
+            try:
+                z = float(t.z())
+                hasZ = True
+            except (TypeError, ValueError):
+                (z, hasZ) = (0.0, False)
+            (x, y) = t.posn()
+            targetStats.append((x, y, z, hasZ, t.wdef(), t.mdef(),
+                                t.statusEffects().has(Status.INVULNERABLE),
+                                t.facing()))
+        rowTarget[i] = j
+    effectIndex = {}
+    effectStats = []
+    rowEffect = numpy.empty(n, dtype=numpy.intp)
+    for (i, e) in enumerate(effects):
+        j = effectIndex.get(id(e))
+        if j == None:
+            j = len(effectStats)
+            effectIndex[id(e)] = j
+            effectStats.append((isPhysicalDamage(e._damageType), e._power))
+        rowEffect[i] = j
+
+    (tx, ty, tz, hasZ, wdef, mdef, invulnerable, facing) = [
+        numpy.array(column)[rowTarget] for column in zip(*targetStats)]
+    (physical, power) = [numpy.array(column)[rowEffect]
+                         for column in zip(*effectStats)]
+    sourcePosns = numpy.asarray(sourcePosns, dtype=numpy.float64)
+    (sx, sy, sz) = sourcePosns.T
+    physical &= ~invulnerable
+
+    # Physical attacks: weapon stats, facing and height
+    attack = numpy.where(physical, float(source.watk()),
+                         float(source.matk()))
+    defense = numpy.where(physical, wdef, mdef).astype(numpy.float64)
+    if physical.any():
+        legal = numpy.isin(facing, list(_FACING_VECTORS))
+        if not legal[physical].all():
+            raise Exception("target.facing() is not legal")
+        forwardX = numpy.zeros(n)
+        forwardY = numpy.zeros(n)
+        for (f, (fx, fy)) in _FACING_VECTORS.items():
+            forwardX[facing == f] = fx
+            forwardY[facing == f] = fy
+        dx = tx - sx
+        dy = ty - sy
+        along = forwardX * dx + forwardY * dy
+        across = numpy.abs(forwardY * dx + forwardX * dy)
+        rear = along - across > 0
+        front = -along - across >= 0
+        defense = numpy.where(physical & rear, defense * 0.5, defense)
+        defense = numpy.where(physical & ~rear & ~front, defense * 0.75,
+                              defense)
+        heightMult = 0.02 * (sz - tz)
+        heightMult = numpy.minimum(0.25, numpy.maximum(-0.25, heightMult))
+        attack = numpy.where(physical & hasZ, attack * (1.0 + heightMult),
+                             attack)
+    attack = numpy.maximum(1.0, attack)
+    defense = numpy.maximum(1.0, defense)
+    damage = (attack - defense * 0.5) * power
+    # Invulnerable targets give (0, -1), which estimates to no damage
+    return numpy.where(invulnerable, 0, damage)
+
 class EffectResult(pb.Copyable, pb.RemoteCopy):
     def __init__(self, target, hit):
         self.target = target
         self.hit = hit
 
+    def getStateToCopy(self):
+        # Clients look the target up by ID; sending the Unit would jelly
+        # all of it again with every result
+        state = self.__dict__.copy()
+        state['target'] = self.target.unitID
+        return state
+
 class MissResult(EffectResult):
     def __init__(self, target):
         EffectResult.__init__(self, target, False)
@@ -17,6 +17,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+from twisted.spread import pb
+
 PLAYER_FACTION = 0
 NPC_HOSTILE_FACTION = 1
 NPC_FRIENDLY_FACTION = 2
@@ -32,6 +34,30 @@ class Faction(object):
     def units(self):
         return self._units
 
+class Census(pb.Copyable, pb.RemoteCopy):
+    """How many units of each faction are alive. The units keep it up to
+    date themselves as they die (see Unit.setAlive), so nobody has to
+    look at every unit to find out."""
+    def __init__(self):
+        self._alive = {}
+
+    def add(self, unit):
+        """Start counting unit."""
+        unit.setCensus(self)
+        if unit.alive():
+            self.changed(unit.faction(), 1)
+
+    def changed(self, factionID, change):
+        self._alive[factionID] = self._alive.get(factionID, 0) + change
+
+    def alive(self, factionID):
+        """@return: the number of living units in a faction."""
+        return self._alive.get(factionID, 0)
+
+    def factions(self):
+        """@return: the factions with a unit alive, in ID order."""
+        return sorted(f for (f, n) in self._alive.items() if n > 0)
+
 def color(factionID):
     if factionID == 0:
         return (0.0, 0.0, 1.0)
@@ -22,11 +22,19 @@
 import numpy as Numeric
 import pickle as cPickle
 import gzip
-import re
 import random
 import logging
+import os
+import ast
+import struct
+import zlib
+import hashlib
+import gc
+from collections import deque
 from engine import Faction
-from OpenGL.GL import *
+from engine import Search
+from engine import MapParser
+from engine.MapGrid import MapGrid, GRID_FIELDS, NO_UNIT, NO_TAG
 from twisted.spread import pb
 
 logger = logging.getLogger('map')
@@ -71,29 +79,99 @@ def parse_color_data(color_data, default_colors):
 
     return default_colors
 
+def _tagColorData(tag):
+    # Default colors (Top, Left, Back, Right, Front)
+    default_colors = [(1.0, 1.0, 1.0, 1.0)] * 5
+    default_variance = [(0.0, 0.0, 0.0, 0.0)] * 5
+
+    # Parse colors and variance using helper function
+    colors = parse_color_data(tag.get("color"), default_colors)
+    variance = parse_color_data(tag.get("colorVar"), default_variance)
+    return (colors, variance)
+
+def tagColorArray(tag, count):
+    """tagColors for count squares at once.
+
+    @return: a (count, 5, 4) array."""
+    (colors, variance) = _tagColorData(tag)
+    colors = Numeric.array([tuple(c) + (1.0,) * (4 - len(c))
+                            for c in colors], dtype=float)
+    variance = Numeric.array([tuple(v) + (0.0,) * (4 - len(v))
+                              for v in variance], dtype=float)
+    return colors - Numeric.random.random((count, 5, 4)) * variance
+
+def tagColors(tag):
+    """@return: the five (Top, Left, Back, Right, Front) RGBA colors of a
+    square with the given tag, with the tag's random colorVar applied."""
+    (colors, variance) = _tagColorData(tag)
+
+    # Apply variance to colors
+    result = []
+    for (color, var) in zip(colors, variance):
+        # Extend to 4 components if needed
+        if len(color) == 3:
+            color = color + (1.0,)
+        if len(var) == 3:
+            var = var + (0.0,)
+
+        # Apply random variance
+        varied_color = tuple(
+            color[i] - random.random() * var[i]
+            for i in range(4)
+        )
+        result.append(varied_color)
+    return result
+
 class MapSquare(pb.Copyable, pb.RemoteCopy):
     def __init__(self, x, y, zBase, cornerHeights, color, smooth,
                  tag, waterHeight, waterColor):
-        # Find our z offset
-        self.cornerHeights = cornerHeights
-        self.x = x
-        self.y = y
-        self.z = zBase
-        self.unit = None
-        self.guiData = {}
-#        self.texture = texture
-        self.color = color
-        self.cornerColors = [[color[0], color[0], color[0], color[0]],
-                             [color[1], color[1], color[1], color[1]],
-                             [color[2], color[2], color[2], color[2]],
-                             [color[3], color[3], color[3], color[3]],
-                             [color[4], color[4], color[4], color[4]]]
-        self.smooth = smooth
-        self.tag = tag
-        self.waterHeight = waterHeight
-        self.waterColor = waterColor
-        self.smoothed = []
-        self.search = None
+        # No grid is attached yet, so there's nothing for __setattr__ to
+        # mirror; write the attributes straight into the dict.
+        self.__dict__.update(
+            # Find our z offset
+            cornerHeights = cornerHeights,
+            x = x,
+            y = y,
+            z = zBase,
+            unit = None,
+            guiData = {},
+#            texture = texture,
+            color = color,
+            cornerColors = [[color[0], color[0], color[0], color[0]],
+                            [color[1], color[1], color[1], color[1]],
+                            [color[2], color[2], color[2], color[2]],
+                            [color[3], color[3], color[3], color[3]],
+                            [color[4], color[4], color[4], color[4]]],
+            smooth = smooth,
+            tag = tag,
+            waterHeight = waterHeight,
+            waterColor = waterColor,
+            smoothed = [],
+            search = None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # Mirror writes into the owning map's grid (see engine.MapGrid)
+        if name in GRID_FIELDS:
+            grid = self.__dict__.get('_grid')
+            if grid is not None:
+                if name == 'unit':
+                    grid.setUnit(self.x, self.y, value)
+                elif name == 'tag':
+                    grid.syncTag(self)
+                else:
+                    grid.syncTerrain(self)
+
+    def getStateToCopy(self):
+        state = self.__dict__.copy()
+        state.pop('_grid', None)
+        return state
+
+    def _syncTerrain(self):
+        """Push in-place cornerHeights edits to the grid."""
+        grid = self.__dict__.get('_grid')
+        if grid is not None:
+            grid.syncTerrain(self)
 
     def minHeight(self):
         return min(self.z,
@@ -173,30 +251,7 @@ class MapSquare(pb.Copyable, pb.RemoteCopy):
         else:
             self.tag = tag
 
-        # Default colors (Top, Left, Back, Right, Front)
-        default_colors = [(1.0, 1.0, 1.0, 1.0)] * 5
-        default_variance = [(0.0, 0.0, 0.0, 0.0)] * 5
-
-        # Parse colors and variance using helper function
-        colors = parse_color_data(tag.get("color"), default_colors)
-        variance = parse_color_data(tag.get("colorVar"), default_variance)
-
-        # Apply variance to colors
-        self.color = []
-        for (color, var) in zip(colors, variance):
-            # Extend to 4 components if needed
-            if len(color) == 3:
-                color = color + (1.0,)
-            if len(var) == 3:
-                var = var + (0.0,)
-
-            # Apply random variance
-            varied_color = tuple(
-                color[i] - random.random() * var[i]
-                for i in range(4)
-            )
-            self.color.append(varied_color)
-
+        self.color = tagColors(tag)
         self.cornerColors = [[self.color[0], self.color[0], self.color[0], self.color[0]],
                              [self.color[1], self.color[1], self.color[1], self.color[1]],
                              [self.color[2], self.color[2], self.color[2], self.color[2]],
@@ -215,11 +270,13 @@ class MapSquare(pb.Copyable, pb.RemoteCopy):
         self.z += height
         for i in range(0,4):
             self.cornerHeights[i] -= height
+        self._syncTerrain()
 
     def minusHeight(self,height=1):
         self.z -= height
         for i in range(0,4):
             self.cornerHeights[i] += height
+        self._syncTerrain()
             
 #    def setCornerHeight(self,corner,height):
 #        self.cornerHeights[corner] = height
@@ -235,6 +292,9 @@ class Map(pb.Copyable, pb.RemoteCopy):
         self.width = width
         self.height = height
         self.squares = []
+        # Plain floats, so that the heights worked out below don't end up
+        # as NumPy scalars (whose repr loadString would write out)
+        z = Numeric.asarray(z, dtype=float).tolist()
         for x in range(0, width):
             self.squares.append([])
             for y in range(0, height):
@@ -410,14 +470,14 @@ class Map(pb.Copyable, pb.RemoteCopy):
                         up = self.squares[x][y-1]
                         if up.smooth:
                             smoothed = True
-                            cornerHeights[0] = up.z+up.cornerHeights[2]-z[x,y]
-                            cornerHeights[1] = up.z+up.cornerHeights[3]-z[x,y]
+                            cornerHeights[0] = up.z+up.cornerHeights[2]-z[x][y]
+                            cornerHeights[1] = up.z+up.cornerHeights[3]-z[x][y]
                     if smooth and x-1 >= 0:
                         left = self.squares[x-1][y]
                         if left.smooth:
-                            cornerHeights[2] = left.z+left.cornerHeights[3]-z[x,y]
+                            cornerHeights[2] = left.z+left.cornerHeights[3]-z[x][y]
                             if not smoothed:
-                                cornerHeights[0] = left.z+left.cornerHeights[1]-z[x,y]
+                                cornerHeights[0] = left.z+left.cornerHeights[1]-z[x][y]
                             smoothed = True
 #                     for i in range(4):
 #                        if cornerHeights[i] < -8 or cornerHeights[i] > 8:
@@ -429,7 +489,7 @@ class Map(pb.Copyable, pb.RemoteCopy):
                      (br - random.random() * vbr,bg - random.random() * vbg,bb - random.random() * vbb,ba - random.random() * vba),
                      (rr - random.random() * vrr,rg - random.random() * vrg,rb - random.random() * vrb,ra - random.random() * vra),
                      (fr - random.random() * vfr,fg - random.random() * vfg,fb - random.random() * vfb,fa - random.random() * vfa)]
-                self.squares[x].append(MapSquare(x, y, z[x,y],
+                self.squares[x].append(MapSquare(x, y, z[x][y],
                                                  cornerHeights,
                                                  c,
                                                  smooth, tag,
@@ -487,6 +547,15 @@ class Map(pb.Copyable, pb.RemoteCopy):
                     sq.waterHeight = highestWater
                     sq.waterColor = waterColor
 
+        self._initGrid()
+
+    def _initGrid(self):
+        self.grid = MapGrid(self.width, self.height, self.tags.keys())
+        self.grid.attach(self.squares)
+        self._reachableCache = {}
+        self._reachableVersion = None
+        self._packed = None
+
     def smoothColors(self):
         # Smooth colors between squares with the same tag. The idea is
         # to make the colorVar smooth instead of on a per-square basis.
@@ -536,11 +605,39 @@ class Map(pb.Copyable, pb.RemoteCopy):
         with open(filename, 'w') as f:
             f.write(self.loadString())
 
+    def packed(self):
+        """@return: (content hash, packed bytes), as from MapPack.pack.
+        They're kept until the terrain changes, so the map is packed once
+        however many clients it is sent to."""
+        version = self.grid.terrainVersion
+        if self._packed == None or self._packed[0] != version:
+            self._packed = (version, MapPack.pack(self))
+        return self._packed[1]
+
     def getStateToCopy(self):
-        return self.loadString()
+        (digest, data) = self.packed()
+        return {'hash': digest, 'data': data}
+
+    def getStateToCopyFor(self, perspective):
+        # Clients that told us they have this map (see
+        # GameObserver.perspective_haveMaps) only get its hash
+        (digest, data) = self.packed()
+        if digest in getattr(perspective, 'mapHashes', ()):
+            return {'hash': digest}
+        return {'hash': digest, 'data': data}
 
     def setCopyableState(self, state):
-        m = MapIO.loadString("remote map", state)
+        digest = state['hash']
+        if 'data' in state:
+            data = state['data']
+            if MapPack.contentHash(data) != digest:
+                raise ValueError("Received map doesn't match its hash")
+            mapCache.put(digest, data)
+        else:
+            data = mapCache.get(digest)
+            if data == None:
+                raise ValueError("Map %s isn't in the map cache" % digest)
+        m = MapPack.unpack(data)
         self.__dict__.update(m.__dict__)
         
     def setLoadString(self, text):
@@ -602,15 +699,18 @@ class Map(pb.Copyable, pb.RemoteCopy):
         return result
 
     def bfs(self, start, expand, visitPredicate, resultPredicate):
+        """Generic predicate-driven search that records its progress in
+        each MapSquare's search attribute. The movement queries below use
+        engine.Search instead, which leaves the squares alone."""
         startX = start[0]
         startY = start[1]
         self.resetSearchCosts()
         sq = self.squares
         result = []
-        q = [sq[startX][startY]]
+        q = deque([sq[startX][startY]])
         q[0].search = (0, None)
-        while len(q) > 0:
-            s = q.pop(0)
+        while q:
+            s = q.popleft()
             if resultPredicate(s):
                 result.append(s)
             for newS in expand(s):
@@ -622,54 +722,52 @@ class Map(pb.Copyable, pb.RemoteCopy):
                         newS.search = None
         return result
 
+    def search(self, unit, start, maxCost=None, ignoreUnits=False):
+        """Search outwards from start with unit's movement rules.
+
+        @return: an engine.Search.SearchResult."""
+        return Search.search(self, unit, start, maxCost, ignoreUnits)
+
     # FIXME: don't use faction() directly?
     # FIXME: this should be in the AI code, not here
     def closestUnits(self, unit, faction):
-        def visit(s):
-            connectedOK = (s.search[1] == None or
-                           connected(s.search[1], s, unit))
-            return connectedOK
-        def resultp(s):
-            for neighbor in self.getPotentialConnections(s):
-                if (neighbor.unit != None and
-                    neighbor.unit.faction() == faction and
-                    neighbor.unit.alive()):
-                    return True
-            return False
-        start = (unit.x(), unit.y())
-        expand = lambda s: self.getPotentialConnections(s)
-        result = self.bfs(start, expand, visit, resultp)
-        return result
+        nextTo = Numeric.zeros((self.width, self.height), dtype=bool)
+        for ((x, y), u) in self.grid.occupants():
+            if u.faction() == faction and u.alive():
+                for s in self.getPotentialConnections(self.squares[x][y]):
+                    nextTo[s.x, s.y] = True
+        result = self.search(unit, unit.posn())
+        return [self.squares[x][y] for (x, y) in result.positions(nextTo)]
     
     def reachable(self, unit):
-        def visit(s):
-            costOK = s.search[0] <= unit.move()
-            connectedOK = (s.search[1] == None or
-                           connected(s.search[1], s, unit))
-            return costOK and connectedOK
-        start = (unit.x(), unit.y())
-        resultp = lambda s: s.unit == None
-        expand = lambda s: self.getPotentialConnections(s)
-        result = self.bfs(start, expand, visit, resultp)
-        return [(s.x, s.y) for s in result]
+        """@return: a list of the empty (x, y) squares unit can move to.
+
+        Results are cached per unit until the terrain or the occupancy of
+        the map changes, so the GUI, the AI and Battle.unitMoved can all
+        ask for the same unit's range in a turn without searching again."""
+        grid = self.grid
+        version = (grid.terrainVersion, grid.occupancyVersion)
+        if self._reachableVersion != version:
+            self._reachableCache = {}
+            self._reachableVersion = version
+        key = (unit.unitID, unit.posn(), unit.move(), unit.jump(),
+               unit.faction())
+        result = self._reachableCache.get(key)
+        if result is None:
+            search = self.search(unit, unit.posn(), unit.move())
+            result = tuple(search.positions(grid.unitID == NO_UNIT))
+            self._reachableCache[key] = result
+        return list(result)
 
     def fillDistances(self, unit, posn):
-        def visit(s):
-            connectedOK = (s.search[1] == None or
-                           connectedIgnoringUnits(s.search[1], s, unit))
-            return connectedOK
-        start = posn
-        resultp = lambda s: s.unit == None
-        expand = lambda s: self.getPotentialConnections(s)
-        self.bfs(start, expand, visit, resultp)
-
-    def shortestPath(self, targetX, targetY):
-        sq = self.squares
-        result = [sq[targetX][targetY]]
-        while result[-1].search[0] != 0:
-            (cost, prev) = result[-1].search
-            result.append(prev)
-        return result
+        """@return: a SearchResult holding the distance from posn to every
+        square unit could walk from, ignoring other units."""
+        return self.search(unit, posn, ignoreUnits=True)
+
+    def shortestPath(self, targetX, targetY, search):
+        """@return: the squares from (targetX, targetY) back to the start
+        of search (a SearchResult)."""
+        return search.path(targetX, targetY)
 
     def changeCorner(self, x, y, corner, change):
         sq = self.squares[x][y]
@@ -692,6 +790,7 @@ class Map(pb.Copyable, pb.RemoteCopy):
                     sq.cornerHeights[corner] + sq.height()):
                     getDiag = True
                     nb.cornerHeights[corner-2*dy] += change
+                    nb._syncTerrain()
             if self.squareExists(x+dx,y):
                 nb = self.squares[x+dx][y]
                 if (nb.tag == sq.tag and
@@ -699,13 +798,16 @@ class Map(pb.Copyable, pb.RemoteCopy):
                     sq.cornerHeights[corner] + sq.height()):
                     getDiag = True
                     nb.cornerHeights[corner-dx] += change
+                    nb._syncTerrain()
             if getDiag == True and self.squareExists(x+dx,y+dy):
                 nb = self.squares[x+dx][y+dy]
                 if (nb.tag == sq.tag and
                     nb.cornerHeights[3-corner] + nb.height() ==
                     sq.cornerHeights[corner] + sq.height()):
                     nb.cornerHeights[3-corner] += change
+                    nb._syncTerrain()
         sq.cornerHeights[corner] += change
+        sq._syncTerrain()
 
     def index(self, x, y):
         return y * self.width + x
@@ -722,88 +824,22 @@ class Map(pb.Copyable, pb.RemoteCopy):
 class MapIO(object):
 
     def load(mapname):
+        """Load a map file: a binary one (see MapFile) if the name ends
+        with MapFile.SUFFIX, else a text one (see loadString)."""
+        if mapname.endswith(MapFile.SUFFIX):
+            return MapFile.load(mapname)
         with open(mapname, 'r') as mapfile:
             text = mapfile.read()
         return MapIO.loadString(mapname, text)
     
     def loadString(mapname, text):
-        """Load map data from string using safe literal evaluation.
-
-        Uses ast.literal_eval for safety instead of eval() to prevent
-        arbitrary code execution. Only Python literals are allowed.
-        """
-        import ast
-
-        # Parse the map file safely
-        mapData = {}
-        try:
-            # Split into assignment statements
-            lines = text.split('\n')
-            current_var = None
-            current_value = []
-            in_multiline = False
-
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-
-                # Handle multiline strings (''')
-                if "'''" in line:
-                    if not in_multiline:
-                        # Start of multiline string
-                        var_name = line.split('=')[0].strip()
-                        in_multiline = True
-                        current_var = var_name
-                        current_value = []
-                        # Check if it ends on same line
-                        if line.count("'''") == 2:
-                            # Single line triple-quoted string
-                            content = line.split("'''")[1]
-                            mapData[var_name] = content
-                            in_multiline = False
-                            current_var = None
-                    else:
-                        # End of multiline string
-                        mapData[current_var] = '\n'.join(current_value)
-                        in_multiline = False
-                        current_var = None
-                        current_value = []
-                    continue
-
-                if in_multiline:
-                    current_value.append(line)
-                    continue
-
-                # Regular assignment
-                if '=' in line and not in_multiline:
-                    var_name, value = line.split('=', 1)
-                    var_name = var_name.strip()
-                    value = value.strip()
-
-                    # Use ast.literal_eval for safe evaluation of Python literals
-                    try:
-                        mapData[var_name] = ast.literal_eval(value)
-                    except (ValueError, SyntaxError) as e:
-                        raise ValueError(f"Invalid map data for {var_name}: {e}")
-
-        except Exception:
-            # Fallback to old method for backward compatibility
-            # This is expected for map files with Python code (variable definitions)
-            logger.debug(f"Map '{mapname}' uses Python code, parsing with eval()")
-            try:
-                compiled = compile(text, mapname, 'exec')
-                localVars = {}
-                eval(compiled, {}, localVars)
-                mapData = localVars
-            except Exception as eval_error:
-                raise ValueError(f"Map parsing failed: {eval_error}")
-
+        """Load map data from a string (see engine.MapParser for what the
+        text may contain)."""
+        mapData = MapParser.parseAssignments(mapname, text)
         if mapData["VERSION"] != 1:
             raise ValueError(f"Map version {mapData['VERSION']} not supported")
         width = mapData['WIDTH']
         height = mapData['HEIGHT']
-#        tilePropertiesTemplate = {}
         waterHeight = 0
         waterColor = [0.3, 0.3, 0.6]
         if 'WATER_HEIGHT' in mapData:
@@ -820,55 +856,511 @@ class MapIO(object):
                     tags[k]['waterHeight'] = waterHeight
         else:
             tags = {}
-        layoutLines = mapData['LAYOUT'].split('\n')
-        layoutLines.pop(0)
-        zdata = Numeric.zeros((width, height))
-        tileProperties = Numeric.zeros((width, height), dtype=object)
-        y = 0
-        padded_lines = 0  # Track irregular map shape
-        for line in layoutLines:
-            if re.match(re.compile(r'^\s*$'), line):
-                continue
-            # Split on multiple spaces (2+) to handle padded tiles
-            # The layout uses %-30s formatting which creates spaces between tiles
-            tiles = re.split(r'\s{2,}', line.strip())
-            # Filter out empty strings from the split
-            tiles = [t for t in tiles if t.strip()]
-
-            # If we have fewer tiles than expected, pad with defaults
-            # This is expected for triangular or irregular-shaped maps
-            if len(tiles) < width:
-                padded_lines += 1
-                # Pad with default tile data
-                tiles.extend(['0'] * (width - len(tiles)))
-
-            for x in range(0, width):
-                tileData = tiles[x] if x < len(tiles) else '0'
-                tileProperties[x,y] = {}
-                # Updated regex to handle floats in corner heights (including negative)
-                m = re.match(re.compile(
-                    r'(\d+)(\[(-?[\d.]+),\s*(-?[\d.]+),\s*(-?[\d.]+),\s*(-?[\d.]+)\])?(wh(\d+))?(\w*)'), tileData)
-                if m is None:
-                    raise ValueError(f"Invalid tile data at position ({x},{y}): '{tileData}'")
-                zdata[x,y] = int(m.group(1))
-                tileProperties[x,y]['tag'] = m.group(9) if m.group(9) else ''
-                if m.group(2) != None:
-                    tileProperties[x,y]['cornerHeights'] = [int(float(m.group(3))),int(float(m.group(4))),int(float(m.group(5))),int(float(m.group(6)))]
-                if m.group(7) != None:
-                    tileProperties[x,y]['waterHeight'] = int(m.group(8))
-            y += 1
+        layout = MapParser.parseLayout(mapData['LAYOUT'], width, height)
 
         # Log map shape summary if irregular
-        if padded_lines > 0:
-            logger.debug(f"Loaded irregular map: {mapname} ({width}x{height}, {padded_lines} padded rows)")
+        if layout.paddedRows > 0:
+            logger.debug(f"Loaded irregular map: {mapname} ({width}x{height}, {layout.paddedRows} padded rows)")
 
-        m = Map(width, height, zdata, tileProperties, waterHeight, waterColor, tags)
+        m = Map(width, height, layout.z, layout.tileProperties(),
+                waterHeight, waterColor, tags)
         m.setLoadString(text)
         return m
 
     load = staticmethod(load)
     loadString = staticmethod(loadString)
 
+def _numbers(a):
+    """@return: a as nested lists, with whole numbers as ints (as the map
+    loader would have made them) and the rest as floats."""
+    whole = a == Numeric.floor(a)
+    if whole.all():
+        return a.astype(int).tolist()
+    result = a.astype(object)
+    result[whole] = a[whole].astype(int)
+    return result.tolist()
+
+class MapPack(object):
+    """Compact binary form of a Map, for sending it over the network.
+
+    A packed map is:
+    - MAGIC, then the format version and the header length as
+      little-endian uint16 / uint32
+    - the header: repr() of a dict with the sizes, global water, tags,
+      and the tables the per-square arrays index into
+    - the zlib-compressed per-square arrays, [x, y] order: z, corner
+      heights, water height, tag index, water color index and smooth flag
+
+    Square colors aren't stored; they are rolled from the tags' colorVar
+    when the map is unpacked, as they are when a map file is loaded.
+
+    The content hash covers the header and the uncompressed arrays, so
+    the same map always hashes the same way.
+    """
+    MAGIC = b'GWMP'
+    VERSION = 1
+    _PREFIX = struct.Struct('<HI')
+    _ARRAYS = (('z', '<f8', ()), ('cornerHeights', '<f8', (4,)),
+               ('waterHeight', '<f8', ()), ('tag', '<i2', ()),
+               ('waterColor', '<i2', ()), ('smooth', 'u1', ()))
+
+    def pack(m):
+        """@return: (content hash, packed bytes) for map m."""
+        (info, arrays) = MapPack._arrays(m)
+        header = repr(info).encode('utf-8')
+        payload = b''.join(a.tobytes() for a in arrays)
+        digest = hashlib.sha256(header + payload).hexdigest()
+        data = (MapPack.MAGIC +
+                MapPack._PREFIX.pack(MapPack.VERSION, len(header)) +
+                header + zlib.compress(payload))
+        return (digest, data)
+
+    def _arrays(m):
+        """@return: (header dict, [arrays in _ARRAYS order]) for map m."""
+        grid = m.grid
+        fileArrays = m.__dict__.get('_fileArrays')
+        if fileArrays != None and fileArrays[0] == grid.terrainVersion:
+            # Loaded from a binary map file and not edited since, so
+            # there's no need to build every square to find out
+            return fileArrays[1:]
+        shape = (m.width, m.height)
+        waterColors = []
+        waterColorIndex = Numeric.zeros(shape, dtype='<i2')
+        smooth = Numeric.zeros(shape, dtype='u1')
+        for column in m.squares:
+            for sq in column:
+                if sq.waterColor in waterColors:
+                    i = waterColors.index(sq.waterColor)
+                else:
+                    i = len(waterColors)
+                    waterColors.append(sq.waterColor)
+                waterColorIndex[sq.x, sq.y] = i
+                smooth[sq.x, sq.y] = bool(sq.smooth)
+        info = {'width': m.width,
+                'height': m.height,
+                'waterHeight': m.waterHeight,
+                'waterColor': m.waterColor,
+                'tags': m.tags,
+                'tagNames': list(grid.tagNames),
+                'waterColors': waterColors}
+        arrays = [grid.z.astype('<f8'),
+                  grid.cornerHeights.astype('<f8'),
+                  grid.waterHeight.astype('<f8'),
+                  grid.tag.astype('<i2'),
+                  waterColorIndex,
+                  smooth]
+        return (info, arrays)
+
+    def _split(data):
+        """@return: (header bytes, uncompressed payload)."""
+        magic = MapPack.MAGIC
+        if data[:len(magic)] != magic:
+            raise ValueError("Not a packed map")
+        start = len(magic) + MapPack._PREFIX.size
+        (version, headerLength) = MapPack._PREFIX.unpack(
+            data[len(magic):start])
+        if version != MapPack.VERSION:
+            raise ValueError(f"Packed map version {version} not supported")
+        header = data[start:start + headerLength]
+        payload = zlib.decompress(data[start + headerLength:])
+        return (header, payload)
+
+    def contentHash(data):
+        (header, payload) = MapPack._split(data)
+        return hashlib.sha256(header + payload).hexdigest()
+
+    def unpack(data):
+        """@return: a new Map from packed bytes."""
+        # Building the squares allocates lots of small objects; don't let
+        # the cyclic garbage collector rescan them all as it goes.
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            return MapPack._unpack(data)
+        finally:
+            if gcWasEnabled:
+                gc.enable()
+
+    def _unpack(data):
+        (header, payload) = MapPack._split(data)
+        info = ast.literal_eval(header.decode('utf-8'))
+        (width, height) = (info['width'], info['height'])
+        arrays = {}
+        offset = 0
+        for (name, dtype, extra) in MapPack._ARRAYS:
+            shape = (width, height) + extra
+            a = Numeric.frombuffer(payload, dtype=dtype,
+                                   count=int(Numeric.prod(shape)),
+                                   offset=offset).reshape(shape)
+            offset += a.nbytes
+            arrays[name] = a
+        return MapPack._build(info, arrays)
+
+    def _build(info, arrays, colors=None):
+        """@return: a new Map from a header dict and the [x, y] arrays
+        named in _ARRAYS. If the (width, height, 5, 4) face colors aren't
+        given, they are rolled from the tags."""
+        (width, height) = (info['width'], info['height'])
+        tags = info['tags']
+        tagNames = info['tagNames']
+        waterColors = info['waterColors']
+        tagIndex = arrays['tag']
+        lists = {}
+        for (name, a) in arrays.items():
+            if name in ('waterHeight', 'cornerHeights'):
+                # Ints when whole, as the map loader makes them, so that
+                # loadString writes them out the same way
+                lists[name] = _numbers(a)
+            else:
+                lists[name] = a.tolist()
+        # Except for smooth squares, which the loader levels off with float
+        # arithmetic
+        (xs, ys) = Numeric.nonzero(arrays['smooth'])
+        if len(xs):
+            corners = arrays['cornerHeights']
+            for (x, y) in zip(xs.tolist(), ys.tolist()):
+                lists['cornerHeights'][x][y] = corners[x, y].tolist()
+
+        m = Map.__new__(Map)
+        m._loadString = ""
+        m.waterHeight = info['waterHeight']
+        m.waterColor = info['waterColor']
+        m.tags = tags
+        m.width = width
+        m.height = height
+
+        if colors is None:
+            # Roll the colors of all the squares with the same tag together
+            colors = Numeric.zeros((width, height, 5, 4))
+            for t in Numeric.unique(tagIndex).tolist():
+                tag = {}
+                if t != NO_TAG and tagNames[t] in tags:
+                    tag = tags[tagNames[t]]
+                where = tagIndex == t
+                colors[where] = tagColorArray(tag, int(where.sum()))
+        # One (r, g, b, a) tuple per face, five faces per square
+        colors = Numeric.asarray(colors).reshape(-1, 4)
+        colors = list(zip(*[colors[:, i].tolist() for i in range(4)]))
+
+        m.squares = []
+        for x in range(0, width):
+            column = []
+            for y in range(0, height):
+                t = lists['tag'][x][y]
+                tag = {}
+                if t != NO_TAG and tagNames[t] in tags:
+                    tag = tags[tagNames[t]]
+                column.append(MapSquare(
+                    x, y, lists['z'][x][y], lists['cornerHeights'][x][y],
+                    colors[(x * height + y) * 5:(x * height + y + 1) * 5],
+                    bool(lists['smooth'][x][y]), tag,
+                    lists['waterHeight'][x][y],
+                    waterColors[lists['waterColor'][x][y]]))
+            m.squares.append(column)
+        m.smoothColors()
+        m._initGrid()
+        return m
+
+    pack = staticmethod(pack)
+    _arrays = staticmethod(_arrays)
+    _split = staticmethod(_split)
+    contentHash = staticmethod(contentHash)
+    unpack = staticmethod(unpack)
+    _unpack = staticmethod(_unpack)
+    _build = staticmethod(_build)
+
+class MapFile(object):
+    """Binary map files, which load without any parsing.
+
+    A binary map file is:
+    - a fixed header: MAGIC, then the format version, the number of
+      sections, the width and the height as little-endian uint16 / uint32
+    - a table with, for each section, its name and NumPy dtype (16 and 8
+      bytes, NUL padded) and its offset and length in bytes (uint64)
+    - the sections, each starting on an ALIGN byte boundary: 'info', the
+      repr() of MapPack's header dict (global water, tags and the tables
+      the other sections index into); MapPack's per-square arrays, [x, y]
+      order; 'colors', the (r, g, b, a) colors of each square's five
+      faces, and 'cornerColors', which face's color (a flat index into
+      'colors') each corner of each face has, as MapSquare keeps them
+
+    The squares are stored as a Map holds them once loaded (smoothed,
+    with water spread to their neighbors, colors rolled and smoothed), so
+    the file loads the same map every time and each square can be built
+    on its own. load maps the file copy-on-write with numpy.memmap: the
+    map's grid works on the mapped arrays directly, and each MapSquare is
+    only built the first time it is looked at (see _FileSquares).
+    """
+    MAGIC = b'GWMB'
+    VERSION = 2
+    SUFFIX = '.gwmb'
+    ALIGN = 64
+    _HEADER = struct.Struct('<4sHHII')
+    _SECTION = struct.Struct('<16s8sQQ')
+    _ARRAYS = MapPack._ARRAYS + (('colors', '<f8', (5, 4)),
+                                 ('cornerColors', '<i4', (5, 4)))
+
+    def save(m, filename):
+        """Write map m to filename, replacing it atomically."""
+        (info, arrays) = MapPack._arrays(m)
+        colors = Numeric.array([[sq.color for sq in column]
+                                for column in m.squares], dtype='<f8')
+        # Corners take their color from a face of their own square or of
+        # a neighbor (see Map.smoothColors)
+        faces = {}
+        for (i, c) in enumerate(colors.reshape(-1, 4).tolist()):
+            faces.setdefault(tuple(c), i)
+        try:
+            cornerColors = Numeric.array(
+                [[[[faces[tuple(c)] for c in face]
+                   for face in sq.cornerColors]
+                  for sq in column] for column in m.squares], dtype='<i4')
+        except KeyError:
+            raise ValueError("A corner color isn't the color of any face")
+        sections = ([('info', 'u1', repr(info).encode('utf-8'))] +
+                    [(name, dtype, a.astype(dtype).tobytes())
+                     for ((name, dtype, extra), a)
+                     in zip(MapFile._ARRAYS,
+                            arrays + [colors, cornerColors])])
+        align = MapFile.ALIGN
+        offset = (MapFile._HEADER.size +
+                  MapFile._SECTION.size * len(sections))
+        table = []
+        for (name, dtype, data) in sections:
+            offset = -(-offset // align) * align
+            table.append(MapFile._SECTION.pack(name.encode('ascii'),
+                                               dtype.encode('ascii'),
+                                               offset, len(data)))
+            offset += len(data)
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(MapFile._HEADER.pack(MapFile.MAGIC, MapFile.VERSION,
+                                         len(sections), m.width, m.height))
+            f.write(b''.join(table))
+            for (name, dtype, data) in sections:
+                f.write(b'\0' * (-f.tell() % align))
+                f.write(data)
+        os.replace(temp, filename)
+
+    def load(filename):
+        """@return: a new Map from a binary map file."""
+        # Copy-on-write, so that edits to the map (e.g. in the map editor)
+        # never reach the file
+        data = Numeric.memmap(filename, dtype='u1', mode='c')
+        sections = MapFile.sections(data)
+        (magic, version, count, width, height) = \
+            MapFile._HEADER.unpack_from(data)
+        info = ast.literal_eval(bytes(sections['info']).decode('utf-8'))
+        if (info['width'], info['height']) != (width, height):
+            raise ValueError("Map file header and info disagree on its size")
+        arrays = {}
+        for (name, dtype, extra) in MapFile._ARRAYS:
+            shape = (width, height) + extra
+            if name not in sections:
+                raise ValueError(f"Map file has no '{name}' section")
+            a = sections[name]
+            if a.dtype != Numeric.dtype(dtype) or a.size != Numeric.prod(shape):
+                raise ValueError(f"Map file section '{name}' is the wrong "
+                                 "type or size")
+            # Plain ndarray views: memmap's Python-level bookkeeping would
+            # otherwise run on every slice the grid queries take
+            arrays[name] = Numeric.asarray(a).reshape(shape)
+
+        m = Map.__new__(Map)
+        m._loadString = ""
+        m.waterHeight = info['waterHeight']
+        m.waterColor = info['waterColor']
+        m.tags = info['tags']
+        m.width = width
+        m.height = height
+        m.grid = MapGrid(width, height, info['tagNames'])
+        m.grid.adopt(arrays['z'], arrays['cornerHeights'],
+                     arrays['waterHeight'], arrays['tag'])
+        m._reachableCache = {}
+        m._reachableVersion = None
+        m._packed = None
+        m.squares = _FileSquares(m, info, arrays)
+        # Until the terrain changes, the map packs straight from the file
+        m._fileArrays = (m.grid.terrainVersion, info,
+                         [arrays[name] for (name, dtype, extra)
+                          in MapPack._ARRAYS])
+        return m
+
+    def sections(data):
+        """@return: a dict of the sections of a binary map file in data (a
+        uint8 array, e.g. a numpy.memmap), as views of it."""
+        try:
+            (magic, version, count, width, height) = \
+                MapFile._HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError("Not a binary map file")
+        if magic != MapFile.MAGIC:
+            raise ValueError("Not a binary map file")
+        if version != MapFile.VERSION:
+            raise ValueError(f"Binary map version {version} not supported")
+        result = {}
+        for i in range(count):
+            try:
+                (name, dtype, offset, length) = MapFile._SECTION.unpack_from(
+                    data, MapFile._HEADER.size + i * MapFile._SECTION.size)
+                dtype = Numeric.dtype(dtype.rstrip(b'\0').decode('ascii'))
+            except (struct.error, TypeError, UnicodeDecodeError):
+                raise ValueError("Corrupt binary map section table")
+            if offset + length > len(data) or length % dtype.itemsize:
+                raise ValueError("Corrupt binary map section table")
+            name = name.rstrip(b'\0').decode('ascii', 'replace')
+            result[name] = data[offset:offset + length].view(dtype)
+        return result
+
+    save = staticmethod(save)
+    load = staticmethod(load)
+    sections = staticmethod(sections)
+
+def _whole(value):
+    """@return: value as an int if it is a whole number, as the map loader
+    would have made it, else as a float."""
+    if value == int(value):
+        return int(value)
+    return value
+
+class _FileSquares(object):
+    """Map.squares for a map loaded from a binary map file.
+
+    Squares are indexed [x][y] and iterated over like the usual lists of
+    columns, but the MapSquares of a column are only built, from the grid
+    and the file's arrays, the first time one of them is looked at.
+    Terrain is read from the grid, so squares built after an edit see
+    it."""
+    def __init__(self, m, info, arrays):
+        self._map = m
+        self._tags = info['tags']
+        self._tagNames = info['tagNames']
+        self._waterColors = info['waterColors']
+        self._arrays = dict((name, arrays[name]) for name in
+                            ('waterColor', 'smooth', 'colors',
+                             'cornerColors'))
+        self._colors = None
+        self._columns = [None] * m.width
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __getitem__(self, x):
+        column = self._columns[x]
+        if column is None:
+            x %= len(self._columns)
+            column = self._buildColumn(x)
+            self._columns[x] = column
+        return column
+
+    def __iter__(self):
+        for x in range(len(self._columns)):
+            yield self[x]
+
+    def _buildColumn(self, x):
+        grid = self._map.grid
+        arrays = self._arrays
+        tags = self._tags
+        tagNames = self._tagNames
+        waterColors = self._waterColors
+        if self._colors is None:
+            # One (r, g, b, a) tuple per face, shared by the corners that
+            # have its color
+            colors = arrays['colors'].reshape(-1, 4)
+            self._colors = list(zip(*[colors[:, i].tolist()
+                                      for i in range(4)]))
+        colors = self._colors
+        height = self._map.height
+        column = []
+        for (y, z, cornerHeights, waterHeight, t, waterColor, smooth,
+             cornerColors) in zip(
+                 range(height), grid.z[x].tolist(),
+                 grid.cornerHeights[x].tolist(),
+                 grid.waterHeight[x].tolist(), grid.tag[x].tolist(),
+                 arrays['waterColor'][x].tolist(),
+                 arrays['smooth'][x].tolist(),
+                 arrays['cornerColors'][x].tolist()):
+            # Whole heights are ints, as the loader makes them, except for
+            # the corners of smooth squares, which it levels off with
+            # float arithmetic
+            if not smooth:
+                cornerHeights = [_whole(c) for c in cornerHeights]
+            tag = {}
+            if t != NO_TAG and tagNames[t] in tags:
+                tag = tags[tagNames[t]]
+            face = (x * height + y) * 5
+            sq = MapSquare(x, y, z, cornerHeights, colors[face:face + 5],
+                           bool(smooth), tag, _whole(waterHeight),
+                           waterColors[waterColor])
+            sq.__dict__['cornerColors'] = [[colors[i] for i in corners]
+                                           for corners in cornerColors]
+            sq.__dict__['unit'] = grid.unitAt(x, y)
+            sq.__dict__['_grid'] = grid
+            column.append(sq)
+        return column
+
+class MapCache(object):
+    """Packed maps by content hash, so a client that already has a map
+    doesn't need to be sent it. Maps are kept in memory and, if a
+    directory is set, on disk between runs."""
+    SUFFIX = '.gwmap'
+
+    def __init__(self, directory=None):
+        self._maps = {}
+        self.directory = directory
+
+    def setDirectory(self, directory):
+        self.directory = directory
+
+    def _filename(self, digest):
+        return os.path.join(self.directory, digest + MapCache.SUFFIX)
+
+    def hashes(self):
+        result = set(self._maps)
+        if self.directory != None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(MapCache.SUFFIX):
+                    result.add(name[:-len(MapCache.SUFFIX)])
+        return sorted(result)
+
+    def add(self, m):
+        """Remember map m. @return: its content hash."""
+        (digest, data) = m.packed()
+        self._maps[digest] = data
+        return digest
+
+    def put(self, digest, data):
+        self._maps[digest] = data
+        if self.directory == None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp = self._filename(digest) + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self._filename(digest))
+        except OSError as e:
+            logger.warning(f"Couldn't save map {digest} to the cache: {e}")
+
+    def get(self, digest):
+        """@return: the packed map with this hash, or None."""
+        data = self._maps.get(digest)
+        if data != None or self.directory == None:
+            return data
+        try:
+            with open(self._filename(digest), 'rb') as f:
+                data = f.read()
+            if MapPack.contentHash(data) != digest:
+                logger.warning(f"Cached map {digest} is corrupt, ignoring it")
+                return None
+        except (OSError, ValueError, struct.error, zlib.error):
+            return None
+        self._maps[digest] = data
+        return data
+
+# Maps this process knows about, shared by the loader and the network code
+mapCache = MapCache()
+
 def connectedIgnoringUnits(sq1, sq2, unit):
     return connected(sq1, sq2, unit, True)
 
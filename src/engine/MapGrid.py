@@ -0,0 +1,326 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Array-backed mirror of a Map's squares.
+
+The MapSquare objects stay the authoritative, editable representation of
+the battlefield (the GUI and the map editor work on them directly), but
+walking them attribute by attribute is slow for pathfinding, range and AI
+queries. MapGrid keeps the fields those queries need in contiguous NumPy
+arrays indexed [x, y], so they can be answered with vectorized operations.
+
+MapSquare forwards its writes to the grid, so the arrays never need to be
+rebuilt by hand:
+- assigning sq.unit, sq.z, sq.waterHeight, sq.cornerHeights or sq.tag
+- MapSquare.setUnit, setTag, plusHeight and minusHeight
+- Map.changeCorner
+"""
+
+import numpy
+
+NO_UNIT = -1
+NO_TAG = -1
+
+# Per-square fields mirrored from MapSquare.
+TERRAIN_FIELDS = ('z', 'waterHeight', 'cornerHeights')
+GRID_FIELDS = TERRAIN_FIELDS + ('unit', 'tag')
+
+# The four steps a unit can take, in Map.getPotentialConnections order, as
+# (source slice, destination slice) pairs over an [x, y] array: for a step
+# in direction d, a[src] and a[dst] line up each square with its
+# neighbour.
+STEP_SLICES = (((slice(1, None), slice(None)), (slice(None, -1), slice(None))),
+               ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+               ((slice(None), slice(1, None)), (slice(None), slice(None, -1))),
+               ((slice(None), slice(None, -1)), (slice(None), slice(1, None))))
+
+
+class MapGrid(object):
+    def __init__(self, width, height, tagNames=()):
+        self.width = width
+        self.height = height
+        self.size = width * height
+        self.z = numpy.zeros((width, height), dtype=numpy.float64)
+        self.cornerHeights = numpy.zeros((width, height, 4),
+                                         dtype=numpy.float64)
+        self.waterHeight = numpy.zeros((width, height), dtype=numpy.float64)
+        self.unitID = numpy.full((width, height), NO_UNIT, dtype=numpy.int32)
+        self.tag = numpy.full((width, height), NO_TAG, dtype=numpy.int16)
+        self.tagNames = list(tagNames)
+        self._tagIndex = dict((n, i) for (i, n) in enumerate(self.tagNames))
+        # Units by (x, y), for the few queries that need more than the ID
+        # (alive(), faction()).
+        self._units = {}
+        # The factions on the map and the boolean masks from occupiedBy,
+        # valid at _factionsVersion
+        self._factions = None
+        self._factionMasks = {}
+        self._factionsVersion = None
+        # Results of aoeHits, valid while the terrain is unchanged
+        self._aoeHits = {}
+        self._noHits = None
+        # Bumped on every terrain / occupancy change so that caches built
+        # on top of the grid know when to throw their results away.
+        # Occupancy versions come from a clock that never goes backwards,
+        # so resetOccupancyVersion can't make a version number mean two
+        # different arrangements of units.
+        self.terrainVersion = 0
+        self.occupancyVersion = 0
+        self._occupancyClock = 0
+        # A name for the current occupancy version (see nameOccupancy),
+        # and the version it was given to
+        self._occupancyName = None
+        self._occupancyNameVersion = None
+        self._walkable = None
+        self._steps = {}
+
+    def attach(self, squares):
+        """Copy every square into the arrays and start mirroring its
+        writes. squares is indexed [x][y], like Map.squares."""
+        for column in squares:
+            for sq in column:
+                self.syncTerrain(sq)
+                self.syncTag(sq)
+                self.setUnit(sq.x, sq.y, sq.unit)
+                sq.__dict__['_grid'] = self
+
+    def adopt(self, z, cornerHeights, waterHeight, tag):
+        """Use existing [x, y] arrays (e.g. views of a memory-mapped map
+        file) as the terrain and tags, instead of copying squares in with
+        attach. tag indexes into tagNames. Squares built later on must
+        have '_grid' set in their __dict__ to mirror their writes."""
+        self.z = numpy.asarray(z, dtype=numpy.float64)
+        self.cornerHeights = numpy.asarray(cornerHeights,
+                                           dtype=numpy.float64)
+        self.waterHeight = numpy.asarray(waterHeight, dtype=numpy.float64)
+        self.tag = numpy.asarray(tag, dtype=numpy.int16)
+        self.terrainVersion += 1
+
+    def index(self, x, y):
+        """Flat index of (x, y) into the raveled [x, y] arrays."""
+        return x * self.height + y
+
+    def posn(self, index):
+        return divmod(int(index), self.height)
+
+    def syncTerrain(self, sq):
+        x, y = sq.x, sq.y
+        self.z[x, y] = sq.z
+        self.waterHeight[x, y] = sq.waterHeight
+        self.cornerHeights[x, y] = sq.cornerHeights
+        self.terrainVersion += 1
+        self._walkable = None
+        if self._aoeHits:
+            self._aoeHits = {}
+        if self._steps:
+            self._steps = {}
+
+    def syncTag(self, sq):
+        name = sq.tag.get('name') if sq.tag else None
+        if name is None:
+            self._setTag(sq.x, sq.y, NO_TAG)
+            return
+        if name not in self._tagIndex:
+            self._tagIndex[name] = len(self.tagNames)
+            self.tagNames.append(name)
+        self._setTag(sq.x, sq.y, self._tagIndex[name])
+
+    def _setTag(self, x, y, index):
+        if self.tag[x, y] != index:
+            self.tag[x, y] = index
+            # Tags are part of the terrain as far as anything packing or
+            # saving the map is concerned
+            self.terrainVersion += 1
+
+    def setUnit(self, x, y, unit):
+        if unit is None:
+            self.unitID[x, y] = NO_UNIT
+            self._units.pop((x, y), None)
+        else:
+            self.unitID[x, y] = unit.unitID
+            self._units[(x, y)] = unit
+        self.occupancyChanged()
+
+    def occupancyChanged(self):
+        """Start a new occupancy version. setUnit calls this itself; call
+        it directly when a unit's blocking changes without a square being
+        written, e.g. when it dies where it stands."""
+        self._occupancyClock += 1
+        self.occupancyVersion = self._occupancyClock
+
+    def resetOccupancyVersion(self, version):
+        """Go back to an earlier occupancy version. Only for callers that
+        have just undone every change made since version was current."""
+        self.occupancyVersion = version
+
+    def nameOccupancy(self, name):
+        """Name the current arrangement of units. The name should be the
+        same whenever the same arrangement is made again (e.g. by the same
+        temporary move from the same starting arrangement), so that caches
+        keyed on occupancyKey can find what they worked out for it last
+        time. It holds until the occupancy next changes."""
+        self._occupancyName = name
+        self._occupancyNameVersion = self.occupancyVersion
+
+    def occupancyKey(self):
+        """@return: a hashable key for the current arrangement of units:
+        its name, if nameOccupancy gave it one, else occupancyVersion."""
+        if self._occupancyNameVersion == self.occupancyVersion:
+            return self._occupancyName
+        return self.occupancyVersion
+
+    def unitAt(self, x, y):
+        return self._units.get((x, y))
+
+    def occupants(self):
+        """@return: a list of ((x, y), unit) for every occupied square."""
+        return list(self._units.items())
+
+    def _checkFactionsVersion(self):
+        if self._factionsVersion != self.occupancyVersion:
+            self._factions = None
+            self._factionMasks = {}
+            self._factionsVersion = self.occupancyVersion
+
+    def factions(self):
+        """@return: the factions with a unit on the map, in ID order."""
+        self._checkFactionsVersion()
+        if self._factions is None:
+            self._factions = sorted(set(u.faction()
+                                        for u in self._units.values()))
+        return self._factions
+
+    def occupiedBy(self, factions):
+        """Read-only boolean [x, y] mask of the squares holding a unit,
+        dead or alive, of one of the given factions.
+
+        Masks and factions() are cached until the occupancy changes; call
+        occupancyChanged if a unit on the map changes faction."""
+        self._checkFactionsVersion()
+        factions = frozenset(factions)
+        mask = self._factionMasks.get(factions)
+        if mask is None:
+            mask = numpy.zeros((self.width, self.height), dtype=bool)
+            for ((x, y), unit) in self._units.items():
+                if unit.faction() in factions:
+                    mask[x, y] = True
+            mask.flags.writeable = False
+            self._factionMasks[factions] = mask
+        return mask
+
+    def walkable(self):
+        """Boolean [x, y] mask of squares a unit may stand on, using the
+        same terrain rules as Map.connected (no holes, not under deep
+        water). The mask is cached until the terrain changes."""
+        mask = self._walkable
+        if mask is None:
+            mask = (self.z != 0) & (self.z + 4 >= self.waterHeight)
+            self._walkable = mask
+        return mask
+
+    def steps(self, jump):
+        """Terrain connectivity for units with the given jump: a tuple of
+        four boolean [x, y] masks, one per STEP_SLICES direction, True
+        where a unit may step from that square to its neighbour in that
+        direction. Occupancy is not taken into account. Built once per
+        jump value and cached until the terrain changes."""
+        result = self._steps.get(jump)
+        if result is None:
+            walkable = self.walkable()
+            result = []
+            for (src, dst) in STEP_SLICES:
+                mask = numpy.zeros((self.width, self.height), dtype=bool)
+                mask[src] = (walkable[src] & walkable[dst] &
+                             (numpy.abs(self.z[src] - self.z[dst]) <= jump))
+                result.append(mask)
+            result = tuple(result)
+            self._steps[jump] = result
+        return result
+
+    def aoeHits(self, offsets, zdiff, targets):
+        """Where an area of effect takes in a target.
+
+        @param offsets: an (n, 2) array of the area's (dx, dy) offsets from
+        the square it is aimed at (see Range.offsets).
+        @param zdiff: how far above or below the aimed-at square an area
+        square may be.
+        @param targets: a boolean [x, y] mask of the squares that count.
+        @return: a read-only boolean [x, y] mask, True on the squares where
+        aiming the area takes in a target square. Results are cached until
+        the terrain changes, so a target mask that comes round again (e.g.
+        when the AI tries out moves that don't change who can be hit) costs
+        a dictionary lookup."""
+        if not targets.any():
+            return self.noHits()
+        key = (offsets.tobytes(), zdiff, targets.tobytes())
+        result = self._aoeHits.get(key)
+        if result is not None:
+            return result
+        (w, h) = (self.width, self.height)
+        result = numpy.zeros((w, h), dtype=bool)
+        for (dx, dy) in offsets.tolist():
+            # The aimed-at squares whose area square is on the map
+            (x0, x1) = (max(0, -dx), min(w, w - dx))
+            (y0, y1) = (max(0, -dy), min(h, h - dy))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            src = (slice(x0, x1), slice(y0, y1))
+            dst = (slice(x0 + dx, x1 + dx), slice(y0 + dy, y1 + dy))
+            result[src] |= (targets[dst] &
+                            (numpy.abs(self.z[dst] - self.z[src]) <= zdiff))
+        result.flags.writeable = False
+        if len(self._aoeHits) >= 256:
+            self._aoeHits = {}
+        self._aoeHits[key] = result
+        return result
+
+    def noHits(self):
+        """@return: a read-only all-False [x, y] mask."""
+        if self._noHits is None:
+            self._noHits = numpy.zeros((self.width, self.height), dtype=bool)
+            self._noHits.flags.writeable = False
+        return self._noHits
+
+    def inBounds(self, xs, ys):
+        """Vectorized Map.squareExists."""
+        xs = numpy.asarray(xs)
+        ys = numpy.asarray(ys)
+        return ((xs >= 0) & (ys >= 0) &
+                (xs < self.width) & (ys < self.height))
+
+    def filterSquares(self, xs, ys, z=None, zdiff=None):
+        """Keep the (x, y) pairs that lie on the map and, if z and zdiff
+        are given, whose square height is within zdiff of z.
+
+        @return: (xs, ys) arrays of the surviving squares, in input order.
+        """
+        xs = numpy.asarray(xs, dtype=numpy.intp)
+        ys = numpy.asarray(ys, dtype=numpy.intp)
+        # Negative coordinates wrap round to huge unsigned ones, so one
+        # comparison per axis does for inBounds
+        keep = ((xs.view(numpy.uintp) < self.width) &
+                (ys.view(numpy.uintp) < self.height))
+        xs = xs[keep]
+        ys = ys[keep]
+        if z is not None and zdiff is not None:
+            keep = numpy.abs(self.z[xs, ys] - z) <= zdiff
+            xs = xs[keep]
+            ys = ys[keep]
+        return xs, ys
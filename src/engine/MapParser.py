@@ -0,0 +1,221 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+Map file parser.
+
+A map file is a list of Python assignments: VERSION, WIDTH, HEIGHT,
+WATER_HEIGHT, WATER_COLOR, TILE_PROPERTIES and LAYOUT, plus any constants
+they use. parseAssignments evaluates them without eval(): the right-hand
+sides may only be literals, names assigned earlier in the file and
+arithmetic on numbers.
+
+parseLayout splits the LAYOUT string into tiles in one pass, matches
+each distinct tile once against a precompiled pattern and fills typed
+[x, y] arrays from the results in bulk (see MapLayout). Tiles are
+separated by any blanks; corner heights may contain blanks
+("4[0, 0, 2, 2]g").
+"""
+
+import ast
+import operator
+import re
+import numpy
+
+# One tile: height, optional [corner heights], optional wh<water height>
+# and the tag name
+_TILE = re.compile(r'(\d+)'
+                   r'(?:\[(-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\])?'
+                   r'(?:wh(\d+))?'
+                   r'(\w*)')
+# Corner heights, which may have blanks in them that would split the tile
+_CORNERS = re.compile(r'\[[^\]\n]*\]')
+# A tile missing from the end of a short row
+_EMPTY_TILE = '0'
+
+_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub,
+              ast.Mult: operator.mul, ast.Div: operator.truediv,
+              ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+
+def parseAssignments(mapname, text):
+    """@return: a dict of the names assigned in map file text.
+    @raise ValueError: if the text is anything but assignments of
+    literals, earlier names and arithmetic on them."""
+    try:
+        module = ast.parse(text, mapname)
+    except SyntaxError as e:
+        raise ValueError(f"Map parsing failed: {e}")
+    names = {}
+    for statement in module.body:
+        if (not isinstance(statement, ast.Assign) or
+            not all(isinstance(t, ast.Name) for t in statement.targets)):
+            raise ValueError(f"Map parsing failed: line {statement.lineno} "
+                             "isn't an assignment")
+        value = _evaluate(statement.value, names)
+        for target in statement.targets:
+            names[target.id] = value
+    return names
+
+
+def _evaluate(node, names):
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        if node.id not in names:
+            raise ValueError(f"Map parsing failed: line {node.lineno}: "
+                             f"'{node.id}' is not defined")
+        return names[node.id]
+    if isinstance(node, ast.Tuple):
+        return tuple(_evaluate(n, names) for n in node.elts)
+    if isinstance(node, ast.List):
+        return [_evaluate(n, names) for n in node.elts]
+    if isinstance(node, ast.Dict) and None not in node.keys:
+        return dict((_evaluate(k, names), _evaluate(v, names))
+                    for (k, v) in zip(node.keys, node.values))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATORS:
+        operand = _evaluate(node.operand, names)
+        if _isNumber(operand):
+            return _OPERATORS[type(node.op)](operand)
+    if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+        (left, right) = (_evaluate(node.left, names),
+                         _evaluate(node.right, names))
+        if _isNumber(left) and _isNumber(right):
+            return _OPERATORS[type(node.op)](left, right)
+    raise ValueError(f"Map parsing failed: line {node.lineno}: "
+                     f"unsupported expression")
+
+
+def _isNumber(value):
+    return (isinstance(value, (int, float)) and
+            not isinstance(value, bool))
+
+
+class MapLayout(object):
+    """The tiles of a map's LAYOUT, as [x, y] arrays:
+    - z: heights, as floats like MapGrid keeps them
+    - cornerHeights: (width, height, 4) corner heights, meaningful where
+      hasCornerHeights is set
+    - waterHeight: water heights, meaningful where hasWaterHeight is set
+    - tag: indices into tagNames
+    paddedRows counts the rows that were short of tiles (irregular maps
+    fill the rest of the row with height 0 tiles)."""
+    def __init__(self, z, cornerHeights, hasCornerHeights, waterHeight,
+                 hasWaterHeight, tag, tagNames, paddedRows):
+        self.z = z
+        self.cornerHeights = cornerHeights
+        self.hasCornerHeights = hasCornerHeights
+        self.waterHeight = waterHeight
+        self.hasWaterHeight = hasWaterHeight
+        self.tag = tag
+        self.tagNames = tagNames
+        self.paddedRows = paddedRows
+
+    def tileProperties(self):
+        """@return: the [x, y] object array of per-tile dicts the Map
+        constructor takes. Tiles with nothing but a tag share one dict per
+        tag, so don't modify them."""
+        (width, height) = self.z.shape
+        plain = numpy.empty(len(self.tagNames), dtype=object)
+        plain[:] = [{'tag': name} for name in self.tagNames]
+        result = plain[self.tag.ravel()]
+        special = numpy.flatnonzero(self.hasCornerHeights.ravel() |
+                                    self.hasWaterHeight.ravel())
+        if len(special):
+            (xs, ys) = numpy.unravel_index(special, (width, height))
+            for (i, x, y) in zip(special.tolist(), xs.tolist(),
+                                 ys.tolist()):
+                props = {'tag': self.tagNames[self.tag[x, y]]}
+                if self.hasCornerHeights[x, y]:
+                    props['cornerHeights'] = self.cornerHeights[x, y].tolist()
+                if self.hasWaterHeight[x, y]:
+                    props['waterHeight'] = int(self.waterHeight[x, y])
+                result[i] = props
+        return result.reshape(width, height)
+
+
+def parseLayout(layout, width, height):
+    """@return: a MapLayout for the LAYOUT string of a width x height map.
+
+    Tiles are separated by blanks, one row of the map per non-blank line.
+    Rows short of tiles are padded with height 0 tiles and extra tiles at
+    the end of a row are ignored.
+
+    Rows are split into tiles by str.split, and each distinct tile is
+    matched against the tile pattern only once: a map has far fewer
+    distinct tiles than squares.
+    @raise ValueError: on a malformed tile or too many rows."""
+    if '[' in layout:
+        layout = _CORNERS.sub(lambda m: ''.join(m.group().split()), layout)
+    tiles = []
+    paddedRows = 0
+    y = 0
+    for line in layout.split('\n'):
+        row = line.split()
+        if not row:
+            continue
+        if y == height:
+            raise ValueError(f"Map layout has more than {height} rows")
+        if len(row) < width:
+            paddedRows += 1
+            row.extend([_EMPTY_TILE] * (width - len(row)))
+        tiles.extend(row[:width])
+        y += 1
+    # Missing rows are empty too
+    tiles.extend([_EMPTY_TILE] * (width * (height - y)))
+
+    # Number the distinct tiles, and parse each of them once
+    distinct = dict.fromkeys(tiles)
+    zs = []
+    tagNames = []
+    tags = []
+    corners = []
+    waters = []
+    for (i, tile) in enumerate(distinct):
+        m = _TILE.fullmatch(tile)
+        if m is None:
+            (y, x) = divmod(tiles.index(tile), width)
+            raise ValueError(f"Invalid tile data at position ({x},{y}): "
+                             f"'{tile}'")
+        distinct[tile] = i
+        (z, c0, c1, c2, c3, water, tag) = m.groups()
+        zs.append(int(z))
+        if tag not in tagNames:
+            tagNames.append(tag)
+        tags.append(tagNames.index(tag))
+        # Corner heights may be written as floats; int() truncates them
+        corners.append(None if c0 is None else
+                       [int(float(c)) for c in (c0, c1, c2, c3)])
+        waters.append(None if water is None else int(water))
+    tileOf = numpy.fromiter(map(distinct.__getitem__, tiles),
+                            dtype=numpy.intp, count=len(tiles))
+
+    # Tiles are in row order; the map's arrays are [x, y]
+    def grid(values, dtype):
+        a = numpy.array(values, dtype=dtype)[tileOf]
+        return a.reshape((height, width) + a.shape[1:]).swapaxes(0, 1)
+
+    return MapLayout(grid(zs, float),
+                     grid([c or [0, 0, 0, 0] for c in corners],
+                          numpy.int32).reshape(width, height, 4),
+                     grid([c is not None for c in corners], bool),
+                     grid([w or 0 for w in waters], numpy.int32),
+                     grid([w is not None for w in waters], bool),
+                     grid(tags, numpy.int16), tagNames, paddedRows)
@@ -17,107 +17,202 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-import copy
+"""
+Shapes of squares an ability can target or affect.
+
+Each Range lists its squares as (dx, dy) offsets from a position. The
+offsets for a shape and its parameters are worked out once and kept as a
+read-only array (see template), so asking for a range every GUI frame or
+for every AI candidate no longer rebuilds the shape. Range.__call__ then
+drops the squares off the map or too far up or down: big ranges against
+the map's height array in one go (MapGrid.filterSquares), small ones
+square by square, which is quicker for a handful of squares.
+"""
+
+import numpy
 from twisted.spread import pb
 
+# Ranges of up to this many squares are filtered one square at a time
+SMALL_TEMPLATE = 40
+
+_templates = {}
+
+def template(build, *args):
+    """@return: build(*args)'s (dx, dy) offsets as a read-only (n, 2)
+    array, in the order build lists them. Each is only built once."""
+    key = (build, args)
+    result = _templates.get(key)
+    if result is None:
+        result = numpy.array(list(build(*args)),
+                             dtype=numpy.intp).reshape(-1, 2)
+        result.flags.writeable = False
+        _templates[key] = result
+    return result
+
+def singleOffsets():
+    return [(0, 0)]
+
+def lineOffsets(length, dx, dy):
+    return [(dx * i, dy * i) for i in range(0, length)]
+
+def crossOffsets(min, max):
+    result = {}
+    for i in range(min, max+1):
+        result[(i, 0)] = True
+        result[(-i, 0)] = True
+        result[(0, i)] = True
+        result[(0, -i)] = True
+    return result.keys()
+
+def diamondOffsets(min, max):
+    result = {}
+    for i in range(0, max+1):
+        for j in range(0, max+1-i):
+            if min <= (i+j) <= max:
+                result[(j, i)] = True
+                result[(j, -i)] = True
+                result[(-j, i)] = True
+                result[(-j, -i)] = True
+    return result.keys()
+
+def _sign(n):
+    return (n > 0) - (n < 0)
+
 class Range(pb.Copyable, pb.RemoteCopy):
+    # Whether affectedSquares depends on where the unit stands (and not
+    # just on pos)
+    sourcePositionMatters = True
+
     def __init__(self):
         self._zdiff = 8
     
     def __call__(self, map, unit, pos):
+        """@return: the (x, y) squares in range of pos that are on the map
+        and within zdiff of pos's height."""
         x, y, z = pos
-        result = self.affectedSquares(map, unit, (x, y, z))
+        offsets = self.offsets(unit, pos)
+        if len(offsets) <= SMALL_TEMPLATE:
+            return self._filterSquares(map, unit, pos, offsets)
+        xs = x + offsets[:, 0]
+        ys = y + offsets[:, 1]
         # Handle cases where z might not be properly serialized over network
         try:
             z_float = float(z)
-            result = [(x,y) for (x,y) in result
-                      if (map.squareExists(x, y) and
-                          abs(map.squares[x][y].z - z_float) <= self._zdiff)]
         except (TypeError, ValueError):
             # If z is not a valid number (e.g., Unpersistable), skip z-diff check
-            result = [(x,y) for (x,y) in result
-                      if map.squareExists(x, y)]
+            (xs, ys) = map.grid.filterSquares(xs, ys)
+        else:
+            (xs, ys) = map.grid.filterSquares(xs, ys, z_float,
+                                              self.zdiff(unit))
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    def _filterSquares(self, map, unit, pos, offsets):
+        # Square by square: quicker than NumPy for a few squares
+        x, y, z = pos
+        squares = map.squares
+        (width, height) = (map.width, map.height)
+        try:
+            z = float(z)
+            zdiff = self.zdiff(unit)
+        except (TypeError, ValueError):
+            z = None
+        result = []
+        for (dx, dy) in offsets.tolist():
+            (sx, sy) = (x + dx, y + dy)
+            if (0 <= sx < width and 0 <= sy < height and
+                (z is None or abs(squares[sx][sy].z - z) <= zdiff)):
+                result.append((sx, sy))
         return result
 
+    def offsets(self, unit, pos):
+        """@return: a read-only (n, 2) array of the (dx, dy) offsets from
+        pos of the squares in range, whether or not they are on the map."""
+        return template(list)
+
     def affectedSquares(self, map, unit, pos):
         x, y, z = pos
-        return []
+        return [(x+dx, y+dy) for (dx, dy) in self.offsets(unit, pos).tolist()]
+
+    def zdiff(self, unit):
+        """@return: how far above or below pos a square in range may be."""
+        return self._zdiff
+
+    def maxDistance(self, unit):
+        """@return: an upper bound on the Manhattan distance from pos to
+        any square affectedSquares can return, or None if unknown."""
+        return None
 
 class Line(Range):
     def __init__(self, length, zdiff=8):
         self._length = length
         self._zdiff = zdiff
 
-    def affectedSquares(self, map, unit, pos):
-        x, y, z = pos
-        result = []
-        if ((x - unit.x()) < 0 and (y - unit.y()) == 0):
-            for i in range(0, self._length):
-                result.append((x-i, y))
-        elif ((x - unit.x()) > 0 and (y - unit.y()) == 0):
-            for i in range(0, self._length):
-                result.append((x+i, y))
-        elif ((x - unit.x()) == 0 and (y - unit.y()) < 0):
-            for i in range(0, self._length):
-                result.append((x, y-i))
-        elif ((x - unit.x()) == 0 and (y - unit.y()) > 0):
-            for i in range(0, self._length):
-                result.append((x, y+i))
-        return result
+    def offsets(self, unit, pos):
+        # Away from the unit, if pos is straight along one axis from it
+        dx = _sign(pos[0] - unit.x())
+        dy = _sign(pos[1] - unit.y())
+        if (dx == 0) == (dy == 0):
+            return template(list)
+        return template(lineOffsets, self._length, dx, dy)
+
+    def maxDistance(self, unit):
+        return max(0, self._length - 1)
 
 class Cross(Range):
+    sourcePositionMatters = False
+
     def __init__(self, min, max, zdiff=8):
         self._min = min
         self._max = max
         self._zdiff = zdiff
 
-    def affectedSquares(self, map, unit, pos):
-        x, y, z = pos
-        result = {}
-        for i in range(self._min, self._max+1):
-            result[(x+i, y)] = True
-            result[(x-i, y)] = True
-            result[(x, y+i)] = True
-            result[(x, y-i)] = True
-        result = result.keys()
-        return result
+    def offsets(self, unit, pos, extend=0):
+        return template(crossOffsets, self._min, self._max + extend)
+
+    def maxDistance(self, unit):
+        return max(0, self._max)
 
 class Diamond(Range):
+    sourcePositionMatters = False
+
     def __init__(self, min, max, zdiff=8):
         self._min = min
         self._max = max
         self._zdiff = zdiff
         
-    def affectedSquares(self, map, unit, pos):
-        x, y, z = pos
-        result = {}
-        for i in range(0, self._max+1):
-            for j in range(0, self._max+1-i):
-                if self._min <= (i+j) <= self._max:
-                    result[(x+j,y+i)] = True
-                    result[(x+j,y-i)] = True
-                    result[(x-j,y+i)] = True
-                    result[(x-j,y-i)] = True
-        result = result.keys()
-        return result
+    def offsets(self, unit, pos, extend=0):
+        return template(diamondOffsets, self._min, self._max + extend)
+
+    def maxDistance(self, unit):
+        return max(0, self._max)
 
     def __str__(self):
         return "Diamond(%d,%d)" % (self._min, self._max)
 
 class DiamondExtend(Diamond):
+    """The unit's weapon range, reaching amount squares further."""
     def __init__(self, amount):
         self._amount = amount
         self._zdiff = 0
 
-    def affectedSquares(self, map, unit, pos):
-        x, y, z = pos
-        r = copy.copy(unit.attack().rangeObject())
-        r._max += self._amount
-        self._zdiff = r._zdiff
-        return r.affectedSquares(map, unit, (x, y, z))
+    def offsets(self, unit, pos):
+        r = unit.attack().rangeObject()
+        return r.offsets(unit, pos, extend=self._amount)
+
+    def zdiff(self, unit):
+        return unit.attack().rangeObject().zdiff(unit)
+
+    def maxDistance(self, unit):
+        inner = unit.attack().rangeObject().maxDistance(unit)
+        if inner is None:
+            return None
+        return inner + self._amount
 
 class Single(Range):
-    def affectedSquares(self, map, unit, pos):
-        x, y, z = pos
-        return [(x,y)]
-        
+    sourcePositionMatters = False
+
+    def offsets(self, unit, pos):
+        return template(singleOffsets)
+
+    def maxDistance(self, unit):
+        return 0
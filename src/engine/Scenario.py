@@ -55,10 +55,7 @@ class Scenario(pb.Copyable, pb.RemoteCopy):
         return self._music
 
     def unitFromID(self, unitID):
-        for u in self.units():
-            if u.unitID == unitID:
-                return u
-        return None
+        return self._battle.unitFromID(unitID)
 
 def blankMap(map):
     return Scenario(map, [], Light.defaultEnvironment(),
@@ -107,10 +104,10 @@ def generateRandom(additionalAIUnits):
 
     def verifyMap(map_, units):
         for unit in units:
-            map_.fillDistances(unit, unit.posn())
+            search = map_.fillDistances(unit, unit.posn())
             for other in units:
                 (x, y) = other.posn()
-                if map_.squares[x][y].search == None:
+                if not search.reached(x, y):
                     return False
         return True
 
@@ -0,0 +1,178 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Breadth-first movement search over a Map's grid.
+
+Unlike Map.bfs, a search never writes into the MapSquare objects: each
+call returns its own SearchResult holding distance and predecessor arrays,
+so searches from the AI thread and the GUI can run at the same time.
+
+The search expands a whole BFS level at once with NumPy operations over
+the squares that can possibly be reached (a window of radius maxCost
+around the start, or the whole map for unbounded searches), so it only
+allocates a handful of arrays per call, never one object per square.
+Steps follow the rules of Map.connected, using the terrain connectivity
+MapGrid.steps keeps for each jump value.
+"""
+
+import numpy
+from engine import Faction
+from engine.MapGrid import STEP_SLICES
+
+UNREACHED = -1
+
+
+class SearchResult(object):
+    """Distances and predecessors from a single search.
+
+    Only the window of the map the search could reach is stored; squares
+    outside it are unreached."""
+    def __init__(self, map_, start, origin, dist, prev):
+        self._map = map_
+        self.start = start
+        self._x0, self._y0 = origin
+        self._dist = dist
+        self._prev = prev
+
+    def _local(self, x, y):
+        lx = x - self._x0
+        ly = y - self._y0
+        (w, h) = self._dist.shape
+        if 0 <= lx < w and 0 <= ly < h:
+            return (lx, ly)
+        return None
+
+    def distance(self, x, y):
+        """@return: the number of steps from the start to (x, y), or None
+        if the search did not reach it."""
+        local = self._local(x, y)
+        if local is None:
+            return None
+        d = self._dist[local]
+        if d == UNREACHED:
+            return None
+        return int(d)
+
+    def reached(self, x, y):
+        return self.distance(x, y) is not None
+
+    def distances(self):
+        """@return: an [x, y] array over the whole map of step counts,
+        UNREACHED where the search did not get to."""
+        m = self._map
+        result = numpy.full((m.width, m.height), UNREACHED, dtype=numpy.int32)
+        (w, h) = self._dist.shape
+        result[self._x0:self._x0 + w, self._y0:self._y0 + h] = self._dist
+        return result
+
+    def positions(self, mask=None):
+        """@return: the reached (x, y) positions, closest first. If mask is
+        given (an [x, y] boolean array over the whole map) only positions
+        where it is True are returned."""
+        (w, h) = self._dist.shape
+        reached = self._dist >= 0
+        if mask is not None:
+            reached &= mask[self._x0:self._x0 + w, self._y0:self._y0 + h]
+        (xs, ys) = numpy.nonzero(reached)
+        order = numpy.argsort(self._dist[xs, ys], kind='stable')
+        xs = (xs[order] + self._x0).tolist()
+        ys = (ys[order] + self._y0).tolist()
+        return list(zip(xs, ys))
+
+    def path(self, x, y):
+        """@return: the squares on a shortest path, from (x, y) back to
+        the start (inclusive)."""
+        local = self._local(x, y)
+        if local is None or self._dist[local] == UNREACHED:
+            raise ValueError("(%d, %d) was not reached by the search" % (x, y))
+        h = self._dist.shape[1]
+        squares = self._map.squares
+        result = []
+        index = local[0] * h + local[1]
+        while index != UNREACHED:
+            (lx, ly) = divmod(index, h)
+            result.append(squares[lx + self._x0][ly + self._y0])
+            index = int(self._prev[lx, ly])
+        return result
+
+
+def search(map_, unit, start, maxCost=None, ignoreUnits=False):
+    """Search outwards from start using unit's jump (and faction, unless
+    ignoreUnits is set) to decide which steps are allowed.
+
+    @param maxCost: stop after this many steps; None searches the whole
+    map.
+    @return: a SearchResult.
+    """
+    grid = map_.grid
+    (sx, sy) = start
+    if maxCost is None:
+        (x0, y0, x1, y1) = (0, 0, grid.width, grid.height)
+    else:
+        maxCost = max(0, maxCost)
+        x0 = max(0, sx - maxCost)
+        y0 = max(0, sy - maxCost)
+        x1 = min(grid.width, sx + maxCost + 1)
+        y1 = min(grid.height, sy + maxCost + 1)
+
+    blocked = None
+    if not ignoreUnits:
+        faction = unit.faction()
+        for ((x, y), occupant) in grid.occupants():
+            if (x0 <= x < x1 and y0 <= y < y1 and occupant.alive() and
+                not Faction.friendly(faction, occupant.faction())):
+                if blocked is None:
+                    blocked = numpy.zeros((x1 - x0, y1 - y0), dtype=bool)
+                blocked[x - x0, y - y0] = True
+
+    # Terrain connectivity is cached by the grid; only the units blocking
+    # the way are worked out per search.
+    steps = []
+    for ((src, dst), allowed) in zip(STEP_SLICES, grid.steps(unit.jump())):
+        allowed = allowed[x0:x1, y0:y1][src]
+        if blocked is not None:
+            allowed = allowed & ~blocked[dst]
+        steps.append((src, dst, allowed))
+
+    shape = (x1 - x0, y1 - y0)
+    index = numpy.arange(shape[0] * shape[1],
+                         dtype=numpy.int32).reshape(shape)
+    dist = numpy.full(shape, UNREACHED, dtype=numpy.int32)
+    prev = numpy.full(shape, UNREACHED, dtype=numpy.int32)
+    frontier = numpy.zeros(shape, dtype=bool)
+    frontier[sx - x0, sy - y0] = True
+    dist[sx - x0, sy - y0] = 0
+
+    cost = 0
+    while maxCost is None or cost < maxCost:
+        found = numpy.zeros(shape, dtype=bool)
+        for (src, dst, allowed) in steps:
+            new = (frontier[src] & allowed & (dist[dst] == UNREACHED) &
+                   ~found[dst])
+            if new.any():
+                found[dst] |= new
+                prev[dst][new] = index[src][new]
+        if not found.any():
+            break
+        cost += 1
+        dist[found] = cost
+        frontier = found
+
+    return SearchResult(map_, start, (x0, y0), dist, prev)
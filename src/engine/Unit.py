@@ -22,9 +22,9 @@ import resources as Resources
 from engine import Equipment
 from engine import Effect
 import logging
-from gui import ScenarioGUI
 import constants as Constants
 import random
+import functools
 from twisted.spread import pb
 
 logger = logging.getLogger("batt")
@@ -45,12 +45,69 @@ def genderAsString(gender):
         return "female"
     return "male"
 
+# Unit attributes that change during a battle, besides status effects
+# and defenders (see Unit.battleState).
+BATTLE_FIELDS = ('_x', '_y', '_z', '_hp', '_sp', '_ct',
+                 '_hasMove', '_hasCancel', '_hasAct', '_alive', '_facing')
+
+def stateDelta(old, new):
+    """@return: the entries of the state dict new that differ from old."""
+    return dict((k, v) for (k, v) in new.items()
+                if k not in old or old[k] != v)
+
+def derivedStat(calc):
+    """Decorator for the Unit stat getters that combine base stats, class,
+    equipment and status effects. The result is cached on the unit until
+    Unit.invalidateStats() is called or its status effects change. The
+    undecorated getter is kept as .uncached."""
+    name = calc.__name__
+    @functools.wraps(calc)
+    def getter(self):
+        stats = self._derivedStats()
+        result = stats.get(name)
+        if result == None:
+            result = calc(self)
+            stats[name] = result
+        return result
+    getter.uncached = calc
+    return getter
+
 class Unit(pb.Copyable, pb.RemoteCopy):
     nextID = 0
 
     def update(self, newUnit):
         self.__dict__.update(newUnit.__dict__)
 
+    def battleState(self):
+        """@return: a dict of plain values holding everything about the
+        unit that can change during a battle. Other units are referred
+        to by ID."""
+        state = dict((f, self.__dict__[f]) for f in BATTLE_FIELDS)
+        se = self._statusEffects
+        state['_statusEffects'] = (tuple(se._effects),
+                                   tuple(se._colorStatus),
+                                   tuple(se._textureStatus))
+        state['_defenders'] = tuple(u.unitID for u in self._defenders)
+        state['_defending'] = tuple(u.unitID for u in self._defending)
+        return state
+
+    def setBattleState(self, state, unitFromID):
+        """Apply a (possibly partial) battleState() dict. unitFromID maps
+        unit IDs back to units."""
+        for (k, v) in state.items():
+            if k == '_statusEffects':
+                (effects, color, texture) = v
+                self._statusEffects._effects = list(effects)
+                self._statusEffects._colorStatus = list(color)
+                self._statusEffects._textureStatus = list(texture)
+                self._statusEffects.changed()
+            elif k in ('_defenders', '_defending'):
+                self.__dict__[k] = [unitFromID(i) for i in v]
+            elif k == '_alive':
+                self.setAlive(v)
+            elif k in BATTLE_FIELDS:
+                self.__dict__[k] = v
+
     def __init__(self, gender):
         self.unitID = Unit.nextID
         Unit.nextID += 1
@@ -96,6 +153,8 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         self._facing = Constants.N
         self._defenders = []
         self._defending = []
+        # The Faction.Census of the battle the unit is in, if any
+        self._census = None
         
         # List of sprites
         self._spriteRoot = None # Set by Resources (FIXME)
@@ -107,6 +166,26 @@ class Unit(pb.Copyable, pb.RemoteCopy):
 
         self._statusEffects = StatusEffects()
 
+        # Cache for the derivedStat getters, valid while the status
+        # effects are at _statsVersion
+        self._stats = {}
+        self._statsVersion = self._statusEffects.version
+
+    def invalidateStats(self):
+        """Throw away the cached derived stats. Call this after changing
+        base stats, class or equipment. Status effect changes are noticed
+        on their own."""
+        self._stats = {}
+
+    def _derivedStats(self):
+        version = self._statusEffects.version
+        if self._statsVersion != version:
+            # A new dict rather than clear(): copy.copy()'d units share
+            # the old one
+            self._stats = {}
+            self._statsVersion = version
+        return self._stats
+
     def setMoveActCancel(self, move, act, cancel):
         self._hasMove = move
         self._hasAct = act
@@ -179,7 +258,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
             return []
 
     def battleInit(self):
-        self._alive = True
+        self.setAlive(True)
         self._hp = self.mhp()
         self._sp = self.msp()
         self._ct = 0
@@ -238,6 +317,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
     def equipment(self):
         return [self._weapon, self._armor]
 
+    @derivedStat
     def mhp(self):
         result = int(self._mhp * self._class.mhpMult)
         for eq in self.equipment():
@@ -245,6 +325,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
                 result += eq.mhp()
         return result
 
+    @derivedStat
     def msp(self):
         result = int(self._msp * self._class.mspMult)
         for eq in self.equipment():
@@ -252,6 +333,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
                 result += eq.msp()
         return result
     
+    @derivedStat
     def watk(self):
         result = int(self._watk * self._class.watkMult)
         for eq in self.equipment():
@@ -264,6 +346,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         result = int(result)
         return result
 
+    @derivedStat
     def wdef(self):
         result = int(self._wdef * self._class.wdefMult)
         for eq in self.equipment():
@@ -278,6 +361,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         result = int(result)
         return result
 
+    @derivedStat
     def matk(self):
         result = int(self._matk * self._class.matkMult)
         for eq in self.equipment():
@@ -290,6 +374,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         result = int(result)
         return result
 
+    @derivedStat
     def mdef(self):
         result = int(self._mdef * self._class.mdefMult)
         for eq in self.equipment():
@@ -302,6 +387,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         result = int(result)
         return result
 
+    @derivedStat
     def speed(self):
         result = int(self._speed * self._class.speedMult)
         for eq in self.equipment():
@@ -314,6 +400,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         result = int(result)
         return max(1, result)
 
+    @derivedStat
     def move(self):
         result = self._class.move
         for eq in self.equipment():
@@ -324,6 +411,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         result = int(result)
         return result
 
+    @derivedStat
     def jump(self):
         result = self._class.jump
         for eq in self.equipment():
@@ -345,6 +433,9 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         return self._faction
 
     def setFaction(self, faction):
+        if self._census != None and self._alive:
+            self._census.changed(self._faction, -1)
+            self._census.changed(faction, 1)
         self._faction = faction
 
     def setCT(self, ct):
@@ -372,7 +463,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         self._hp = min(self._hp, self.mhp())
         if self._hp <= 0:
             self._hp = 0
-            self._alive = False
+            self.setAlive(False)
 
     def damageSP(self, amount):
         self._sp -= amount
@@ -388,6 +479,18 @@ class Unit(pb.Copyable, pb.RemoteCopy):
     def active(self):
         return self._alive
 
+    def setAlive(self, alive):
+        if alive != self._alive and self._census != None:
+            self._census.changed(self._faction, 1 if alive else -1)
+        self._alive = alive
+
+    def setCensus(self, census):
+        """Count the unit in census from now on, instead of wherever it
+        was counted before."""
+        if self._census != None and self._alive:
+            self._census.changed(self._faction, -1)
+        self._census = census
+
     def getAI(self):
         return self._ai
 
@@ -408,6 +511,7 @@ class Unit(pb.Copyable, pb.RemoteCopy):
             self._classLevels[className] = 0
         self._classLevels[className] += 1
         self._level += 1
+        self.invalidateStats()
 
     def classLevel(self, className):
         if className not in self._classLevels:
@@ -427,12 +531,14 @@ class Unit(pb.Copyable, pb.RemoteCopy):
 
     def equipWeapon(self, weapon):
         self._weapon = weapon
+        self.invalidateStats()
 
     def weapon(self):
         return self._weapon
 
     def equipArmor(self, armor):
         self._armor = armor
+        self.invalidateStats()
 
     def armor(self):
         return self._armor
@@ -483,17 +589,32 @@ class Unit(pb.Copyable, pb.RemoteCopy):
         return statusEffectMult
 
 class StatusEffects(pb.Copyable, pb.RemoteCopy):
+    # Source of version numbers, shared by every StatusEffects so that a
+    # unit's stat cache can't mistake one object's version for another's
+    _clock = 0
+
     def __init__(self):
         self._effects = [
             None for i in range(0, Effect.Status.NUM_TYPES)]
         self._colorStatus = []
         self._textureStatus = []
+        self.version = 0
+        self.changed()
+
+    def changed(self):
+        """Start a new version. Call after changing the effects from
+        outside this class."""
+        # Copies from another process bring their own version along; never
+        # go back below it.
+        StatusEffects._clock = max(StatusEffects._clock, self.version) + 1
+        self.version = StatusEffects._clock
         
     def clear(self):
         self._effects = [
             None for i in range(0, Effect.Status.NUM_TYPES)]
         self._colorStatus = []
         self._textureStatus = []
+        self.changed()
 
     def has(self, effectType):
         return self._effects[effectType] != None
@@ -514,6 +635,7 @@ class StatusEffects(pb.Copyable, pb.RemoteCopy):
             self._colorStatus.append(effectType)
         else:
             self._textureStatus.append(effectType)
+        self.changed()
 
     def update(self):
         # Decrement status-effect counters
@@ -535,6 +657,7 @@ class StatusEffects(pb.Copyable, pb.RemoteCopy):
             else:
                 newE = (duration, power)
             self._effects[i] = newE
+        self.changed()
 
     def color(self):
         return self._colorStatus
@@ -1,4 +1,6 @@
 from twisted.spread import pb
+from twisted.spread import banana
+from twisted.spread import jelly
 from engine import Light
 from engine import Map
 from engine import Unit
@@ -10,6 +12,7 @@ from engine import Effect
 from engine import Light
 from engine import Equipment
 from engine import Battle
+from engine import Faction
 
 pb.setUnjellyableForClass(Light.Light, Light.Light)
 pb.setUnjellyableForClass(Map.MapSquare, Map.MapSquare)
@@ -40,6 +43,7 @@ pb.setUnjellyableForClass(Equipment.Armor, Equipment.Armor)
 pb.setUnjellyableForClass(Battle.Battle, Battle.Battle)
 pb.setUnjellyableForClass(Battle.DefeatAllEnemies, Battle.DefeatAllEnemies)
 pb.setUnjellyableForClass(Battle.PlayerDefeated, Battle.PlayerDefeated)
+pb.setUnjellyableForClass(Faction.Census, Faction.Census)
 pb.setUnjellyableForClass(Effect.MissResult, Effect.MissResult)
 pb.setUnjellyableForClass(Effect.DamageResult, Effect.DamageResult)
 pb.setUnjellyableForClass(Effect.DamageSPResult, Effect.DamageSPResult)
@@ -47,3 +51,24 @@ pb.setUnjellyableForClass(Effect.HealResult, Effect.HealResult)
 pb.setUnjellyableForClass(Effect.StatusResult, Effect.StatusResult)
 
 
+# Messages sent the same to many clients
+
+class _AnyClient(object):
+    """Stands in for the Broker jelly normally copies pb.Copyables for, so
+    that they are copied for no client in particular."""
+    serializingPerspective = None
+
+def encodeMessage(methodName, *args):
+    """Encode a call of remote_<methodName>(*args) once, as bytes that any
+    number of clients can be sent (see GameSession.broadcast)."""
+    sexp = jelly.jelly([methodName, list(args)], jelly.globalSecurity,
+                       invoker=_AnyClient())
+    return banana.encode(sexp)
+
+def decodeMessage(data):
+    """@return: (methodName, args) from encodeMessage. Both ends use
+    PB's own security options, so only the classes registered above get
+    through, as in any other PB message."""
+    (methodName, args) = jelly.unjelly(banana.decode(data),
+                                       taster=jelly.globalSecurity)
+    return (methodName, args)
@@ -40,6 +40,7 @@ import sound as Sound
 from engine import Class as Class
 from engine import Ability
 from engine import Effect
+from engine import Display
 from engine import Unit as Unit
 from gui import Input as Input
 from engine import Faction
@@ -54,6 +55,7 @@ class ScenarioGUI(MainWindow.MainWindowDelegate):
     def __init__(self, client, scenario, faction):
         global _gui
         _gui = self
+        Display.setDamageDisplay(self.displayDamage)
 
         self.scenario = scenario
         self.client = client
@@ -228,8 +230,8 @@ class ScenarioGUI(MainWindow.MainWindowDelegate):
 
         # FIXME: variable names suck
         self._unitMoving = u
-        self.m.reachable(u)
-        self.unitTarget = self.m.shortestPath(x, y)
+        search = self.m.search(u, u.posn(), u.move())
+        self.unitTarget = self.m.shortestPath(x, y, search)
         self.originalUnitPosn = u.posn()
         self.lastUnitMove = 0.0
         self.nextUnitMovePosn = self.unitTarget.pop()
@@ -662,6 +664,11 @@ class ScenarioGUI(MainWindow.MainWindowDelegate):
     def unitDisplayer(self, unit):
         return self.unitDisplayersDict[unit]
 
+    def displayDamage(self, unit, amount, kind, delay):
+        ud = self.unitDisplayersDict.get(unit)
+        if ud != None:
+            ud.addAnimation(Sprite.DamageDisplayer(amount, kind, delay))
+
     def handleEvent(self, event):
         if self.textEntry.enabled and event.type == pygame.KEYDOWN:
             self.textEntry.addEvent(event)
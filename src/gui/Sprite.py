@@ -24,6 +24,7 @@ import constants as Constants
 import resources as Resources
 from engine import Effect
 from engine import Faction as Faction
+from engine.Display import BENEFICIAL, NEUTRAL, NEGATIVE
 from gui import Input
 import pygame
 from OpenGL.GL import *
@@ -892,9 +893,6 @@ class Animation(Sprite):
 RED = (255, 0, 0) # FIXME: rm 0-255 color tuple
 GREEN = (128, 255, 128)
 WHITE = (255, 255, 255)
-BENEFICIAL = 0
-NEUTRAL = 1
-NEGATIVE = 2
 
 class DamageDisplayer(Animation):
     def __init__(self, damageAmount, beneficial=NEUTRAL, delay=0.0):
@@ -0,0 +1,3 @@
+# The GUI modules import each other in a cycle that only resolves when
+# GLUtil is loaded first, so load it whichever gui module is asked for.
+from gui import GLUtil
@@ -0,0 +1,210 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+Load test for the game server (galaxywizard-loadtest).
+
+Starts N headless AI clients spread over M sessions against a server on
+this machine, lets them play for a while and reports:
+- throughput: unitMove/unitAct/unitFacing commands and unit turns per
+  second
+- p50/p99 command round trip, from the client calling the command to its
+  result coming back
+- server CPU time per unit turn, from the sessions' own accounting (see
+  GameState.usage)
+
+The clients use UnitAI.Scripted, which thinks in milliseconds, so the time
+goes on the server and the network rather than the AI. Unless --external
+is given the server runs in this process too; the CPU it reports is still
+its own (TimeAccount only charges server code), but the round trips then
+include the clients' share of the reactor.
+"""
+
+import logging
+import optparse
+import time
+
+from twisted.internet import reactor, defer, task
+
+import ai.UnitAI
+import resources
+import util
+from client import AIClient
+from server import Access, GameServer
+from translate import Translate
+
+loadLog = logging.getLogger('load')
+
+# The commands whose round trips are timed
+COMMANDS = ('unitMove', 'unitAct', 'unitFacing')
+
+
+class LoadStats(object):
+    """What the load clients measured, and the last stats each session's
+    creator got from the server."""
+    def __init__(self):
+        self.latency = util.LatencyHistogram()
+        self.commandLatency = dict((c, util.LatencyHistogram())
+                                   for c in COMMANDS)
+        self.sessions = {}
+        self.started = time.perf_counter()
+        self.stopped = None
+
+    def record(self, command, seconds):
+        self.latency.record(seconds)
+        self.commandLatency[command].record(seconds)
+
+    def stop(self):
+        self.stopped = time.perf_counter()
+
+    def elapsed(self):
+        end = self.stopped if self.stopped != None else time.perf_counter()
+        return end - self.started
+
+    def turns(self):
+        return sum(s['turns'] for s in self.sessions.values())
+
+    def serverCPU(self):
+        return sum(s['usage']['cpu'] for s in self.sessions.values())
+
+    def report(self):
+        elapsed = self.elapsed()
+        turns = self.turns()
+        lines = ["%d sessions, %.1fs" % (len(self.sessions), elapsed),
+                 "throughput: %.1f commands/s, %.1f turns/s" %
+                 (self.latency.count / elapsed, turns / elapsed),
+                 "round trip: p50<=%.1fms p99<=%.1fms (%s)" %
+                 (self.latency.percentile(50) * 1000,
+                  self.latency.percentile(99) * 1000, self.latency)]
+        for command in COMMANDS:
+            lines.append("  %-10s %s" % (command,
+                                         self.commandLatency[command]))
+        if turns:
+            lines.append("server CPU: %.2fms per turn (%d turns)" %
+                         (self.serverCPU() / turns * 1000, turns))
+        else:
+            lines.append("server CPU: no turns played")
+        return "\n".join(lines)
+
+
+class LoadClient(AIClient):
+    """An AIClient that times its commands. The first client in a session
+    chooses the scenario and keeps the session's stats up to date."""
+
+    unitAI = ai.UnitAI.Scripted
+
+    def __init__(self, server, serverPort, session, stats, scenario):
+        self.stats = stats
+        self.scenarioName = scenario
+        self.poller = None
+        AIClient.__init__(self, server, serverPort, session, useWorker=False,
+                          username="Load")
+
+    def chooseScenario(self):
+        if self.accessLevel == Access.CREATOR:
+            return self.remote('setScenario', *self.scenarioName)
+        return None
+
+    def gotInfo(self, info):
+        AIClient.gotInfo(self, info)
+        if self.accessLevel == Access.CREATOR:
+            self.poller = task.LoopingCall(self.pollStats)
+            self.poller.start(1.0)
+
+    def pollStats(self):
+        df = self.remote('sessionStats')
+        df.addCallback(self.gotStats)
+        return df
+
+    def gotStats(self, stats):
+        if stats:
+            self.stats.sessions[stats['session']] = stats
+
+    def remote(self, methodName, *args):
+        if methodName not in COMMANDS:
+            return AIClient.remote(self, methodName, *args)
+        start = time.perf_counter()
+        df = AIClient.remote(self, methodName, *args)
+        def returned(result):
+            self.stats.record(methodName, time.perf_counter() - start)
+            return result
+        df.addBoth(returned)
+        return df
+
+
+def startLoad(host, port, clients, sessions, scenario, stats):
+    """Connect LoadClients to the server, spread round robin over
+    the sessions.
+
+    @return: the clients."""
+    return [LoadClient(host, port, "load-%d" % (i % sessions), stats,
+                       scenario)
+            for i in range(clients)]
+
+
+def run(args=None):
+    """Load test a server (galaxywizard-loadtest)."""
+    parser = optparse.OptionParser(description="Load test a GalaxyWizard "
+                                   "server with headless AI clients.")
+    parser.add_option("--clients", "-n", type=int, default=8,
+                      help="number of clients (default: %default)")
+    parser.add_option("--sessions", "-m", type=int, default=4,
+                      help="number of sessions to spread them over "
+                      "(default: %default)")
+    parser.add_option("--duration", "-d", type=float, default=30.0,
+                      help="seconds to run for (default: %default)")
+    parser.add_option("--host", default="localhost")
+    parser.add_option("--port", "-P", type=int, default=22299)
+    parser.add_option("--external", action="store_true", default=False,
+                      help="use a server that is already running instead "
+                      "of starting one")
+    parser.add_option("--campaign", default=None,
+                      help="(default: %s)" % resources.campaign)
+    parser.add_option("--scenario", default="castle",
+                      help="(default: %default)")
+    parser.add_option("--verbose", "-v", action="count", default=0)
+    (options, args) = parser.parse_args(args)
+    if options.clients < 1 or options.sessions < 1:
+        parser.error("need at least one client and one session")
+
+    logging.basicConfig(level=logging.WARNING - options.verbose * 10)
+    # Ability and unit files mark their text for translation
+    Translate().setLanguage()
+
+    if not options.external:
+        GameServer(options.port)
+    stats = LoadStats()
+    scenario = (options.campaign or resources.campaign, options.scenario)
+    clients = startLoad(options.host, options.port, options.clients,
+                        options.sessions, scenario, stats)
+
+    def finish():
+        stats.stop()
+        # Get the sessions' final stats before stopping
+        polls = [c.pollStats() for c in clients if c.poller != None]
+        df = defer.DeferredList(polls)
+        df.addBoth(lambda result: reactor.stop())
+    reactor.callLater(options.duration, finish)
+    reactor.run()
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    run()
@@ -1,7 +1,7 @@
 import os
 import logging
 import optparse
-import pygame
+import multiprocessing
 from translate import Translate
 import numpy as np
 
@@ -23,6 +23,15 @@ def main():
     parser.add_option("--port", "-P", type=int, default=22222)
     parser.add_option("--lang", "-l", default="en")
     parser.add_option("--user", default=os.environ.get('USER', 'Player'))
+    parser.add_option("--ai-budget", type=float, default=None, metavar="SECONDS",
+                      help="time limit for each computer-controlled turn")
+    parser.add_option("--no-ai-process", dest="ai_process", action="store_false",
+                      default=True,
+                      help="run the AI in a thread instead of a worker process")
+    parser.add_option("--map-cache", metavar="DIR",
+                      default=os.path.join(os.path.expanduser('~'),
+                                           '.galaxywizard', 'maps'),
+                      help="where to keep maps received from servers")
     (options, args) = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG - options.verbose * 10)
@@ -30,6 +39,7 @@ def main():
     translate_config.setLanguage(options.lang)
 
     # init pygame config
+    import pygame
     pygame.display.init()
     pygame.font.init()
     pygame.joystick.init()
@@ -53,4 +63,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # The AI worker process is started with multiprocessing
+    multiprocessing.freeze_support()
     main()
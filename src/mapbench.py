@@ -0,0 +1,203 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+Map parser benchmark.
+
+Times how long it takes to turn map text into what the Map constructor
+takes (heights and per-tile properties), with engine.MapParser and with
+the line-by-line regular expression parser MapIO.loadString used before
+it, on the shipped maps and on synthetic maps of a given size. The full
+MapIO.loadString time, building the squares included, is shown for
+scale.
+
+The old parser splits tiles on two or more spaces, so it misreads the
+shipped maps whose tiles are one space apart; its times on those are
+still shown, for what they are worth.
+"""
+
+import glob
+import optparse
+import os
+import random
+import re
+import time
+
+import numpy
+
+from engine import Map, MapParser
+
+
+def legacyParse(mapname, text):
+    """The parser MapIO.loadString used before engine.MapParser.
+
+    @return: (map data, heights, per-tile properties)."""
+    import ast
+    mapData = {}
+    try:
+        current_var = None
+        current_value = []
+        in_multiline = False
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if "'''" in line:
+                if not in_multiline:
+                    var_name = line.split('=')[0].strip()
+                    in_multiline = True
+                    current_var = var_name
+                    current_value = []
+                    if line.count("'''") == 2:
+                        mapData[var_name] = line.split("'''")[1]
+                        in_multiline = False
+                        current_var = None
+                else:
+                    mapData[current_var] = '\n'.join(current_value)
+                    in_multiline = False
+                    current_var = None
+                    current_value = []
+                continue
+            if in_multiline:
+                current_value.append(line)
+                continue
+            if '=' in line:
+                var_name, value = line.split('=', 1)
+                mapData[var_name.strip()] = ast.literal_eval(value.strip())
+    except Exception:
+        localVars = {}
+        eval(compile(text, mapname, 'exec'), {}, localVars)
+        mapData = localVars
+    (width, height) = (mapData['WIDTH'], mapData['HEIGHT'])
+    layoutLines = mapData['LAYOUT'].split('\n')
+    layoutLines.pop(0)
+    zdata = numpy.zeros((width, height))
+    tileProperties = numpy.zeros((width, height), dtype=object)
+    y = 0
+    for line in layoutLines:
+        if re.match(re.compile(r'^\s*$'), line):
+            continue
+        tiles = re.split(r'\s{2,}', line.strip())
+        tiles = [t for t in tiles if t.strip()]
+        if len(tiles) < width:
+            tiles.extend(['0'] * (width - len(tiles)))
+        for x in range(0, width):
+            tileData = tiles[x] if x < len(tiles) else '0'
+            tileProperties[x,y] = {}
+            m = re.match(re.compile(
+                r'(\d+)(\[(-?[\d.]+),\s*(-?[\d.]+),\s*(-?[\d.]+),\s*(-?[\d.]+)\])?(wh(\d+))?(\w*)'), tileData)
+            zdata[x,y] = int(m.group(1))
+            tileProperties[x,y]['tag'] = m.group(9) if m.group(9) else ''
+            if m.group(2) != None:
+                tileProperties[x,y]['cornerHeights'] = [
+                    int(float(m.group(i))) for i in range(3, 7)]
+            if m.group(7) != None:
+                tileProperties[x,y]['waterHeight'] = int(m.group(8))
+        y += 1
+    return (mapData, zdata, tileProperties)
+
+
+def parse(mapname, text):
+    """engine.MapParser's equivalent of legacyParse."""
+    mapData = MapParser.parseAssignments(mapname, text)
+    layout = MapParser.parseLayout(mapData['LAYOUT'], mapData['WIDTH'],
+                                   mapData['HEIGHT'])
+    return (mapData, layout.z, layout.tileProperties())
+
+
+def syntheticMap(width, height, seed=0):
+    """@return: the text of a random width x height map, laid out the way
+    Map.loadString writes maps (tiles padded to 30 characters), with a
+    few tags, corner heights and water heights."""
+    rng = random.Random(seed)
+    lines = ["VERSION = 1", "WIDTH = %d" % width, "HEIGHT = %d" % height,
+             "WATER_HEIGHT = 2",
+             "TILE_PROPERTIES = {",
+             "    'g': {'color': (0.5, 0.75, 0.5), 'colorVar': (0.1, 0.1, 0.1)},",
+             "    's': {'color': (0.6, 0.6, 0.6), 'smooth': True},",
+             "    '': {'color': (0.5, 0.7, 0.5)},",
+             "}", "LAYOUT = '''"]
+    for y in range(height):
+        row = []
+        for x in range(width):
+            tile = "%d" % rng.randint(0, 30)
+            if rng.random() < 0.1:
+                tile += repr([rng.randint(-2, 2) for i in range(4)])
+            if rng.random() < 0.05:
+                tile += "wh%d" % rng.randint(1, 5)
+            tile += rng.choice(['', 'g', 's'])
+            row.append("%-30s" % tile)
+        lines.append(''.join(row))
+    lines.append("'''")
+    return '\n'.join(lines) + '\n'
+
+
+def timeIt(function, *args, repeat=5):
+    """@return: the best of repeat runs, in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(args=None):
+    """Benchmark the map parsers."""
+    parser = optparse.OptionParser(description="Time the GalaxyWizard map "
+                                   "parser against the one it replaced.")
+    parser.add_option("--maps", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "data", "*", "maps",
+        "*.py"), help="glob of map files (default: the shipped maps)")
+    parser.add_option("--size", type=int, action="append", default=[],
+                      help="also time a synthetic SIZE x SIZE map; may be "
+                      "given more than once (default: 64 and 256)")
+    parser.add_option("--repeat", "-r", type=int, default=5,
+                      help="runs to take the best of (default: %default)")
+    (options, args) = parser.parse_args(args)
+
+    maps = [(os.path.basename(f), open(f).read())
+            for f in sorted(glob.glob(options.maps))]
+    for size in options.size or [64, 256]:
+        maps.append(("synthetic %dx%d" % (size, size),
+                     syntheticMap(size, size)))
+
+    print("%-26s %10s %10s %8s %10s" % ("map", "old (ms)", "new (ms)",
+                                         "speedup", "load (ms)"))
+    for (name, text) in maps:
+        try:
+            old = timeIt(legacyParse, name, text, repeat=options.repeat)
+        except Exception as e:
+            print("%-26s old parser failed: %s" % (name, e))
+            old = None
+        new = timeIt(parse, name, text, repeat=options.repeat)
+        load = timeIt(Map.MapIO.loadString, name, text, repeat=1)
+        if old is None:
+            print("%-26s %10s %10.2f %8s %10.1f" % (name, "-", new * 1000,
+                                                     "-", load * 1000))
+        else:
+            print("%-26s %10.2f %10.2f %7.1fx %10.1f" %
+                  (name, old * 1000, new * 1000, old / new, load * 1000))
+
+
+if __name__ == "__main__":
+    run()
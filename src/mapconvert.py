@@ -0,0 +1,111 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+Convert map files to the binary map format (galaxywizard-mapconvert).
+
+Each text map file given (data/<campaign>/maps/<name>.py) is loaded and
+saved as <name>.gwmb next to it, or in --output-dir. The binary file is
+then loaded back and checked against the text one: the same squares,
+face colors and all, and the same Map.loadString() text. Once a map
+has a binary file, resources.MapLoader loads that instead, as long as it
+is at least as new as the text file.
+
+Face colors are rolled from the tags' color variance when a text map is
+loaded and then stored in the binary file, so converting the same map
+twice gives files that differ in their colors.
+"""
+
+import glob
+import optparse
+import os
+import sys
+
+from engine.Map import MapIO, MapFile, MapPack
+
+
+def binaryName(filename, outputDir=None):
+    """@return: the binary map file name for text map file filename."""
+    base = os.path.splitext(filename)[0] + MapFile.SUFFIX
+    if outputDir != None:
+        base = os.path.join(outputDir, os.path.basename(base))
+    return base
+
+
+def sameMap(a, b):
+    """@return: whether maps a and b have the same squares and save to the
+    same text."""
+    if MapPack.pack(a)[0] != MapPack.pack(b)[0]:
+        return False
+    for (columnA, columnB) in zip(a.squares, b.squares):
+        for (sa, sb) in zip(columnA, columnB):
+            if sa.color != sb.color or sa.cornerColors != sb.cornerColors:
+                return False
+    return a.loadString() == b.loadString()
+
+
+def convert(filename, outputDir=None):
+    """Convert one text map file.
+
+    @return: the binary file name.
+    @raise ValueError: if the binary file doesn't load back the same."""
+    m = MapIO.load(filename)
+    output = binaryName(filename, outputDir)
+    MapFile.save(m, output)
+    if not sameMap(m, MapFile.load(output)):
+        os.remove(output)
+        raise ValueError(f"{output} doesn't load back the same as "
+                         f"{filename}")
+    return output
+
+
+def run(args=None):
+    """Convert map files (galaxywizard-mapconvert)."""
+    parser = optparse.OptionParser(
+        usage="%prog [options] MAP.py...",
+        description="Convert GalaxyWizard map files to binary map files "
+        "that load without parsing.")
+    parser.add_option("--output-dir", "-o", default=None,
+                      help="where to write the binary files (default: "
+                      "next to each map file)")
+    parser.add_option("--all", action="store_true", default=False,
+                      help="convert every map under data/*/maps")
+    (options, args) = parser.parse_args(args)
+    files = list(args)
+    if options.all:
+        files += sorted(glob.glob(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "data", "*", "maps",
+            "*.py")))
+    if not files:
+        parser.error("no map files given")
+
+    failed = False
+    for filename in files:
+        try:
+            print("%s -> %s" % (filename, convert(filename,
+                                                  options.output_dir)))
+        except (OSError, ValueError) as e:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
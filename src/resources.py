@@ -1,8 +1,6 @@
 import logging
-import pygame
 import os
 import sys
-from gui import GLUtil
 import re
 import random
 
@@ -85,6 +83,7 @@ class FontLoader(object):
             fontFile = _getFilename("fonts", filename)
             if fontFile == None:
                 raise Exception('Font file "%s" not found' % filename)
+            import pygame
             f = pygame.font.Font(fontFile, size)
             self.fonts[key] = f
         return self.fonts[key]
@@ -96,12 +95,30 @@ class MapLoader(object):
         if mapName == 'random':
             import engine.MapGenerator as MapGenerator
             return MapGenerator.generateRandom()
+        m = None
         if (not '/' in mapName) and (not '.' in mapName):
             filename = mapName + ".py"
+            binary = _getFilename("maps", mapName + Map.MapFile.SUFFIX)
             mapName = _getFilename("maps", filename)
-        if mapName == None:
-            raise Exception('Map file "%s" not found' % filename)
-        return Map.MapIO.load(mapName)
+            # Prefer the binary map file (see mapconvert), unless the text
+            # one has been edited since it was converted
+            if binary != None and (mapName == None or
+                                   os.path.getmtime(binary) >=
+                                   os.path.getmtime(mapName)):
+                try:
+                    m = Map.MapFile.load(binary)
+                except (OSError, ValueError) as e:
+                    if mapName == None:
+                        raise
+                    logger.warning(f"Couldn't load {binary}, using "
+                                   f"the text map instead: {e}")
+        if m == None:
+            if mapName == None:
+                raise Exception('Map file "%s" not found' % filename)
+            m = Map.MapIO.load(mapName)
+        # A client in this process won't need the map sent to it
+        Map.mapCache.add(m)
+        return m
 
 
 class ImageLoader(object):
@@ -110,6 +127,7 @@ class ImageLoader(object):
 
     def __call__(self, imageName, dirName="images"):
         if imageName not in self.cache:
+            import pygame
             filename = imageName + ".png"
             fileName = _getFilename(dirName, filename)
             if fileName == None:
@@ -133,6 +151,8 @@ class TextureLoader(object):
 
     def __call__(self, textureName):
         if textureName not in self.cache:
+            import pygame
+            from gui import GLUtil
             i = image(textureName, "textures")
             i = pygame.transform.scale(i, (self._textureSize,
                                            self._textureSize))
@@ -461,6 +481,7 @@ class MusicLoader(object):
         musicFile = _getFilename("music", musicName + ".ogg")
         if musicFile == None:
             return
+        import pygame
         try:
             pygame.mixer.music.load(musicFile)
             pygame.mixer.music.set_volume(0.4)
@@ -494,6 +515,7 @@ class SoundLoader(object):
             soundFile = _getFilename("sounds", soundName + ".ogg")
             if soundFile == None:
                 soundFile = _getFilename("sounds", soundName + ".wav")
+            import pygame
             try:
                 s = pygame.mixer.Sound(soundFile)
             except pygame.error as e:
@@ -0,0 +1,773 @@
+# Copyright (C) 2005 Jeremy Jeanne <jyjeanne@gmail.com>
+#
+# This file is part of GalaxyWizard.
+#
+# GalaxyWizard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# GalaxyWizard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GalaxyWizard; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+The game server, without any of the client or GUI code.
+
+GameServer accepts clients over Perspective Broker and GameState runs the
+battle they play, so the server only needs the engine. Nothing here (or
+in the engine) imports pygame or OpenGL: a server can run on a machine
+with no display at all, either inside the game (see twistedmain) or on
+its own as galaxywizard-server.
+
+One server hosts any number of matches at once, each in its own
+GameSession with its own clients, factions, GameState and Battle. A
+client picks its session when it logs in, by giving its name as
+"name@session" (see loginName); a plain name joins the oldest session
+still waiting for players, or starts a new one.
+"""
+
+from twisted.internet import reactor, defer
+from twisted.spread import pb
+from twisted.cred import checkers, portal, credentials
+from zope.interface import implementer
+
+import functools
+import logging
+import optparse
+import time
+import resources
+import main
+import util
+from translate import Translate
+
+serverLog = logging.getLogger('gsrv')
+
+import engine.netsupport
+import engine.Ability
+from engine import Unit
+
+
+# Separates the player's name from the session they want to join in the
+# name a client logs in with
+SESSION_SEPARATOR = '@'
+
+def loginName(name, sessionID=None):
+    """@return: the name to log in with to join sessionID (None: any
+    session that is waiting for players)."""
+    if sessionID is None:
+        return name
+    return '%s%s%s' % (name, SESSION_SEPARATOR, sessionID)
+
+def splitLoginName(login):
+    """@return: (name, session ID or None) from a loginName."""
+    (name, sep, sessionID) = login.partition(SESSION_SEPARATOR)
+    if not sep or not sessionID:
+        return (name, None)
+    return (name, sessionID)
+
+# Each Avatar can call some methods on the server. A GameCreator can
+# call all methods, a GamePlayer can call most methods (everything
+# needed to actually play in a game), and a GameObserver has the least
+# access (they can only watch.)
+class Access(object):
+    CREATOR = "Creator"
+    PLAYER = "Player"
+    OBSERVER = "Observer"
+
+class GameObserver(pb.Avatar):
+    def __init__(self, server, session, clientRef, name):
+        self.clientRef = clientRef
+        self.accessLevel = Access.OBSERVER
+        self.server = server
+        self.session = session
+        self.gameState = session.state
+        self.name = name
+        self.faction = None
+        # Content hashes of the maps the client has (see Map.MapCache)
+        self.mapHashes = set()
+
+    def perspective_info(self, version):
+        if main.__version__ != version:
+            err = ("Your version of GalaxyWizard (%s) does not match the server's (%s)." %
+                   (version, main.__version__))
+            raise Exception(err)
+        return (self.name, self.accessLevel, self.faction,
+                self.session.sessionID)
+
+    def perspective_chat(self, message):
+        self.session.broadcast('chat', self.name, message)
+
+    def perspective_haveMaps(self, hashes):
+        self.mapHashes = set(hashes)
+
+    def perspective_readyForGame(self):
+        self.session.clients[id(self.clientRef)].readyForGame = True
+        self.gameState.update()
+
+    def perspective_readyToDisplay(self):
+        self.session.clients[id(self.clientRef)].readyToDisplay = True
+        self.gameState.update()
+
+    def perspective_commandLatency(self):
+        return self.gameState.commandLatency.snapshot()
+
+    def perspective_sessionStats(self):
+        return self.session.stats()
+
+    def perspective_unitResync(self, unitID):
+        return self.gameState.unitResync(int(unitID))
+
+class GamePlayer(GameObserver):
+    def __init__(self, server, session, clientRef, name):
+        GameObserver.__init__(self, server, session, clientRef, name)
+        self.accessLevel = Access.PLAYER
+
+    def perspective_unitMove(self, x, y):
+        return self.gameState.unitMove(self, int(x), int(y))
+
+    def perspective_unitAct(self, abilityID, x, y):
+        return self.gameState.unitAct(self, int(abilityID), int(x), int(y))
+
+    def perspective_unitFacing(self, facing):
+        return self.gameState.unitFacing(self, int(facing))
+        
+class GameCreator(GamePlayer):
+    def __init__(self, server, session, clientRef, name):
+        GamePlayer.__init__(self, server, session, clientRef, name)
+        self.accessLevel = Access.CREATOR
+            
+    def perspective_setScenario(self, campaign, scenario):
+        serverLog.debug("Set campaign and scenario to %s/%s" %
+                        (campaign, scenario))
+        return self.gameState.setScenario(campaign, scenario)
+
+
+class UnitState(object):
+    def __init__(self, unit, controller):
+        self.unit = unit
+        self.controller = controller
+        self.originalPosn = unit.posn()
+
+    def moveActCancel(self):
+        return self.unit.hasMove(), self.unit.hasAct(), self.unit.hasCancel()
+
+def accounted(method):
+    """Charge the time spent in a GameState method to its game."""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        with self.usage.measure():
+            return method(self, *args)
+    return wrapper
+
+class GameState(object):
+    WAITING_FOR_PLAYERS = 0
+    PLAYING = 1
+    DONE = 2
+    
+    def __init__(self, session):
+        self.session = session
+        self.scenario = None
+        self.campaign = None
+        self.state = GameState.WAITING_FOR_PLAYERS
+        self.unitState = None
+        self.factions = {}
+        # (command name, args, time queued)
+        self.clientCommandQueue = []
+        # Time from a command being queued to it being sent to the clients
+        self.commandLatency = util.LatencyHistogram()
+        # Time spent running this game (see accounted)
+        self.usage = util.TimeAccount()
+        self._updatePending = False
+        self.clock = reactor
+        # What the clients were last sent of each unit's battle state,
+        # and its version (see sendUnitDelta)
+        self.sentUnitStates = {}
+        self.unitVersions = {}
+        
+    def _validate_name(self, name, name_type):
+        """
+        Validate campaign/scenario names to prevent directory traversal attacks.
+
+        Args:
+            name: The name to validate
+            name_type: 'campaign' or 'scenario' (for error messages)
+
+        Returns:
+            The validated name
+
+        Raises:
+            ValueError: If the name contains invalid characters
+        """
+        import re
+
+        if not name:
+            raise ValueError(f"{name_type} name cannot be empty")
+
+        # Check for reserved names first (before regex check)
+        if name in ['.', '..', 'CON', 'PRN', 'AUX', 'NUL']:
+            raise ValueError(f"Reserved {name_type} name '{name}' is not allowed")
+
+        # Only allow alphanumeric characters, hyphens, and underscores
+        # This prevents directory traversal attacks (../, ./, /etc)
+        if not re.match(r'^[a-zA-Z0-9_-]+$', name):
+            raise ValueError(
+                f"Invalid {name_type} name '{name}'. "
+                f"Only alphanumeric characters, hyphens, and underscores are allowed."
+            )
+
+        return name
+
+    @accounted
+    def setScenario(self, campaign, scenario):
+        """
+        Set the current scenario for the game.
+
+        Args:
+            campaign: Campaign name (validated for security)
+            scenario: Scenario name (validated for security)
+
+        Raises:
+            ValueError: If campaign or scenario names contain invalid characters
+        """
+        # Validate input to prevent directory traversal attacks
+        validated_campaign = self._validate_name(campaign, 'campaign')
+        validated_scenario = self._validate_name(scenario, 'scenario')
+
+        # The loaders in resources (classes, abilities, maps...) are global
+        # to the process: switching campaign would switch it under every
+        # other session too, so all sessions have to play the same one
+        server = self.session.server
+        if server != None:
+            inUse = server.campaignsInUse(self.session)
+            if inUse and validated_campaign not in inUse:
+                raise ValueError(
+                    f"Campaign '{validated_campaign}' can't be played while "
+                    f"other sessions are playing '{inUse.pop()}'")
+        if resources.campaign != validated_campaign:
+            resources.setCampaign(validated_campaign)
+        self.scenario = resources.scenario(validated_scenario)
+        self.campaign = validated_campaign
+        self.scenario.numPlayers = 2 # FIXME: should be defined by the scenario
+        self.update()
+
+    def update(self):
+        """Move the game on as far as it can go. Called whenever something
+        happens that might let it (a client getting ready, a command
+        arriving, a client leaving). The work is done on the next reactor
+        iteration, after the current remote call has returned, and calls
+        made before then are merged into one."""
+        if self._updatePending:
+            return
+        self._updatePending = True
+        self.clock.callLater(0, self._runUpdate)
+
+    @accounted
+    def _runUpdate(self):
+        self._updatePending = False
+        self._update()
+
+    def queueCommand(self, commandName, args):
+        self.clientCommandQueue.append((commandName, args, time.monotonic()))
+        self.update()
+
+    def _update(self):
+        # If we've collected enough players, start the game
+        if self.state == GameState.WAITING_FOR_PLAYERS:
+            if not self.scenario:
+                return
+            readyPlayers = 0
+            for c in self.session.players():
+                if c.readyForGame:
+                    readyPlayers += 1
+            if readyPlayers == self.scenario.numPlayers:
+                self.startGame()
+            return
+        # If we need a new unit, pick one
+        if self.state == GameState.PLAYING and self.clientsReadyToDisplay():
+            b = self.scenario.battle()
+            if b.status() != -1:
+                self.clientCommandQueue.append(('battleStatus', (b.status(),),
+                                                time.monotonic()))
+            if b.activeUnit == None:
+                unit = b.pickNextUnit()
+                if unit == None:
+                    # No unit can take a turn, so the battle is over even
+                    # if no faction has won it
+                    if b.status() == -1:
+                        self.clientCommandQueue.append(
+                            ('battleStatus', (None,), time.monotonic()))
+                else:
+                    controller = self.factions[unit.faction()]
+                    self.unitState = UnitState(unit, controller)
+                    self.session.broadcast('unitBeginTurn', unit.unitID)
+                    self.session.remote(controller.ref, 'unitMoveActCancel',
+                                       *self.unitState.moveActCancel())
+            if self.clientCommandQueue:
+                commandName, args, queued = self.clientCommandQueue.pop(0)
+                self.setClientsReadyToDisplay(False)
+                if commandName == 'unitMove':
+                    self.sendUnitMove(*args)
+                elif commandName == 'unitAct':
+                    self.sendUnitAct(*args)
+                elif commandName == 'unitFacing':
+                    self.sendUnitFacing(*args)
+                elif commandName == 'battleStatus':
+                    self.sendBattleStatus(*args)
+                self.commandLatency.record(time.monotonic() - queued)
+                
+    def startGame(self):
+        self.factions = {}
+        self.state = GameState.PLAYING
+        self.session.remoteAll('startGame', self.scenario)
+        self.sentUnitStates = {}
+        self.unitVersions = {}
+        for u in self.scenario.units():
+            self.sentUnitStates[u.unitID] = u.battleState()
+            self.unitVersions[u.unitID] = 0
+        for c in self.session.players():
+            self.factions[c.faction] = c
+        self.setClientsReadyToDisplay(True)
+        self.update()
+
+    def clientsReadyToDisplay(self):
+        for c in list(self.session.clients.values()):
+            if not c.readyToDisplay:
+                return False
+        return True
+
+    def setClientsReadyToDisplay(self, ready):
+        for c in list(self.session.clients.values()):
+            c.readyToDisplay = ready       
+
+    def unitController(self, client):
+        return client.faction == self.unitState.unit.faction()
+
+    @accounted
+    def unitMove(self, client, x, y):
+        if not self.unitController(client):
+            return False
+        result = self.scenario.battle().unitMoved(x, y)
+        if not result:
+            return False
+        self.queueCommand('unitMove', (client, x, y))
+        return True
+
+    def sendBattleStatus(self, winner):
+        for c in list(self.session.clients.values()):
+            if c.faction == winner:
+                self.session.remote(c.ref,
+                                   'serverMessage', 'You win!')
+            else:
+                self.session.remote(c.ref,
+                                   'serverMessage', 'You lose!')
+        self.state = GameState.DONE
+        serverLog.info('Session %s command latency: %s, time used: %s' %
+                       (self.session.sessionID, self.commandLatency,
+                        self.usage))
+        self.clock.callLater(10, self.session.close)
+
+    def sendUnitMove(self, client, x, y):
+        self.session.remote(client, 'unitMoveActCancel',
+                           *self.unitState.moveActCancel())
+        self.session.broadcast('unitMoved', x, y)
+
+    @accounted
+    def unitAct(self, client, abilityID, x, y):
+        if not self.unitController(client):
+            return False
+        ability = engine.Ability.Ability.get.get(abilityID)
+        if ability is None:
+            serverLog.error(f"Ability with ID {abilityID} not found")
+            return False
+        result = self.scenario.battle().unitActed(ability, x, y)
+        if not result:
+            return False
+        affectedUnits, allEffectResults = result
+        self.queueCommand('unitAct',
+                          (client, abilityID, affectedUnits, allEffectResults))
+        return True
+
+    def sendUnitAct(self, client, abilityID, affectedUnits, allEffectResults):
+        # The ability, what it did and the units it changed go out
+        # together, so clients see the whole action at once
+        unitDeltas = []
+        for u in affectedUnits:
+            unitDelta = self.nextUnitDelta(u)
+            if unitDelta != None:
+                unitDeltas.append(unitDelta)
+        self.session.broadcast('actionResolved', abilityID,
+                               allEffectResults, unitDeltas)
+        self.session.remote(client, 'unitMoveActCancel',
+                           *self.unitState.moveActCancel())
+
+    def nextUnitDelta(self, unit):
+        """@return: (unit ID, new version, the battle fields of unit that
+        changed since it was last sent), or None if nothing did. The
+        clients are taken to have been sent it."""
+        state = unit.battleState()
+        delta = Unit.stateDelta(self.sentUnitStates[unit.unitID], state)
+        if not delta:
+            return None
+        self.sentUnitStates[unit.unitID] = state
+        self.unitVersions[unit.unitID] += 1
+        return (unit.unitID, self.unitVersions[unit.unitID], delta)
+
+    def sendUnitDelta(self, unit):
+        """Send the clients the battle fields of unit that changed since
+        it was last sent, under a new version number."""
+        unitDelta = self.nextUnitDelta(unit)
+        if unitDelta != None:
+            self.session.broadcast('unitDelta', *unitDelta)
+
+    def unitResync(self, unitID):
+        """@return: (version, full battle state) of a unit, as last sent,
+        for a client that has lost track of it."""
+        if unitID not in self.sentUnitStates:
+            raise GameServerException("No unit with ID %d" % unitID)
+        return (self.unitVersions[unitID], self.sentUnitStates[unitID])
+
+    @accounted
+    def unitFacing(self, client, facing):
+        if not self.unitController(client):
+            return False
+        result = self.scenario.battle().unitSetFacing(facing)
+        if not result:
+            return False
+        self.queueCommand('unitFacing', (facing,))
+        return True
+    
+    def sendUnitFacing(self, facing):
+        self.session.broadcast('unitSetFacing', facing)
+        self.scenario.battle().unitDone()
+
+class ClientInfo(object):
+    def __init__(self, ref, name, address, accessLevel, faction=None):
+        self.ref = ref
+        self.address = address
+        self.accessLevel = accessLevel
+        self.name = name
+        self.faction = faction
+        self.session = None
+        self.readyForGame = False
+        self.readyToDisplay = True
+
+    def __str__(self):
+        return "%s (%s:%s)" % (self.name, self.address.host, self.address.port)
+
+@implementer(checkers.ICredentialsChecker)
+class UsernameChecker(object):
+    #interface.implements(checkers.ICredentialsChecker)
+    credentialInterfaces = (credentials.IUsernamePassword,
+                            credentials.IUsernameHashedPassword)
+
+    def __init__(self):
+        self.users = {}
+
+    def requestAvatarId(self, credentials):
+        # Handle both bytes and string usernames for Python 3 compatibility
+        username = credentials.username
+        if isinstance(username, bytes):
+            username = username.decode('utf-8')
+
+        # Names are unique across the server; the session stays as asked
+        (username, sessionID) = splitLoginName(username)
+        name = username
+        i = 2
+        while name in self.users:
+            name = username + str(i)
+            i += 1
+        self.users[name] = True
+        return defer.succeed(loginName(name, sessionID))
+
+    def logout(self, name):
+        self.users.pop(name, None)
+
+class GameSession(object):
+    """One match: the clients taking part in it or watching, the factions
+    they were given and the GameState (and so the Battle) they play.
+    Sessions share the server's reactor and port but nothing else."""
+
+    # How many players a session waits for until a scenario says
+    # otherwise (see GameState.setScenario)
+    DEFAULT_PLAYERS = 2
+
+    def __init__(self, server, sessionID):
+        self.server = server
+        self.sessionID = sessionID
+        self.clients = {} # maps id(clientRef) -> ClientInfo
+        self.nextFaction = 0
+        self.created = time.monotonic()
+        self.closed = False
+        self.state = GameState(self)
+
+    def numPlayers(self):
+        if self.state.scenario:
+            return self.state.scenario.numPlayers
+        return GameSession.DEFAULT_PLAYERS
+
+    def players(self):
+        return [c for c in list(self.clients.values())
+                if c.accessLevel != Access.OBSERVER]
+
+    def waitingForPlayers(self):
+        return (self.state.state == GameState.WAITING_FOR_PLAYERS and
+                len(self.players()) < self.numPlayers())
+
+    def accessFor(self):
+        """@return: the access level the next client to join gets: the
+        first player creates the game, the others play it until it is
+        full, and then everyone else watches."""
+        if not self.waitingForPlayers():
+            return Access.OBSERVER
+        if not self.players():
+            return Access.CREATOR
+        return Access.PLAYER
+
+    def join(self, clientInfo):
+        if clientInfo.accessLevel != Access.OBSERVER:
+            clientInfo.faction = self.nextFaction
+            self.nextFaction += 1
+        clientInfo.session = self
+        self.clients[id(clientInfo.ref)] = clientInfo
+        self.broadcast('serverMessage', "%s connected (%d players total)" %
+                       (clientInfo.name, len(self.clients)))
+
+    def leave(self, client):
+        clientInfo = self.clients.pop(client)
+        self.broadcast('serverMessage', "%s disconnected (%d players total)" %
+                       (clientInfo.name, len(self.clients)))
+        if not self.clients:
+            self.close()
+        else:
+            # Whoever was being waited for may have just left
+            self.state.update()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.sessionClosed(self)
+
+    def remote(self, client, methodName, *args):
+        return self.server.remote(client, methodName, *args)
+
+    def remoteAll(self, methodName, *args):
+        return self.server.remoteEach(list(self.clients.values()),
+                                      methodName, *args)
+
+    def broadcast(self, methodName, *args):
+        """remoteAll for messages that are the same for every client. The
+        message is jellied and encoded once; each client is then only sent
+        the bytes, so a session with many observers doesn't copy the same
+        objects over and over.
+
+        Not for anything jellied differently for each client, like the
+        scenario (see Map.getStateToCopyFor)."""
+        if not self.clients:
+            return []
+        data = engine.netsupport.encodeMessage(methodName, *args)
+        return self.remoteAll('broadcast', data)
+
+    def stats(self):
+        """@return: how this session is doing, as plain values."""
+        return {'session': self.sessionID,
+                'state': self.state.state,
+                'clients': len(self.clients),
+                'players': len(self.players()),
+                'age': time.monotonic() - self.created,
+                'turns': (self.state.scenario.battle().turns()
+                          if self.state.scenario else 0),
+                'usage': self.state.usage.snapshot(),
+                'latency': self.state.commandLatency.snapshot()}
+
+@implementer(portal.IRealm)
+class GameServer(object):
+    """Hosts sessions for clients that connect to the port.
+
+    @param scenario: (campaign, scenario) that new sessions start with, so
+    the players don't have to choose one.
+    @param exitAfterGame: stop the reactor when a session ends (for the
+    server a player starts along with their game)."""
+    def __init__(self, port, scenario=None, exitAfterGame=False):
+        self.port = port
+        self.defaultScenario = scenario
+        self.exitAfterGame = exitAfterGame
+        self.sessions = {} # maps session ID -> GameSession
+        self.clients = {} # maps id(clientRef) -> ClientInfo
+        self._nextSessionID = 1
+        self.checker = UsernameChecker()
+        self.start()
+        serverLog.info('Listening on port %d' % self.port)
+
+    def start(self):
+        p = portal.Portal(self)
+        p.registerChecker(self.checker)
+        reactor.listenTCP(self.port, pb.PBServerFactory(p))
+
+    def newSession(self, sessionID=None):
+        if sessionID is None:
+            while str(self._nextSessionID) in self.sessions:
+                self._nextSessionID += 1
+            sessionID = str(self._nextSessionID)
+            self._nextSessionID += 1
+        session = GameSession(self, sessionID)
+        self.sessions[sessionID] = session
+        if self.defaultScenario:
+            session.state.setScenario(*self.defaultScenario)
+        serverLog.debug('Session %s started (%d sessions)' %
+                        (sessionID, len(self.sessions)))
+        return session
+
+    def campaignsInUse(self, exclude=None):
+        """@return: the set of campaigns the sessions other than exclude
+        have set a scenario from."""
+        return set(session.state.campaign
+                   for session in list(self.sessions.values())
+                   if session is not exclude and
+                   session.state.campaign != None)
+
+    def findSession(self, sessionID=None):
+        """@return: the session with the given ID, started if need be, or
+        for None the oldest session still waiting for players."""
+        if sessionID is None:
+            for session in list(self.sessions.values()):
+                if session.waitingForPlayers():
+                    return session
+        elif sessionID in self.sessions:
+            return self.sessions[sessionID]
+        return self.newSession(sessionID)
+
+    def sessionClosed(self, session):
+        if self.sessions.get(session.sessionID) is session:
+            del self.sessions[session.sessionID]
+        serverLog.info('Session %s closed (%d sessions left): %s' %
+                       (session.sessionID, len(self.sessions),
+                        session.state.usage))
+        if self.exitAfterGame and reactor.running:
+            reactor.stop()
+
+    def sessionStats(self):
+        return [s.stats() for s in list(self.sessions.values())]
+
+    def error(self, failure, op=""):
+        """Handle server-side network errors gracefully."""
+        # Silently ignore connection lost errors (normal disconnects)
+        if failure.type == pb.PBConnectionLost:
+            return
+
+        errorMsg = str(failure.getErrorMessage())
+
+        # Log different error types with appropriate severity
+        if 'Connection' in errorMsg:
+            serverLog.info(f'Client connection error in {op}: {errorMsg}')
+        else:
+            serverLog.warning(f'Network error in {op}: {errorMsg}')
+
+        # Continue running - don't stop server on individual client errors
+
+    def requestAvatar(self, login, clientRef, *interfaces):
+        """This is what gets called when a client logs in."""
+        if pb.IPerspective not in interfaces:
+            raise NotImplementedError
+        (name, sessionID) = splitLoginName(login)
+        session = self.findSession(sessionID)
+        accessLevel = session.accessFor()
+        perspectiveClass = {Access.CREATOR: GameCreator,
+                            Access.PLAYER: GamePlayer,
+                            Access.OBSERVER: GameObserver}[accessLevel]
+        address = clientRef.broker.transport.getPeer()
+        perspective = perspectiveClass(self, session, clientRef, name)
+        clientInfo = ClientInfo(clientRef, name, address, accessLevel)
+        session.join(clientInfo)
+        perspective.faction = clientInfo.faction
+        self.clients[id(clientRef)] = clientInfo
+        serverLog.debug('%s joined session %s as %s (total clients: %d)' %
+                        (clientInfo, session.sessionID, accessLevel,
+                         len(self.clients)))
+        return (pb.IPerspective, perspective,
+                lambda: self.handleDisconnect(id(clientRef)))
+
+    def handleDisconnect(self, client):
+        clientInfo = self.clients.pop(client)
+        self.checker.logout(clientInfo.name)
+        serverLog.debug('%s disconnected (total clients: %d)' %
+                        (clientInfo, len(self.clients)))
+        if client in clientInfo.session.clients:
+            clientInfo.session.leave(client)
+
+
+    def remote(self, client, methodName, *args):
+        """Call a remote method on a client with error handling."""
+        try:
+            if isinstance(client, GameObserver):
+                client = client.clientRef
+            df = client.callRemote(methodName, *args)
+            # Only spell the call out if it fails: args can be big
+            df.addErrback(lambda failure: self.error(
+                failure, "%s%s" % (methodName, str(args))))
+            return df
+        except Exception as e:
+            serverLog.error(f'Exception calling remote {methodName}: {e}')
+            return None
+
+    def remoteEach(self, clients, methodName, *args):
+        """Call a remote method on each of a list of ClientInfos with
+        error handling."""
+        dfs = []
+        for clientInfo in clients:
+            try:
+                df = self.remote(clientInfo.ref, methodName, *args)
+                if df is not None:
+                    dfs.append(df)
+            except Exception as e:
+                serverLog.warning(f'Failed to call {methodName} on client {clientInfo.name}: {e}')
+                continue
+        return dfs
+
+    def remoteAll(self, methodName, *args):
+        """Call a remote method on every client in every session."""
+        return self.remoteEach(list(self.clients.values()), methodName, *args)
+
+class GameServerException(Exception):
+    pass
+
+########################################### MAIN
+
+def run(args=None):
+    """Run a server on its own, with no game window (galaxywizard-server)."""
+    parser = optparse.OptionParser(description="Headless GalaxyWizard game server.")
+    parser.add_option("--port", "-P", type=int, default=22222)
+    parser.add_option("--campaign", default=None,
+                      help="campaign of --scenario (default: %s)" %
+                      resources.campaign)
+    parser.add_option("--scenario", default=None,
+                      help="play this scenario in every session instead of "
+                      "letting the first client to join choose")
+    parser.add_option("--verbose", "-v", action="count", default=0)
+    (options, args) = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO - options.verbose * 10)
+    # Ability and unit files mark their text for translation
+    Translate().setLanguage()
+    serverLog.info('GalaxyWizard server %s' % main.__version__)
+
+    scenario = None
+    if options.scenario:
+        scenario = (options.campaign or resources.campaign, options.scenario)
+    server = GameServer(options.port, scenario)
+    try:
+        reactor.run()
+    except KeyboardInterrupt:
+        if reactor.running:
+            reactor.stop()
+
+
+if __name__ == "__main__":
+    run()
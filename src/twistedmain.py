@@ -1,7 +1,4 @@
-from twisted.internet import reactor, defer
-from twisted.spread import pb
-from twisted.cred import checkers, portal, credentials
-from zope.interface import implementer
+from twisted.internet import reactor
 
 from gui.MainWindow import MainWindow
 from gui import ScenarioChooser
@@ -10,220 +7,49 @@ import logging
 import resources
 import main
 
-serverLog = logging.getLogger('gsrv')
 clientLog = logging.getLogger('gcli')
 
-import engine.netsupport
+import engine.Map
 
 ############################ COMMON
 
-# Each Avatar can call some methods on the server. A GameCreator can
-# call all methods, a GamePlayer can call most methods (everything
-# needed to actually play in a game), and a GameObserver has the least
-# access (they can only watch.)
-class Access(object):
-    CREATOR = "Creator"
-    PLAYER = "Player"
-    OBSERVER = "Observer"
+# The server side lives in server.py
+from server import (Access, GameObserver, GamePlayer, GameCreator,
+                    UnitState, GameState, ClientInfo, UsernameChecker,
+                    GameSession, GameServer, GameServerException,
+                    loginName)
 
-class GameObserver(pb.Avatar):
-    def __init__(self, server, clientRef, name):
-        self.clientRef = clientRef
-        self.accessLevel = Access.OBSERVER
-        self.server = server
-        self.gameState = server.state
-        self.name = name
-        self.faction = None
-
-    def perspective_info(self, version):
-        if main.__version__ != version:
-            err = ("Your version of GalaxyWizard (%s) does not match the server's (%s)." %
-                   (version, main.__version__))
-            raise Exception(err)
-        return self.name, self.accessLevel, self.faction
-
-    def perspective_chat(self, message):
-        self.server.remoteAll('chat', self.name, message)
-
-    def perspective_readyForGame(self):
-        self.server.clients[id(self.clientRef)].readyForGame = True
-
-    def perspective_readyToDisplay(self):
-        self.server.clients[id(self.clientRef)].readyToDisplay = True
-
-class GamePlayer(GameObserver):
-    def __init__(self, server, clientRef, name):
-        GameObserver.__init__(self, server, clientRef, name)
-        self.accessLevel = Access.PLAYER
-
-    def perspective_unitMove(self, x, y):
-        return self.gameState.unitMove(self, int(x), int(y))
-
-    def perspective_unitAct(self, abilityID, x, y):
-        return self.gameState.unitAct(self, int(abilityID), int(x), int(y))
-
-    def perspective_unitFacing(self, facing):
-        return self.gameState.unitFacing(self, int(facing))
-        
-class GameCreator(GamePlayer):
-    def __init__(self, server, clientRef, name):
-        GamePlayer.__init__(self, server, clientRef, name)
-        self.accessLevel = Access.CREATOR
-            
-    def perspective_setScenario(self, campaign, scenario):
-        clientLog.debug("Set campaign and scenario to %s/%s" %
-                        (campaign, scenario))
-        return self.server.state.setScenario(campaign, scenario)
+# The clients that don't need the game window live in client.py
+from client import GameClient, AIFSM, AIClient
 
 ############################ CLIENT
 
-class GameClient(pb.Referenceable):
-    """Client interface. Handles talking to the server but doesn't
-    take any real actions or start any GUI."""
-    def __init__(self, server, serverPort, username):
-        self.server = server
-        self.serverPort = serverPort
-        self.username = username
-        self.perspective = None
-        self.accessLevel = Access.OBSERVER
-        self.name = None
-        self.faction = None
-        self.scenario = None
-        self.start()
-        self.unit = None # FIXME: remove
-
-    def start(self):
-        # Start connection to the PB server
-        factory = pb.PBClientFactory()
-        reactor.connectTCP(self.server,
-                           self.serverPort,
-                           factory)
-        # log in with username and blank password
-        # Ensure both username and password are properly encoded for Python 3
-        username = self.username
-        password = ""
-        if isinstance(username, str):
-            username = username.encode('utf-8')
-        if isinstance(password, str):
-            password = password.encode('utf-8')
-        c = credentials.UsernamePassword(username, password)
-        df = factory.login(c, self)
-        df.addCallback(self.gotPerspective)
-        df.addErrback(lambda e: self.error(e, "logging in to %s" %
-                                           self.server))
-
-    # Methods starting with remote_ can be called by the server.
-    def remote_startGame(self, scenario):
-        self.scenario = scenario
-        for u in scenario.units():
-            scenario.map().squares[u.x()][u.y()].unit = u
-
-    def remote_chat(self, username, message):
-        pass
-
-    def remote_serverMessage(self, message):
-        pass
-
-    def remote_unitBeginTurn(self, unitID):
-        if self.scenario is None:
-            return
-        self.unit = self.scenario.unitFromID(unitID)
-
-    def remote_unitUpdate(self, unitID, newUnit):
-        if self.scenario is None:
-            return
-        unit = self.scenario.unitFromID(unitID)
-        unit.update(newUnit)
-        if not unit.alive():
-            self.scenario.map().squares[unit.x()][unit.y()].unit = None
-
-    # FIXME: for sanity's sake, need to send unitIDs with all of these
-    # so that the right unit is guaranteed to be affected even if
-    # lagmonster happens - I think this is fixed now, 2006-Mar-25
-    def remote_unitMoveActCancel(self, move, act, cancel):
-        pass
-
-    def remote_unitMoved(self, x, y):
-        # Actually move the unit on our map
-        m = self.scenario.map()
-        m.squares[self.unit.x()][self.unit.y()].unit = None
-        m.squares[x][y].unit = self.unit
-        # FIXME: we should set the unit posn here but that screws up
-        # the GUI
-
-    def remote_unitSetFacing(self, facing):
-        self.unit.setFacing(facing)
-
-    def remote_actionResults(self, actionResults):
-        pass
-
-    def remote_actionPerformed(self, abilityID):
-        pass
-
-    # Utility function for calling a remote method on the server. Adds
-    # a sensible errback.
-    def remote(self, methodName, *args):
-        df = self.perspective.callRemote(methodName, *args)
-        op = "%s%s" % (methodName, str(args))
-        df.addErrback(self.error, op)
-        return df
-
-    def error(self, failure, op=""):
-        """Handle network errors with appropriate logging and recovery."""
-        errorMsg = str(failure.getErrorMessage())
-        clientLog.error(f'Network error in {op}: {errorMsg}')
-
-        # Check if this is a fatal error that requires shutdown
-        from twisted.internet import error as twisted_errors
-        fatal_errors = (
-            twisted_errors.ConnectionRefusedError,
-            twisted_errors.ConnectionLost,
-            twisted_errors.ConnectionDone,
-        )
-
-        # Only stop reactor for fatal connection errors
-        if failure.check(*fatal_errors):
-            clientLog.critical(f'Fatal network error: {errorMsg}. Shutting down.')
-            if reactor.running:
-                reactor.stop()
-        else:
-            # Log non-fatal errors but continue running
-            clientLog.warning(f'Non-fatal network error in {op}, continuing...')
-
-    def gotPerspective(self, perspective):
-        """Called after a successful login to the server."""
-        self.perspective = perspective
-        df = self.remote('info', main.__version__)
-        df.addCallback(self.gotInfo)
-
-    def gotInfo(self, xxx_todo_changeme):
-        (name, accessLevel, faction) = xxx_todo_changeme
-        self.name = name
-        self.faction = faction
-        self.accessLevel = accessLevel
-        self.remote('readyForGame')
-
 class InteractiveClient(GameClient):
     """Interactive client -- the normal player GUI."""
     def __init__(self, server, serverPort, username, scenario, aiPlayers,
-                 window):
+                 window, session=None):
         self.window = window
         self.scenarioGUI = None
         self.scenarioName = scenario
         self.aiPlayers = aiPlayers
-        GameClient.__init__(self, server, serverPort, username)
+        GameClient.__init__(self, server, serverPort, username, session)
+
+    def chooseScenario(self):
+        if self.accessLevel == Access.CREATOR:
+            # FIXME: set scenario name from in-game, not command-line only
+            return self.remote('setScenario',
+                               'demo', # FIXME: allow setting campaign
+                               self.scenarioName)
+        return None
 
-    def gotInfo(self, xxx_todo_changeme1):
-        (name, accessLevel, faction) = xxx_todo_changeme1
-        GameClient.gotInfo(self, (name, accessLevel, faction))
+    def gotInfo(self, info):
+        GameClient.gotInfo(self, info)
         clientLog.debug("Access level set to %s" % self.accessLevel)
         if self.accessLevel == Access.CREATOR:        
-            # FIXME: set scenario name from in-game, not command-line only
-            df = self.remote('setScenario',
-                             'demo', # FIXME: allow setting campaign
-                             self.scenarioName)
             for i in range(0, self.aiPlayers):
-                ai = AIClient(self.server, self.serverPort)
+                ai = AIClient(self.server, self.serverPort, self.session,
+                              budget=getattr(opts, 'ai_budget', None),
+                              useWorker=getattr(opts, 'ai_process', True))
 
     def gotPerspective(self, perspective):
         GameClient.gotPerspective(self, perspective)
@@ -259,426 +85,15 @@ class InteractiveClient(GameClient):
         GameClient.remote_unitSetFacing(self, facing)
         reactor.callLater(1.0, self.remote, 'readyToDisplay')
         
-    def remote_actionResults(self, actionResults):
+    def remote_actionResolved(self, abilityID, actionResults, unitDeltas):
+        self.scenarioGUI.showActionPerformed(abilityID)
         for unitID, results in list(actionResults.items()):
             self.scenarioGUI.showActionResults(unitID, results)
+        GameClient.remote_actionResolved(self, abilityID, actionResults,
+                                         unitDeltas)
         reactor.callLater(1.0, self.remote, 'readyToDisplay')
-        
-    def remote_actionPerformed(self, abilityID):
-        self.scenarioGUI.showActionPerformed(abilityID)
-
-### AI Client
-import ai.UnitAI
-import fsm
-import engine.Battle
-from twisted.internet import threads
-        
-class AIFSM(fsm.FSM):
-    def __init__(self, aiClient):
-        fsm.FSM.__init__(self, ['disabled', 'begin', 'calc'])
-        for s in self.states:
-            self.addEntryHook(s, getattr(self, "enter_" + s, self.doNothing))
-        self.aiClient = aiClient
-        self.unit = None
-        self.turn = None
-        
-    def enter_begin(self, oldState, unitID):
-        self.unit = self.aiClient.scenario.unitFromID(unitID)
-        if self.unit is None:
-            clientLog.error(f"AI cannot find unit with ID {unitID}")
-            return
-
-    def enter_calc(self, oldState, xxx_todo_changeme2):
-        (move, act, cancel) = xxx_todo_changeme2
-        if self.unit is None:
-            clientLog.error("AI unit is None, cannot calculate turn")
-            return
-        self.unit.setMoveActCancel(move, act, cancel)
-        unitAI = ai.UnitAI.Exhaustive(self.unit)
-        df = threads.deferToThread(unitAI.calc,
-                                   self.aiClient.scenario.battle())
-        df.addCallback(self.executeTurn)
-
-    def executeTurn(self, turn):
-        self.turn = turn
-        if turn.turnOrder() == engine.Battle.UnitTurn.MOVE_FIRST:
-            if turn.moveTarget() != None:
-                self.aiClient.remote('unitMove',
-                                     *turn.moveTarget())
-            if turn.action() != None:
-                self.aiClient.remote('unitAct',
-                                     turn.action().abilityID,
-                                     *turn.actionTarget())
-            self.aiClient.remote('unitFacing', turn.facing())
-        else:
-            raise NotImplemented("AI turn order = act-first")
-
-    def doNothing(self, *args):
-        pass
-
-# FIXME: clean up AIclient, don't need AIFSM class
-class AIClient(GameClient):
-    """AI client -- just sends moves to the server when needed."""
-    def __init__(self, server, serverPort):
-        GameClient.__init__(self, server, serverPort, "AI")
-        self.fsm = AIFSM(self)
-    
-    def remote_unitBeginTurn(self, unitID):
-        GameClient.remote_unitBeginTurn(self, unitID)
-        if self.unit is not None:
-            self.fsm.trans('begin', unitID)
-    
-    def remote_unitMoveActCancel(self, move, act, cancel):
-        if self.fsm.state == 'begin':
-            self.fsm.trans('calc', (move, act, cancel))
-
-    def remote_unitMoved(self, x, y):
-        GameClient.remote_unitMoved(self, x, y)
-        self.unit.setPosn(x, y, self.scenario.map().squares[x][y].z)
-        self.remote('readyToDisplay')
-
-    def remote_unitSetFacing(self, facing):
-        GameClient.remote_unitSetFacing(self, facing)
-        self.remote('readyToDisplay')
-
-    def remote_actionResults(self, *args):
-        GameClient.remote_actionResults(self, *args)
-        self.remote('readyToDisplay')
 
 ########################### SERVER
-
-class UnitState(object):
-    def __init__(self, unit, controller):
-        self.unit = unit
-        self.controller = controller
-        self.originalPosn = unit.posn()
-
-    def moveActCancel(self):
-        return self.unit.hasMove(), self.unit.hasAct(), self.unit.hasCancel()
-
-class GameState(object):
-    WAITING_FOR_PLAYERS = 0
-    PLAYING = 1
-    DONE = 2
-    
-    def __init__(self, server):
-        self.server = server
-        self.scenario = None
-        self.state = GameState.WAITING_FOR_PLAYERS
-        self.unitState = None
-        self.factions = {}
-        self.clientCommandQueue = []
-        
-    def _validate_name(self, name, name_type):
-        """
-        Validate campaign/scenario names to prevent directory traversal attacks.
-
-        Args:
-            name: The name to validate
-            name_type: 'campaign' or 'scenario' (for error messages)
-
-        Returns:
-            The validated name
-
-        Raises:
-            ValueError: If the name contains invalid characters
-        """
-        import re
-
-        if not name:
-            raise ValueError(f"{name_type} name cannot be empty")
-
-        # Check for reserved names first (before regex check)
-        if name in ['.', '..', 'CON', 'PRN', 'AUX', 'NUL']:
-            raise ValueError(f"Reserved {name_type} name '{name}' is not allowed")
-
-        # Only allow alphanumeric characters, hyphens, and underscores
-        # This prevents directory traversal attacks (../, ./, /etc)
-        if not re.match(r'^[a-zA-Z0-9_-]+$', name):
-            raise ValueError(
-                f"Invalid {name_type} name '{name}'. "
-                f"Only alphanumeric characters, hyphens, and underscores are allowed."
-            )
-
-        return name
-
-    def setScenario(self, campaign, scenario):
-        """
-        Set the current scenario for the game.
-
-        Args:
-            campaign: Campaign name (validated for security)
-            scenario: Scenario name (validated for security)
-
-        Raises:
-            ValueError: If campaign or scenario names contain invalid characters
-        """
-        # Validate input to prevent directory traversal attacks
-        validated_campaign = self._validate_name(campaign, 'campaign')
-        validated_scenario = self._validate_name(scenario, 'scenario')
-
-        resources.setCampaign(validated_campaign)
-        self.scenario = resources.scenario(validated_scenario)
-        self.scenario.numPlayers = 2 # FIXME: should be defined by the scenario
-
-    def update(self):
-        self._update()
-        reactor.callLater(0.1, self.update)
-
-    def _update(self):
-        # If we've collected enough players, start the game
-        if self.state == GameState.WAITING_FOR_PLAYERS:
-            if not self.scenario:
-                return
-            readyPlayers = 0
-            for c in list(self.server.clients.values()):
-                if c.readyForGame:
-                    readyPlayers += 1
-            if readyPlayers == self.scenario.numPlayers:
-                self.startGame()
-            return
-        # If we need a new unit, pick one
-        if self.state == GameState.PLAYING and self.clientsReadyToDisplay():
-            b = self.scenario.battle()
-            if b.status() != -1:
-                self.clientCommandQueue.append(('battleStatus', (b.status(),)))
-            if b.activeUnit == None:
-                unit = b.pickNextUnit()
-                controller = self.factions[unit.faction()]
-                self.unitState = UnitState(unit, controller)
-                self.server.remoteAll('unitBeginTurn', unit.unitID)
-                self.server.remote(controller.ref, 'unitMoveActCancel',
-                                   *self.unitState.moveActCancel())
-            if self.clientCommandQueue:
-                commandName, args = self.clientCommandQueue.pop(0)
-                self.setClientsReadyToDisplay(False)
-                if commandName == 'unitMove':
-                    self.sendUnitMove(*args)
-                elif commandName == 'unitAct':
-                    self.sendUnitAct(*args)
-                elif commandName == 'unitFacing':
-                    self.sendUnitFacing(*args)
-                elif commandName == 'battleStatus':
-                    self.sendBattleStatus(*args)
-                
-    def startGame(self):
-        self.factions = {}
-        self.state = GameState.PLAYING
-        self.server.remoteAll('startGame', self.scenario)
-        for c in list(self.server.clients.values()):
-            self.factions[c.faction] = c
-        self.setClientsReadyToDisplay(True)
-
-    def clientsReadyToDisplay(self):
-        for c in list(self.server.clients.values()):
-            if not c.readyToDisplay:
-                return False
-        return True
-
-    def setClientsReadyToDisplay(self, ready):
-        for c in list(self.server.clients.values()):
-            c.readyToDisplay = ready       
-
-    def unitController(self, client):
-        return client.faction == self.unitState.unit.faction()
-
-    def unitMove(self, client, x, y):
-        if not self.unitController(client):
-            return False
-        result = self.scenario.battle().unitMoved(x, y)
-        if not result:
-            return False
-        self.clientCommandQueue.append(('unitMove', (client, x, y)))
-        return True
-
-    def sendBattleStatus(self, winner):
-        for c in list(self.server.clients.values()):
-            if c.faction == winner:
-                self.server.remote(c.ref,
-                                   'serverMessage', 'You win!')
-            else:
-                self.server.remote(c.ref,
-                                   'serverMessage', 'You lose!')
-        self.state = GameState.DONE
-        reactor.callLater(10, reactor.stop)
-
-    def sendUnitMove(self, client, x, y):
-        self.server.remote(client, 'unitMoveActCancel',
-                           *self.unitState.moveActCancel())
-        self.server.remoteAll('unitMoved', x, y)
-
-    def unitAct(self, client, abilityID, x, y):
-        if not self.unitController(client):
-            return False
-        ability = engine.Ability.Ability.get.get(abilityID)
-        if ability is None:
-            serverLog.error(f"Ability with ID {abilityID} not found")
-            return False
-        result = self.scenario.battle().unitActed(ability, x, y)
-        if not result:
-            return False
-        affectedUnits, allEffectResults = result
-        self.clientCommandQueue.append(('unitAct',
-                                        (client, abilityID, affectedUnits,
-                                         allEffectResults)))
-        return True
-
-    def sendUnitAct(self, client, abilityID, affectedUnits, allEffectResults):
-        # FIXME: put actionPerformed and actionResults into one
-        # message
-        self.server.remoteAll('actionPerformed', abilityID)
-        self.server.remoteAll('actionResults', allEffectResults)
-        for u in affectedUnits:
-            self.server.remoteAll('unitUpdate', u.unitID, u)
-        self.server.remote(client, 'unitMoveActCancel',
-                           *self.unitState.moveActCancel())
-
-
-    def unitFacing(self, client, facing):
-        if not self.unitController(client):
-            return False
-        result = self.scenario.battle().unitSetFacing(facing)
-        if not result:
-            return False
-        self.clientCommandQueue.append(('unitFacing', (facing,)))
-        return True
-    
-    def sendUnitFacing(self, facing):
-        self.server.remoteAll('unitSetFacing', facing)
-        self.scenario.battle().unitDone()
-
-class ClientInfo(object):
-    nextFaction = 0
-    
-    def __init__(self, ref, name, address, accessLevel):
-        self.ref = ref
-        self.address = address
-        self.accessLevel = accessLevel
-        self.name = name
-        self.faction = ClientInfo.nextFaction
-        self.readyForGame = False
-        self.readyToDisplay = True
-        ClientInfo.nextFaction += 1
-
-    def __str__(self):
-        return "%s (%s:%s)" % (self.name, self.address.host, self.address.port)
-
-@implementer(checkers.ICredentialsChecker)
-class UsernameChecker(object):
-    #interface.implements(checkers.ICredentialsChecker)
-    credentialInterfaces = (credentials.IUsernamePassword,
-                            credentials.IUsernameHashedPassword)
-
-    def __init__(self):
-        self.users = {}
-
-    def requestAvatarId(self, credentials):
-        # Handle both bytes and string usernames for Python 3 compatibility
-        username = credentials.username
-        if isinstance(username, bytes):
-            username = username.decode('utf-8')
-
-        name = username
-        i = 2
-        while name in self.users:
-            name = username + str(i)
-            i += 1
-        self.users[name] = True
-        return defer.succeed(name)
-
-@implementer(portal.IRealm)
-class GameServer(object):
-    def __init__(self, port):
-        self.port = port
-        self.state = GameState(self)
-        self.clients = {} # maps clientRef -> ClientInfo
-        self.start()
-        serverLog.info('Listening on port %d' % self.port)
-
-    def start(self):
-        p = portal.Portal(self)
-        c = UsernameChecker()
-        p.registerChecker(c)
-        reactor.listenTCP(self.port, pb.PBServerFactory(p))
-        self.state.update()
-
-    def error(self, failure, op=""):
-        """Handle server-side network errors gracefully."""
-        # Silently ignore connection lost errors (normal disconnects)
-        if failure.type == pb.PBConnectionLost:
-            return
-
-        errorMsg = str(failure.getErrorMessage())
-
-        # Log different error types with appropriate severity
-        if 'Connection' in errorMsg:
-            serverLog.info(f'Client connection error in {op}: {errorMsg}')
-        else:
-            serverLog.warning(f'Network error in {op}: {errorMsg}')
-
-        # Continue running - don't stop server on individual client errors
-
-    def requestAvatar(self, name, clientRef, *interfaces):
-        """This is what gets called when a client logs in."""
-        if pb.IPerspective not in interfaces:
-            raise NotImplementedError
-        perspectiveClass = None
-        if len(self.clients) == 0:
-            perspectiveClass = GameCreator
-        else:
-            perspectiveClass = GamePlayer
-        address = clientRef.broker.transport.getPeer()
-        perspective = perspectiveClass(self, clientRef, name)
-        clientInfo = ClientInfo(clientRef, name, address,
-                                perspective.accessLevel)
-        perspective.faction = clientInfo.faction
-        self.clients[id(clientRef)] = clientInfo
-        serverLog.debug('%s connected (total clients: %d)' %
-                        (clientInfo, len(self.clients)))
-        self.remoteAll('serverMessage', "%s connected (%d players total)" %
-                       (name, len(self.clients)))
-        return (perspectiveClass, perspective,
-                lambda: self.handleDisconnect(id(clientRef)))
-
-    def handleDisconnect(self, client):
-        clientInfo = self.clients[client]
-        del self.clients[client]
-        serverLog.debug('%s disconnected (total clients: %d)' %
-                        (clientInfo, len(self.clients)))
-        self.remoteAll('serverMessage', "%s disconnected (%d players total)" %
-                       (clientInfo.name, len(self.clients)))
-
-
-    def remote(self, client, methodName, *args):
-        """Call a remote method on a client with error handling."""
-        try:
-            if isinstance(client, GameObserver):
-                client = client.clientRef
-            df = client.callRemote(methodName, *args)
-            op = "%s%s" % (methodName, str(args))
-            df.addErrback(self.error, op)
-            return df
-        except Exception as e:
-            serverLog.error(f'Exception calling remote {methodName}: {e}')
-            return None
-
-    def remoteAll(self, methodName, *args):
-        """Call a remote method on all clients with error handling."""
-        dfs = []
-        # Create a copy of clients to avoid dict modification during iteration
-        for clientInfo in list(self.clients.values()):
-            try:
-                df = self.remote(clientInfo.ref, methodName, *args)
-                if df is not None:
-                    dfs.append(df)
-            except Exception as e:
-                serverLog.warning(f'Failed to call {methodName} on client {clientInfo.name}: {e}')
-                continue
-        return dfs          
-
-class GameServerException(Exception):
-    pass
-
 ########################################### MAIN
 
 import gui.ScenarioChooser
@@ -725,7 +140,7 @@ def startGame(server, port=None, user=None, scenario=None,
     # Configure the server
     if server == None:
         server = '127.0.0.1'
-        gameServer = GameServer(port)
+        gameServer = GameServer(port, exitAfterGame=True)
     # Then configure the client
     aiPlayers = 1
     if multiplayer:
@@ -741,6 +156,8 @@ def run(options):
     global window
     global opts
     opts = options
+    if opts.map_cache:
+        engine.Map.mapCache.setDirectory(opts.map_cache)
     window = MainWindow(opts.fullscreen,opts.width)
     window.update()
     if opts.edit_map:
@@ -1,3 +1,6 @@
+import bisect
+import contextlib
+import time
 import traceback
 import logging
 
@@ -27,3 +30,97 @@ class Lock:
         logging.debug(line)
         self._lock.acquire()
         logging.debug("acq done")
+
+
+class LatencyHistogram:
+    """Counts of latencies, in seconds, in buckets that grow roughly
+    exponentially. Cheap enough to record every event."""
+
+    # Upper bounds of the buckets in seconds; the last bucket is open.
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+              0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        """@return: an upper bound for the p-th percentile (0-100): the top
+        of the bucket it falls in, or the maximum for the open bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+    def snapshot(self):
+        """@return: the histogram as plain values, e.g. to send to a
+        client."""
+        return {'bounds': list(self.bounds), 'counts': list(self.counts),
+                'count': self.count, 'mean': self.mean(), 'max': self.max}
+
+    def __str__(self):
+        return (f"n={self.count} mean={self.mean() * 1000:.1f}ms "
+                f"p50<={self.percentile(50) * 1000:.1f}ms "
+                f"p99<={self.percentile(99) * 1000:.1f}ms "
+                f"max={self.max * 1000:.1f}ms")
+
+
+class TimeAccount:
+    """CPU and wall-clock time spent on something, in seconds. The CPU
+    time is the measuring thread's own, so work other threads do at the
+    same time (e.g. an AI thinking) isn't charged to it."""
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.wall = 0.0
+        self.count = 0
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def measure(self):
+        """Charge the time spent in a with block to this account. Nested
+        blocks are only counted once, by the outermost one."""
+        self._depth += 1
+        if self._depth > 1:
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self.cpu += time.thread_time() - cpu
+            self.wall += time.perf_counter() - wall
+            self.count += 1
+
+    def snapshot(self):
+        return {'cpu': self.cpu, 'wall': self.wall, 'count': self.count}
+
+    def __str__(self):
+        return (f"cpu={self.cpu * 1000:.1f}ms wall={self.wall * 1000:.1f}ms "
+                f"n={self.count}")
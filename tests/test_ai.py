@@ -2,6 +2,7 @@
 Unit tests for the AI system
 """
 import unittest
+import threading
 import sys
 import os
 
@@ -9,8 +10,13 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from ai.UnitAI import Base, HealWeakest, DamageWeakest, MoveToWeakest, Exhaustive
+from ai.UnitAI import TurnGenerator, TemporaryUnitPosition, Scripted
+from engine import Ability, Effect, Range
+from ai.AIWorker import AIWorker
+from engine.Scenario import Scenario
 from engine.Battle import Battle, UnitTurn, NEVER_ENDING
 from engine.Unit import Unit
+from engine import Unit as UnitModule
 from engine.Class import Class
 from engine.Map import Map
 from engine.Faction import Faction
@@ -377,5 +383,572 @@ class TestAITargetSelection(unittest.TestCase):
         self.assertIsInstance(result, list)
 
 
+class TestAITurnGenerator(unittest.TestCase):
+    """Test pruned, lazy turn generation"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.test_class = Class(
+            name="TestClass",
+            abilities=[],
+            spriteRoot="fighter",
+            move=3,
+            jump=2,
+            mhpBase=50,
+            mhpGrowth=5.0,
+            mhpMult=1.0,
+            mspBase=20,
+            mspGrowth=2.0,
+            mspMult=1.0,
+            watkBase=10,
+            watkGrowth=1.0,
+            watkMult=1.0,
+            wdefBase=10,
+            wdefGrowth=1.0,
+            wdefMult=1.0,
+            matkBase=10,
+            matkGrowth=1.0,
+            matkMult=1.0,
+            mdefBase=10,
+            mdefGrowth=1.0,
+            mdefMult=1.0,
+            speedBase=50,
+            speedGrowth=2.0,
+            speedMult=1.0
+        )
+
+        width, height = 12, 12
+        zdata = np.ones((width, height))
+        tileProperties = np.zeros((width, height), dtype=object)
+        for x in range(width):
+            for y in range(height):
+                tileProperties[x, y] = {'tag': ''}
+
+        self.test_map = Map(
+            width=width,
+            height=height,
+            z=zdata,
+            tileProperties=tileProperties,
+            globalWaterHeight=0,
+            globalWaterColor=[0.3, 0.3, 0.6],
+            tags_={}
+        )
+
+        self.strike = Ability.Ability("Strike", "", 0, Ability.HOSTILE, [],
+                                      Range.Cross(1, 1), Range.Single(),
+                                      [Effect.Damage()], None)
+        self.blast = Ability.Ability("Blast", "", 0, Ability.HOSTILE, [],
+                                     Range.Diamond(1, 4), Range.Diamond(0, 1),
+                                     [Effect.Damage()], None)
+        self.mend = Ability.Ability("Mend", "", 0, Ability.FRIENDLY, [],
+                                    Range.Diamond(0, 3), Range.Single(),
+                                    [Effect.Healing()], None)
+        self.units = []
+
+    def place_unit(self, x, y, faction):
+        unit = self.test_class.createUnit(gender=2)
+        unit.setPosn(x, y, 1)
+        unit.setFaction(faction)
+        unit.battleInit()
+        self.test_map.squares[x][y].setUnit(unit)
+        self.units.append(unit)
+        return unit
+
+    def all_turns(self, battle, unit, moveTargets, abilities):
+        """Every turn, found by trying every square"""
+        map_ = battle.map()
+        result = []
+        for ability in abilities:
+            for mt in moveTargets:
+                z = map_.squares[mt[0]][mt[1]].z
+                with TemporaryUnitPosition(map_, unit, mt[0], mt[1], z):
+                    for target in ability.range(map_, unit):
+                        if ability.hasEffect(map_, unit, target):
+                            result.append((UnitTurn.MOVE_FIRST, mt,
+                                           ability.abilityID, target))
+            for target in ability.range(map_, unit):
+                if ability.hasEffect(map_, unit, target):
+                    result.append((UnitTurn.ACT_FIRST, None,
+                                   ability.abilityID, target))
+        for mt in moveTargets:
+            result.append((UnitTurn.MOVE_FIRST, mt, None, None))
+        return sorted(result, key=repr)
+
+    def turn_keys(self, turns):
+        result = []
+        for t in turns:
+            abilityID = t.action().abilityID if t.action() else None
+            result.append((t.turnOrder(), t.moveTarget(), abilityID,
+                           t.actionTarget()))
+        return sorted(result, key=repr)
+
+    def test_generator_matches_exhaustive_search(self):
+        """Test pruning loses no turn that has an effect"""
+        unit = self.place_unit(2, 2, 0)
+        self.place_unit(3, 3, 0)
+        self.place_unit(6, 2, 1)
+        self.place_unit(10, 10, 1)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        moveTargets = self.test_map.reachable(unit) + [unit.posn()]
+        abilities = [self.strike, self.blast, self.mend]
+        expected = self.all_turns(battle, unit, moveTargets, abilities)
+
+        turns = TurnGenerator(battle, unit, moveTargets, abilities)
+        self.assertEqual(self.turn_keys(turns), expected)
+        # A second pass reuses the generated turns
+        considered = turns.considered
+        self.assertEqual(self.turn_keys(turns), expected)
+        self.assertEqual(turns.considered, considered)
+        self.assertIs(self.test_map.squares[2][2].unit, unit)
+
+    def test_act_first_then_retreat(self):
+        """Test each act-first turn comes once and moves away afterwards"""
+        unit = self.place_unit(2, 2, 0)
+        enemy = self.place_unit(3, 2, 1)
+        # Allies on the enemy's other sides, so striking from where the
+        # unit stands is the best it can do
+        for (x, y) in [(4, 2), (3, 1), (3, 3)]:
+            self.place_unit(x, y, 0)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        moveTargets = self.test_map.reachable(unit) + [unit.posn()]
+        turns = TurnGenerator(battle, unit, moveTargets, [self.strike])
+        actFirst = [t for t in turns
+                    if t.turnOrder() == UnitTurn.ACT_FIRST]
+        self.assertEqual([(t.moveTarget(), t.actionTarget())
+                          for t in actFirst], [(None, (3, 2))])
+
+        def distance(posn):
+            return abs(posn[0] - 3) + abs(posn[1] - 2)
+        retreat = turns.retreat()
+        self.assertIn(retreat, moveTargets)
+        self.assertEqual(distance(retreat), max(map(distance, moveTargets)))
+
+        ai = Exhaustive(unit)
+        ai.allAbilities = lambda: [self.strike]
+        turn = ai.getTurn(battle)
+        self.assertEqual(turn.turnOrder(), UnitTurn.ACT_FIRST)
+        self.assertEqual(turn.actionTarget(), enemy.posn())
+        self.assertEqual(turn.moveTarget(), retreat)
+
+    def test_evaluators_generate_only_what_they_need(self):
+        """Test evaluators with nothing to do don't generate turns"""
+        unit = self.place_unit(2, 2, 0)
+        self.place_unit(3, 3, 0)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        moveTargets = self.test_map.reachable(unit) + [unit.posn()]
+        turns = TurnGenerator(battle, unit, moveTargets,
+                              [self.strike, self.mend])
+
+        # Nobody is wounded and there are no enemies
+        self.assertEqual(HealWeakest()(battle, unit, turns), [])
+        self.assertEqual(DamageWeakest()(battle, unit, turns), [])
+        self.assertEqual(turns.considered, 0)
+
+        moves = MoveToWeakest().moveTurns(turns)
+        self.assertEqual(len(list(moves)), len(moveTargets))
+
+    def test_budget_falls_back_to_cheapest_evaluator(self):
+        """Test a spent time budget returns the best turn found so far"""
+        unit = self.place_unit(2, 2, 0)
+        self.place_unit(6, 2, 1)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        ai = Exhaustive(unit)
+        ai.allAbilities = lambda: [self.strike]
+        turn = ai.getTurn(battle)
+        self.assertIs(turn.action(), self.strike)
+
+        unit.readyTurn()
+        # A deadline already in the past, however coarse the clock
+        with self.assertLogs('ai', level='INFO') as logs:
+            turn = ai.getTurn(battle, budget=-1.0)
+        self.assertIsNone(turn.action())
+        self.assertEqual(turn.moveTarget(), (5, 2))
+        self.assertIn('time budget hit', logs.output[-1])
+
+    def test_budget_not_hit(self):
+        """Test a generous budget gives the same kind of turn as no budget"""
+        unit = self.place_unit(2, 2, 0)
+        self.place_unit(6, 2, 1)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        ai = Exhaustive(unit)
+        ai.allAbilities = lambda: [self.strike]
+        with self.assertLogs('ai', level='INFO') as logs:
+            turn = ai.getTurn(battle, budget=60.0)
+        self.assertIs(turn.action(), self.strike)
+        self.assertIn('finished within', logs.output[-1])
+
+    def test_scripted_closes_in_and_attacks(self):
+        """Test the scripted AI walks to the nearest enemy and hits it"""
+        unit = self.place_unit(2, 2, 0)
+        self.place_unit(4, 2, 1)
+        self.place_unit(10, 10, 1)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        ai = Scripted(unit)
+        ai.allAbilities = lambda: [self.strike]
+        turn = ai.getTurn(battle)
+        self.assertIs(turn.action(), self.strike)
+        self.assertEqual(turn.actionTarget(), (4, 2))
+
+        # Out of reach: just get closer
+        unit.readyTurn()
+        ai.allAbilities = lambda: []
+        turn = ai.getTurn(battle)
+        self.assertIsNone(turn.action())
+        self.assertEqual(turn.moveTarget(), (3, 2))
+
+    def test_scripted_without_enemies(self):
+        """Test the scripted AI stays put with nobody to fight"""
+        unit = self.place_unit(2, 2, 0)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+        turn = Scripted(unit).calc(battle)
+        self.assertIsNone(turn.moveTarget())
+        self.assertIsNone(turn.action())
+        self.assertIsNone(turn.facing())
+
+    def test_batch_matches_has_effect(self):
+        """Test the whole-map effect masks agree with hasEffect"""
+        unit = self.place_unit(2, 2, 0)
+        self.place_unit(3, 3, 0)
+        self.place_unit(6, 2, 1)
+        self.place_unit(0, 11, 1)
+        for (x, y) in [(6, 3), (5, 2), (1, 11)]:
+            self.test_map.squares[x][y].z = 8
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        rush = Ability.Ability("Rush", "", 0, Ability.HOSTILE, [],
+                               Range.Cross(1, 1), Range.Line(3),
+                               [Effect.Damage()], None)
+        posns = [(x, y) for x in range(12) for y in range(12)]
+        for ability in [self.strike, self.blast, self.mend, rush]:
+            expected = [ability.hasEffect(self.test_map, unit, p)
+                        for p in posns]
+            self.assertEqual(
+                ability.hasEffectMask(self.test_map, unit, posns), expected)
+            self.assertEqual(
+                ability.affectedUnitsBatch(self.test_map, unit, posns),
+                [ability.affectedUnits(self.test_map, unit, p)
+                 for p in posns])
+        self.assertIsNone(rush.effectMask(self.test_map, unit))
+
+        # The masks follow units as they move
+        before = self.blast.effectMask(self.test_map, unit)
+        self.assertTrue(before[7, 2])
+        with TemporaryUnitPosition(self.test_map, self.units[2], 9, 9, 1):
+            after = self.blast.effectMask(self.test_map, unit)
+            self.assertFalse(after[7, 2])
+            self.assertTrue(after[9, 8])
+        self.assertIs(self.blast.effectMask(self.test_map, unit), before)
+
+    def test_query_cache(self):
+        """Test range and affectedUnits are memoized inside a QueryCache"""
+        unit = self.place_unit(2, 2, 0)
+        enemy = self.place_unit(3, 2, 1)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        unit.readyTurn()
+
+        with Ability.QueryCache() as cache:
+            squares = self.strike.range(self.test_map, unit)
+            self.assertIs(self.strike.range(self.test_map, unit), squares)
+            self.assertEqual(
+                self.strike.affectedUnits(self.test_map, unit, (3, 2)),
+                [enemy])
+            self.assertEqual(
+                self.strike.affectedUnits(self.test_map, unit, (3, 2)),
+                [enemy])
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            # Moving units changes the occupancy, so nothing stale comes
+            # back
+            with TemporaryUnitPosition(self.test_map, enemy, 3, 3, 1):
+                self.assertEqual(
+                    self.strike.affectedUnits(self.test_map, unit, (3, 2)),
+                    [])
+            self.assertEqual(
+                self.strike.affectedUnits(self.test_map, unit, (3, 2)),
+                [enemy])
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+        self.assertIsNone(Ability.QueryCache.current())
+        self.assertIsNot(self.strike.range(self.test_map, unit), squares)
+
+        ai = Exhaustive(unit)
+        ai.allAbilities = lambda: [self.strike]
+        turn = ai.getTurn(battle)
+        self.assertIs(turn.action(), self.strike)
+        self.assertGreater(ai.queryCache.hits + ai.queryCache.misses, 0)
+
+    def test_query_cache_per_thread(self):
+        """Test a cache is only seen by the thread that entered it, however
+        the threads' with blocks interleave"""
+        unit = self.place_unit(2, 2, 0)
+        steps = [threading.Event() for i in range(4)]
+        seen = {}
+
+        def first():
+            with Ability.QueryCache() as cache:
+                seen['first'] = Ability.QueryCache.current() is cache
+                steps[0].set()
+                steps[1].wait(5)
+            seen['firstAfter'] = Ability.QueryCache.current()
+            steps[2].set()
+
+        def second():
+            steps[0].wait(5)
+            with Ability.QueryCache() as cache:
+                seen['second'] = Ability.QueryCache.current() is cache
+                steps[1].set()
+                steps[2].wait(5)
+                seen['main'] = steps[3].wait(5)
+                seen['secondInside'] = Ability.QueryCache.current() is cache
+            seen['secondAfter'] = Ability.QueryCache.current()
+
+        threads = [threading.Thread(target=first),
+                   threading.Thread(target=second)]
+        for t in threads:
+            t.start()
+        steps[1].wait(5)
+        # Another thread's cache doesn't memoize this thread's queries
+        self.assertIsNone(Ability.QueryCache.current())
+        squares = self.strike.range(self.test_map, unit)
+        self.assertIsNot(self.strike.range(self.test_map, unit), squares)
+        steps[3].set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(seen, {'first': True, 'firstAfter': None,
+                                'second': True, 'main': True,
+                                'secondInside': True, 'secondAfter': None})
+        self.assertIsNone(Ability.QueryCache.current())
+
+    def test_query_cache_shared_for_moves(self):
+        """Test affectedUnits results worked out for a move-then-act turn
+        are found again by the next evaluator making the same move"""
+        unit = self.place_unit(2, 2, 0)
+        friend = self.place_unit(6, 2, 0)
+        battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        friend.damageHP(10, 0)
+        unit.readyTurn()
+
+        moveTargets = self.test_map.reachable(unit) + [unit.posn()]
+        turns = list(TurnGenerator(battle, unit, moveTargets,
+                                   [self.mend]).actionTurns())
+        moved = [t for t in turns if t.turnOrder() == UnitTurn.MOVE_FIRST]
+        self.assertTrue(moved)
+        with Ability.QueryCache() as cache:
+            first = HealWeakest()(battle, unit, moved)
+            self.assertEqual((cache.hits, cache.misses), (0, len(moved)))
+            second = HealWeakest()(battle, unit, moved)
+            self.assertEqual((cache.hits, cache.misses),
+                             (len(moved), len(moved)))
+        self.assertEqual(first, second)
+        self.assertIs(self.test_map.squares[2][2].unit, unit)
+
+class TestAIDamageEstimate(unittest.TestCase):
+    """Test batched damage estimation against the per-target calls"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.test_class = Class(
+            name="TestClass",
+            abilities=[],
+            spriteRoot="fighter",
+            move=3,
+            jump=2,
+            mhpBase=50,
+            mhpGrowth=5.0,
+            mhpMult=1.0,
+            mspBase=20,
+            mspGrowth=2.0,
+            mspMult=1.0,
+            watkBase=14,
+            watkGrowth=1.0,
+            watkMult=1.0,
+            wdefBase=9,
+            wdefGrowth=1.0,
+            wdefMult=1.0,
+            matkBase=11,
+            matkGrowth=1.0,
+            matkMult=1.0,
+            mdefBase=7,
+            mdefGrowth=1.0,
+            mdefMult=1.0,
+            speedBase=50,
+            speedGrowth=2.0,
+            speedMult=1.0
+        )
+
+    def make_unit(self, x, y, z, facing):
+        unit = self.test_class.createUnit(gender=2)
+        unit.setPosn(x, y, z)
+        unit.battleInit()
+        unit.setFacing(facing)
+        return unit
+
+    def expected(self, source, effect, posn, target):
+        source.setPosn(*posn)
+        (att, df) = effect.calcAttackAndDefense(source, target)
+        return effect.estimateDamage(att, df)
+
+    def test_matches_calc_attack_and_defense(self):
+        """Every facing, side, height difference and damage type"""
+        source = self.make_unit(5, 5, 4, 0)
+        effects = [Effect.Damage(), Effect.Damage(1.5, 1.0, Effect.SLASHING),
+                   Effect.Damage(0.8, 1.0, Effect.FIRE)]
+        targets = []
+        for facing in (0, 2, 4, 6):
+            for z in (1, 4, 9, 30):
+                targets.append(self.make_unit(5, 5, z, facing))
+        shielded = self.make_unit(5, 5, 4, 0)
+        shielded.addStatusEffect(Effect.Status.INVULNERABLE, 3, 1)
+        targets.append(shielded)
+
+        rows = []
+        for target in targets:
+            for (dx, dy) in ((0, -2), (0, 2), (-2, 0), (2, 0),
+                             (1, 3), (-3, 1), (2, 2), (0, 0)):
+                for sz in (0, 4, 12):
+                    for e in effects:
+                        rows.append((e, (5 + dx, 5 + dy, sz), target))
+
+        (es, posns, ts) = zip(*rows)
+        batched = Effect.estimateDamages(source, es, posns, ts).tolist()
+        for ((e, posn, target), damage) in zip(rows, batched):
+            self.assertEqual(damage, self.expected(source, e, posn, target))
+
+    def test_no_rows(self):
+        """No candidate turns estimate to nothing"""
+        source = self.make_unit(5, 5, 1, 0)
+        self.assertEqual(len(Effect.estimateDamages(source, [], [], [])), 0)
+
+    def test_illegal_facing(self):
+        """Physical attacks on a target with an illegal facing still fail"""
+        source = self.make_unit(5, 5, 1, 0)
+        target = self.make_unit(5, 6, 1, 1)
+        with self.assertRaises(Exception):
+            Effect.estimateDamages(source, [Effect.Damage()],
+                                   [(5, 5, 1)], [target])
+        # ...but magic doesn't look at facing
+        magic = Effect.Damage(1.0, 1.0, Effect.MAGICAL)
+        damage = Effect.estimateDamages(source, [magic], [(5, 5, 1)],
+                                        [target]).tolist()
+        self.assertEqual(damage, [self.expected(source, magic, (5, 5, 1),
+                                                target)])
+
+
+class TestAIWorker(unittest.TestCase):
+    """Test running the AI in a worker process"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.test_class = Class(
+            name="TestClass",
+            abilities=[],
+            spriteRoot="fighter",
+            move=3,
+            jump=2,
+            mhpBase=50,
+            mhpGrowth=5.0,
+            mhpMult=1.0,
+            mspBase=20,
+            mspGrowth=2.0,
+            mspMult=1.0,
+            watkBase=10,
+            watkGrowth=1.0,
+            watkMult=1.0,
+            wdefBase=10,
+            wdefGrowth=1.0,
+            wdefMult=1.0,
+            matkBase=10,
+            matkGrowth=1.0,
+            matkMult=1.0,
+            mdefBase=10,
+            mdefGrowth=1.0,
+            mdefMult=1.0,
+            speedBase=50,
+            speedGrowth=2.0,
+            speedMult=1.0
+        )
+
+        width, height = 8, 8
+        zdata = np.ones((width, height))
+        tileProperties = np.zeros((width, height), dtype=object)
+        for x in range(width):
+            for y in range(height):
+                tileProperties[x, y] = {'tag': ''}
+
+        self.test_map = Map(
+            width=width,
+            height=height,
+            z=zdata,
+            tileProperties=tileProperties,
+            globalWaterHeight=0,
+            globalWaterColor=[0.3, 0.3, 0.6],
+            tags_={}
+        )
+        self.units = []
+        for (x, y, faction) in [(1, 1, 0), (6, 6, 1)]:
+            unit = self.test_class.createUnit(gender=2)
+            unit.setPosn(x, y, 1)
+            unit.setFaction(faction)
+            self.test_map.squares[x][y].setUnit(unit)
+            self.units.append(unit)
+        self.battle = Battle([NEVER_ENDING], self.units, self.test_map)
+        self.scenario = Scenario(self.test_map, self.units, None,
+                                 self.battle, None, '')
+
+    def test_battle_state_round_trip(self):
+        """Test unit battle state can be diffed and applied"""
+        (unit, other) = self.units
+        old = unit.battleState()
+        unit.setCT(250)
+        unit.addDefender(other)
+        delta = UnitModule.stateDelta(old, unit.battleState())
+        self.assertEqual(set(delta), set(['_ct', '_defenders']))
+
+        copy_ = self.test_class.createUnit(gender=2)
+        copy_.setBattleState(unit.battleState(),
+                             {other.unitID: other}.get)
+        self.assertEqual(copy_.battleState(), unit.battleState())
+
+    def test_unit_turn_tuple(self):
+        """Test turns survive conversion to plain tuples"""
+        attack = self.units[0].attack()
+        turn = UnitTurn(UnitTurn.MOVE_FIRST, (2, 1), attack, (3, 1), 2)
+        copy_ = UnitTurn.fromTuple(turn.asTuple())
+        self.assertIs(copy_.action(), attack)
+        self.assertEqual(copy_.asTuple(), turn.asTuple())
+
+    def test_worker_calc(self):
+        """Test the worker process follows the battle and picks a turn"""
+        worker = AIWorker(self.scenario)
+        try:
+            (unit, enemy) = self.units
+            self.assertEqual(worker.delta(), ({}, None))
+
+            # Move the enemy next to the unit; only that gets sent
+            self.test_map.squares[6][6].unit = None
+            self.test_map.squares[1][2].unit = enemy
+            enemy.setPosn(1, 2, 1)
+            unit.readyTurn()
+            future = worker.calc(unit)
+            turn = UnitTurn.fromTuple(future.result(timeout=120))
+            self.assertIs(turn.action(), unit.attack())
+            self.assertEqual(turn.actionTarget(), (1, 2))
+            self.assertEqual(worker.delta(), ({}, None))
+        finally:
+            worker.close()
+
+
 if __name__ == '__main__':
     unittest.main()
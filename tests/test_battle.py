@@ -4,11 +4,13 @@ Unit tests for the Battle class
 import unittest
 import sys
 import os
+import copy
+import pickle
 
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from engine.Battle import Battle
+from engine.Battle import Battle, NEVER_ENDING
 from engine.Unit import Unit
 from engine.Class import Class
 from engine.Map import Map
@@ -137,6 +139,142 @@ class TestBattle(unittest.TestCase):
         # Status is either ongoing or won, depending on ending condition logic
         self.assertIn(status, [-1, 0])
 
+    def test_census(self):
+        """Units keep the count of the living per faction up to date"""
+        from engine.Battle import (DEFEAT_ALL_ENEMIES, PLAYER_DEFEATED,
+                                   LAST_TEAM_STANDING)
+        units = []
+        for faction in (0, 1, 1):
+            unit = self.test_class.createUnit(gender=2)
+            unit.setFaction(faction)
+            units.append(unit)
+        battle = Battle([NEVER_ENDING], units, self.test_map)
+        census = battle.census()
+        self.assertEqual((census.alive(0), census.alive(1)), (1, 2))
+        self.assertIs(battle.unitFromID(units[2].unitID), units[2])
+        self.assertIsNone(battle.unitFromID(-1))
+        self.assertEqual(battle.status(), -1)
+
+        units[1].damageHP(units[1].hp(), 0)
+        units[1].damageHP(5, 0)
+        self.assertEqual(census.alive(1), 1)
+        self.assertFalse(DEFEAT_ALL_ENEMIES(battle))
+        units[2].damageHP(units[2].hp() + 10, 0)
+        self.assertEqual(census.factions(), [0])
+        self.assertEqual(battle.status(), 0)
+        self.assertTrue(DEFEAT_ALL_ENEMIES(battle))
+        self.assertFalse(PLAYER_DEFEATED(battle))
+
+        # A copy counts its own units, including changes sent to them
+        other = pickle.loads(pickle.dumps(battle))
+        other.unitFromID(units[2].unitID).setBattleState({'_alive': True},
+                                                         other.unitFromID)
+        self.assertEqual(other.census().alive(1), 1)
+        self.assertEqual(census.alive(1), 0)
+
+        units[0].damageHP(units[0].hp(), 0)
+        self.assertTrue(PLAYER_DEFEATED(battle))
+        self.assertIsNone(LAST_TEAM_STANDING(battle))
+
+
+class TickingBattle(Battle):
+    """Charges CT one tick at a time, the way Battle used to"""
+
+    def _step(self):
+        self._steps += 1
+        self._ctCharging()
+        return self._activeTimeResolution()
+
+    def pickNextUnit(self):
+        self.unitQueue = [u for u in self.unitQueue if u.active()]
+        while not self.unitQueue:
+            self.unitQueue = self._step()
+        return Battle.pickNextUnit(self)
+
+
+class TestTurnOrder(unittest.TestCase):
+    """Test the CT scheduler against charging tick by tick"""
+
+    setUp = TestBattle.setUp
+
+    def make_units(self):
+        units = []
+        # Ties in speed and CT, so the roster order has to break them
+        for (speed, ct) in [(70, 0), (55, 400), (70, 0), (90, 120),
+                            (40, 999), (55, 400)]:
+            unit = self.test_class.createUnit(gender=2)
+            unit.setFaction(len(units) % 2)
+            unit.battleInit()
+            unit._speed = speed
+            unit.setCT(ct)
+            units.append(unit)
+        return units
+
+    def play(self, battle, turns):
+        """Take turns, moving and acting on some, and kill a unit half
+        way. @return: (unit index, CTs after picking) for each turn."""
+        units = battle.units()
+        result = []
+        for turn in range(turns):
+            u = battle.pickNextUnit()
+            result.append((units.index(u), [v.ct() for v in units]))
+            if turn % 3 == 0:
+                u.setCT(u.ct() - 300)
+            if turn % 2 == 0:
+                u.setCT(u.ct() - 200)
+            if turn == turns // 2:
+                units[3].damageHP(units[3].hp(), 0)
+            battle.unitDone()
+        return result
+
+    def test_matches_ticking(self):
+        units = self.make_units()
+        ticking = TickingBattle([NEVER_ENDING], copy.deepcopy(units),
+                                self.test_map)
+        battle = Battle([NEVER_ENDING], units, self.test_map)
+        expected = self.play(ticking, 60)
+        self.assertEqual(self.play(battle, 60), expected)
+        self.assertEqual(battle._steps, ticking._steps)
+        self.assertEqual([u.speed() for u in units], [70, 55, 70, 90, 40, 55])
+        self.assertEqual(battle.turns(), 60)
+
+    def test_forecast(self):
+        """The forecast is the order units then take their turns in, if
+        they just wait, and changes nothing"""
+        units = self.make_units()
+        battle = Battle([NEVER_ENDING], units, self.test_map)
+        for turn in range(5):
+            battle.pickNextUnit()
+            battle.unitDone()
+        battle.pickNextUnit()
+        states = [u.battleState() for u in units]
+        queue = list(battle.unitQueue)
+        forecast = battle.forecastTurnOrder(20)
+        self.assertEqual(battle.forecastTurnOrder(20), forecast)
+        self.assertEqual([u.battleState() for u in units], states)
+        self.assertEqual(battle.unitQueue, queue)
+
+        battle.unitDone()
+        taken = []
+        for turn in range(20):
+            taken.append(battle.pickNextUnit())
+            battle.unitDone()
+        self.assertEqual(taken, forecast)
+
+    def test_forecast_without_units(self):
+        unit = self.make_units()[0]
+        battle = Battle([NEVER_ENDING], [unit], self.test_map)
+        self.assertEqual(battle.forecastTurnOrder(3), [unit] * 3)
+        unit.damageHP(unit.hp(), 0)
+        self.assertEqual(battle.forecastTurnOrder(3), [])
+
+    def test_nobody_alive(self):
+        unit = self.make_units()[0]
+        battle = Battle([NEVER_ENDING], [unit], self.test_map)
+        unit.damageHP(unit.hp(), 0)
+        with self.assertLogs('batt', level='ERROR'):
+            self.assertIsNone(battle.pickNextUnit())
+
 
 if __name__ == '__main__':
     unittest.main()
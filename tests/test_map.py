@@ -8,9 +8,16 @@ import os
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from engine.Map import Map, MapSquare
+from engine.Map import Map, MapSquare, connected
+from engine.Map import MapPack, MapCache, MapFile
+import engine.Map as MapModule
+from engine import MapParser
+import glob
+import tempfile
 from engine.Unit import Unit
 from engine.Class import Class
+from ai.UnitAI import TemporaryUnitPosition
+from engine import Range
 import numpy as np
 
 
@@ -246,15 +253,20 @@ class TestMapPathfinding(unittest.TestCase):
         unit.battleInit()
         map_obj.squares[5][5].unit = unit
 
+        for column in map_obj.squares:
+            for sq in column:
+                sq.z = 1
+
         # Fill distances to target
         target_posn = (7, 7)
-        map_obj.fillDistances(unit, target_posn)
+        search = map_obj.fillDistances(unit, target_posn)
+
+        # Target square should be at distance 0
+        self.assertEqual(search.distance(7, 7), 0)
+        self.assertEqual(search.distance(5, 5), 4)
 
-        # Check that search costs are set
-        # Target square should have search cost 0
-        target_square = map_obj.squares[7][7]
-        self.assertIsNotNone(target_square.search)
-        self.assertEqual(target_square.search[0], 0)
+        # The squares themselves are left alone
+        self.assertIsNone(map_obj.squares[7][7].search)
 
     def test_shortest_path(self):
         """Test shortest path calculation"""
@@ -265,20 +277,25 @@ class TestMapPathfinding(unittest.TestCase):
         unit.battleInit()
         map_obj.squares[5][5].unit = unit
 
+        for column in map_obj.squares:
+            for sq in column:
+                sq.z = 1
+
         # Fill distances first
         target_posn = (7, 7)
-        map_obj.fillDistances(unit, target_posn)
+        search = map_obj.fillDistances(unit, target_posn)
 
         # Get shortest path
-        path = map_obj.shortestPath(7, 7)
+        path = map_obj.shortestPath(5, 5, search)
 
         # Should return a list of squares
         self.assertIsInstance(path, list)
         self.assertGreater(len(path), 0)
 
-        # First element should be the target
-        self.assertEqual(path[0].x, 7)
-        self.assertEqual(path[0].y, 7)
+        # From the requested square back to the search start
+        self.assertEqual(path[0].posn2d(), (5, 5))
+        self.assertEqual(path[-1].posn2d(), (7, 7))
+        self.assertEqual(len(path), 5)
 
 
 class TestMapGeneration(unittest.TestCase):
@@ -425,5 +442,750 @@ class TestMapBFS(unittest.TestCase):
             self.assertLessEqual(square.search[0], max_distance)
 
 
+class TestMapGrid(unittest.TestCase):
+    """Test the array-backed grid kept in sync with the map squares"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.test_class = Class(
+            name="TestClass",
+            abilities=[],
+            spriteRoot="fighter",
+            move=5,
+            jump=2,
+            mhpBase=50,
+            mhpGrowth=5.0,
+            mhpMult=1.0,
+            mspBase=20,
+            mspGrowth=2.0,
+            mspMult=1.0,
+            watkBase=10,
+            watkGrowth=1.0,
+            watkMult=1.0,
+            wdefBase=10,
+            wdefGrowth=1.0,
+            wdefMult=1.0,
+            matkBase=10,
+            matkGrowth=1.0,
+            matkMult=1.0,
+            mdefBase=10,
+            mdefGrowth=1.0,
+            mdefMult=1.0,
+            speedBase=50,
+            speedGrowth=2.0,
+            speedMult=1.0
+        )
+
+    def create_test_map(self, width=6, height=4):
+        """Helper to create a map with varied heights and some water"""
+        zdata = np.zeros((width, height))
+        tileProperties = np.zeros((width, height), dtype=object)
+        for x in range(width):
+            for y in range(height):
+                zdata[x, y] = x + 2 * y
+                tileProperties[x, y] = {'tag': ''}
+        tileProperties[1, 1]['waterHeight'] = 12
+        return Map(
+            width=width,
+            height=height,
+            z=zdata,
+            tileProperties=tileProperties,
+            globalWaterHeight=0,
+            globalWaterColor=[0.3, 0.3, 0.6],
+            tags_={}
+        )
+
+    def assertGridMatchesSquares(self, map_obj):
+        grid = map_obj.grid
+        for x in range(map_obj.width):
+            for y in range(map_obj.height):
+                sq = map_obj.squares[x][y]
+                self.assertEqual(grid.z[x, y], sq.z)
+                self.assertEqual(grid.waterHeight[x, y], sq.waterHeight)
+                self.assertEqual(list(grid.cornerHeights[x, y]),
+                                 list(sq.cornerHeights))
+                expected = -1 if sq.unit is None else sq.unit.unitID
+                self.assertEqual(grid.unitID[x, y], expected)
+
+    def test_grid_initialized_from_squares(self):
+        """Test the grid arrays mirror the squares after construction"""
+        map_obj = self.create_test_map()
+        self.assertEqual(map_obj.grid.z.shape, (6, 4))
+        self.assertGridMatchesSquares(map_obj)
+
+    def test_grid_tracks_units(self):
+        """Test occupancy follows setUnit and direct square assignment"""
+        map_obj = self.create_test_map()
+        unit = self.test_class.createUnit(gender=2)
+        version = map_obj.grid.occupancyVersion
+
+        map_obj.squares[2][3].setUnit(unit)
+        self.assertEqual(map_obj.grid.unitID[2, 3], unit.unitID)
+        self.assertIs(map_obj.grid.unitAt(2, 3), unit)
+        self.assertGreater(map_obj.grid.occupancyVersion, version)
+
+        map_obj.squares[2][3].unit = None
+        map_obj.squares[0][1].unit = unit
+        self.assertEqual(map_obj.grid.unitID[2, 3], -1)
+        self.assertEqual(map_obj.grid.unitID[0, 1], unit.unitID)
+        self.assertEqual(map_obj.grid.occupants(), [((0, 1), unit)])
+
+    def test_grid_tracks_terrain_edits(self):
+        """Test height, corner and water edits are mirrored"""
+        map_obj = self.create_test_map()
+        version = map_obj.grid.terrainVersion
+
+        map_obj.squares[3][2].plusHeight(2)
+        map_obj.squares[4][1].minusHeight()
+        map_obj.squares[0][0].z = 9
+        map_obj.squares[5][3].waterHeight += 1
+        map_obj.changeCorner(1, 2, 3, 2)
+
+        self.assertGreater(map_obj.grid.terrainVersion, version)
+        self.assertGridMatchesSquares(map_obj)
+
+    def test_walkable_mask(self):
+        """Test walkable excludes holes and deeply flooded squares"""
+        map_obj = self.create_test_map()
+        walkable = map_obj.grid.walkable()
+
+        # z == 0 is a hole
+        self.assertFalse(walkable[0, 0])
+        # (1, 1) has z = 3 under water height 12
+        self.assertFalse(walkable[1, 1])
+        for x in range(map_obj.width):
+            for y in range(map_obj.height):
+                sq = map_obj.squares[x][y]
+                self.assertEqual(walkable[x, y],
+                                 sq.z != 0 and sq.z + 4 >= sq.waterHeight)
+
+        map_obj.squares[0][0].z = 4
+        self.assertTrue(map_obj.grid.walkable()[0, 0])
+
+    def test_filter_squares(self):
+        """Test vectorized bounds and height-difference filtering"""
+        map_obj = self.create_test_map()
+        xs = [-1, 0, 2, 5, 6, 3]
+        ys = [0, 0, 1, 3, 0, 3]
+
+        fx, fy = map_obj.grid.filterSquares(xs, ys)
+        self.assertEqual(list(zip(fx.tolist(), fy.tolist())),
+                         [(0, 0), (2, 1), (5, 3), (3, 3)])
+
+        # z values: (0,0)=0, (2,1)=4, (5,3)=11, (3,3)=9
+        fx, fy = map_obj.grid.filterSquares(xs, ys, z=4, zdiff=5)
+        self.assertEqual(list(zip(fx.tolist(), fy.tolist())),
+                         [(0, 0), (2, 1), (3, 3)])
+
+
+class TestRange(unittest.TestCase):
+    """Test range templates against listing the squares one by one"""
+
+    setUp = TestMapGrid.setUp
+    create_test_map = TestMapGrid.create_test_map
+
+    def reference(self, rng, map_obj, unit, pos):
+        """The squares in range, listed the way Range used to"""
+        (x, y, z) = pos
+        (shape, zdiff) = (rng, rng._zdiff)
+        if isinstance(rng, Range.DiamondExtend):
+            shape = unit.attack().rangeObject()
+            zdiff = shape._zdiff
+        squares = {}
+        if isinstance(shape, Range.Single):
+            squares[(x, y)] = True
+        elif isinstance(shape, Range.Line):
+            (dx, dy) = (x - unit.x(), y - unit.y())
+            if (dx == 0) != (dy == 0):
+                (dx, dy) = ((dx > 0) - (dx < 0), (dy > 0) - (dy < 0))
+                for i in range(shape._length):
+                    squares[(x + dx * i, y + dy * i)] = True
+        else:
+            (low, high) = (shape._min, shape._max)
+            if shape is not rng:
+                high += rng._amount
+            if isinstance(shape, Range.Cross):
+                for i in range(low, high + 1):
+                    for (sx, sy) in ((i, 0), (-i, 0), (0, i), (0, -i)):
+                        squares[(x + sx, y + sy)] = True
+            else:
+                for i in range(0, high + 1):
+                    for j in range(0, high + 1 - i):
+                        if low <= i + j <= high:
+                            for (sx, sy) in ((j, i), (j, -i), (-j, i),
+                                             (-j, -i)):
+                                squares[(x + sx, y + sy)] = True
+        return [(sx, sy) for (sx, sy) in squares
+                if map_obj.squareExists(sx, sy) and
+                abs(map_obj.squares[sx][sy].z - z) <= zdiff]
+
+    def test_matches_reference(self):
+        map_obj = self.create_test_map(9, 7)
+        unit = self.test_class.createUnit(gender=2)
+        unit.setPosn(4, 3, map_obj.squares[4][3].z)
+        ranges = [Range.Single(), Range.Line(3), Range.Cross(1, 2),
+                  Range.Cross(0, 3, 2), Range.Diamond(0, 1),
+                  Range.Diamond(2, 4, 3), Range.DiamondExtend(2),
+                  # Big enough to be filtered with NumPy
+                  Range.Diamond(0, 6, 4), Range.Cross(0, 12)]
+        for rng in ranges:
+            for x in range(-1, 10):
+                for y in range(-1, 8):
+                    if map_obj.squareExists(x, y):
+                        z = map_obj.squares[x][y].z
+                    else:
+                        z = 5
+                    self.assertEqual(rng(map_obj, unit, (x, y, z)),
+                                     self.reference(rng, map_obj, unit,
+                                                    (x, y, z)),
+                                     (rng, x, y))
+
+    def test_templates_are_shared_and_read_only(self):
+        a = Range.Diamond(1, 3).offsets(None, (0, 0, 0))
+        self.assertIs(Range.Diamond(1, 3).offsets(None, (5, 5, 0)), a)
+        self.assertFalse(a.flags.writeable)
+        # The order squares were always listed in
+        self.assertEqual(Range.Cross(1, 1).offsets(None, None).tolist(),
+                         [[1, 0], [-1, 0], [0, 1], [0, -1]])
+
+    def test_unknown_height(self):
+        """Without a usable z, only the map's edges limit the range"""
+        map_obj = self.create_test_map()
+        self.assertEqual(sorted(Range.Cross(1, 1)(map_obj, None,
+                                                  (0, 0, object()))),
+                         [(0, 1), (1, 0)])
+        expected = sorted([(x, 0) for x in range(1, 6)] +
+                          [(0, y) for y in range(1, 4)])
+        self.assertEqual(sorted(Range.Cross(1, 20)(map_obj, None,
+                                                   (0, 0, object()))),
+                         expected)
+
+
+class TestMapSearch(unittest.TestCase):
+    """Test the array-based movement search against the square-based bfs"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.test_class = Class(
+            name="TestClass",
+            abilities=[],
+            spriteRoot="fighter",
+            move=4,
+            jump=2,
+            mhpBase=50,
+            mhpGrowth=5.0,
+            mhpMult=1.0,
+            mspBase=20,
+            mspGrowth=2.0,
+            mspMult=1.0,
+            watkBase=10,
+            watkGrowth=1.0,
+            watkMult=1.0,
+            wdefBase=10,
+            wdefGrowth=1.0,
+            wdefMult=1.0,
+            matkBase=10,
+            matkGrowth=1.0,
+            matkMult=1.0,
+            mdefBase=10,
+            mdefGrowth=1.0,
+            mdefMult=1.0,
+            speedBase=50,
+            speedGrowth=2.0,
+            speedMult=1.0
+        )
+
+    def create_test_map(self, width=12, height=9):
+        """Helper to create a hilly map with a hole and a lake"""
+        zdata = np.zeros((width, height))
+        tileProperties = np.zeros((width, height), dtype=object)
+        for x in range(width):
+            for y in range(height):
+                zdata[x, y] = 1 + (x * 2 + y) % 4
+                tileProperties[x, y] = {'tag': ''}
+        zdata[4, 4] = 0
+        tileProperties[7, 2]['waterHeight'] = 12
+        return Map(
+            width=width,
+            height=height,
+            z=zdata,
+            tileProperties=tileProperties,
+            globalWaterHeight=0,
+            globalWaterColor=[0.3, 0.3, 0.6],
+            tags_={}
+        )
+
+    def place_unit(self, map_obj, x, y, faction):
+        unit = self.test_class.createUnit(gender=2)
+        unit.setFaction(faction)
+        unit.setPosn(x, y, map_obj.squares[x][y].z)
+        unit.battleInit()
+        map_obj.squares[x][y].setUnit(unit)
+        return unit
+
+    def bfs_reachable(self, map_obj, unit):
+        """Reference implementation on top of Map.bfs"""
+        def visit(s):
+            return (s.search[0] <= unit.move() and
+                    connected(s.search[1], s, unit))
+        expand = map_obj.getPotentialConnections
+        result = map_obj.bfs(unit.posn(), expand, visit,
+                             lambda s: s.unit == None)
+        return [(s.x, s.y) for s in result]
+
+    def test_reachable_matches_bfs(self):
+        """Test reachable finds the same squares as the old search"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 5, 4, 0)
+        self.place_unit(map_obj, 6, 4, 0)
+        self.place_unit(map_obj, 5, 5, 1)
+        dead = self.place_unit(map_obj, 4, 3, 1)
+        dead._alive = False
+
+        expected = self.bfs_reachable(map_obj, unit)
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(sorted(map_obj.reachable(unit)), sorted(expected))
+
+    def test_reachable_sorted_by_distance(self):
+        """Test reachable lists closer squares first"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 2, 2, 0)
+        search = map_obj.search(unit, unit.posn(), unit.move())
+        distances = [search.distance(x, y) for (x, y)
+                     in map_obj.reachable(unit)]
+        self.assertEqual(distances, sorted(distances))
+        self.assertLessEqual(max(distances), unit.move())
+
+    def test_search_leaves_squares_alone(self):
+        """Test searching does not write into MapSquare.search"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 5, 4, 0)
+        map_obj.reachable(unit)
+        map_obj.fillDistances(unit, (0, 0))
+        for column in map_obj.squares:
+            for sq in column:
+                self.assertIsNone(sq.search)
+
+    def test_path_follows_connected_steps(self):
+        """Test every step of a shortest path is a legal move"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 1, 1, 0)
+        search = map_obj.fillDistances(unit, unit.posn())
+        (x, y) = max(search.positions(), key=lambda p: search.distance(*p))
+
+        path = map_obj.shortestPath(x, y, search)
+        self.assertEqual(path[0].posn2d(), (x, y))
+        self.assertEqual(path[-1].posn2d(), (1, 1))
+        self.assertEqual(len(path), search.distance(x, y) + 1)
+        for (a, b) in zip(path[1:], path[:-1]):
+            self.assertTrue(connected(a, b, unit, True))
+
+    def test_unreached_square(self):
+        """Test squares the search cannot get to"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 1, 1, 0)
+        search = map_obj.fillDistances(unit, unit.posn())
+        self.assertIsNone(search.distance(4, 4))
+        self.assertFalse(search.reached(7, 2))
+        self.assertRaises(ValueError, map_obj.shortestPath, 4, 4, search)
+
+    def test_reachable_cached(self):
+        """Test repeated reachable queries reuse the cached result"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 2, 2, 0)
+
+        first = map_obj.reachable(unit)
+        first.append((99, 99))
+        self.assertEqual(len(map_obj._reachableCache), 1)
+        self.assertNotIn((99, 99), map_obj.reachable(unit))
+        self.assertEqual(len(map_obj._reachableCache), 1)
+
+        # Blocking a square invalidates the cached range
+        self.assertIn((3, 2), map_obj.reachable(unit))
+        self.place_unit(map_obj, 3, 2, 1)
+        self.assertNotIn((3, 2), map_obj.reachable(unit))
+
+    def test_reachable_cache_follows_deaths(self):
+        """Test a unit dying in place stops blocking after the version bump"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 2, 2, 0)
+        enemy = self.place_unit(map_obj, 3, 2, 1)
+        before = map_obj.reachable(unit)
+
+        enemy.damageHP(enemy.hp(), 0)
+        map_obj.grid.occupancyChanged()
+        self.assertEqual(sorted(map_obj.reachable(unit)),
+                         sorted(self.bfs_reachable(map_obj, unit)))
+        self.assertGreaterEqual(len(map_obj.reachable(unit)), len(before))
+
+    def test_temporary_position_restores_version(self):
+        """Test simulated moves leave the occupancy version as they found it"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 2, 2, 0)
+        grid = map_obj.grid
+        version = grid.occupancyVersion
+
+        with TemporaryUnitPosition(map_obj, unit, 3, 3, 0):
+            self.assertNotEqual(grid.occupancyVersion, version)
+            with TemporaryUnitPosition(map_obj, unit, 4, 3, 0):
+                pass
+        self.assertEqual(grid.occupancyVersion, version)
+
+        # A real change made meanwhile is kept
+        with TemporaryUnitPosition(map_obj, unit, 3, 3, 0):
+            self.place_unit(map_obj, 0, 0, 1)
+        self.assertGreater(grid.occupancyVersion, version)
+
+    def test_steps_match_connected(self):
+        """Test the cached terrain connectivity agrees with connected"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 2, 2, 0)
+        steps = map_obj.grid.steps(unit.jump())
+        self.assertIs(map_obj.grid.steps(unit.jump()), steps)
+
+        offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        for x in range(map_obj.width):
+            for y in range(map_obj.height):
+                for ((dx, dy), mask) in zip(offsets, steps):
+                    if not map_obj.squareExists(x + dx, y + dy):
+                        self.assertFalse(mask[x, y])
+                        continue
+                    sq1 = map_obj.squares[x][y]
+                    sq2 = map_obj.squares[x + dx][y + dy]
+                    self.assertEqual(mask[x, y],
+                                     connected(sq1, sq2, unit, True))
+
+        # Terrain edits throw the cached masks away
+        map_obj.squares[0][0].plusHeight(3)
+        self.assertIsNot(map_obj.grid.steps(unit.jump()), steps)
+
+    def test_closest_units(self):
+        """Test closestUnits returns squares next to the given faction"""
+        map_obj = self.create_test_map()
+        unit = self.place_unit(map_obj, 1, 1, 0)
+        self.place_unit(map_obj, 2, 7, 1)
+
+        squares = map_obj.closestUnits(unit, 1)
+        self.assertGreater(len(squares), 0)
+        for sq in squares:
+            neighbors = map_obj.getPotentialConnections(sq)
+            self.assertTrue(any(n.unit != None and n.unit.faction() == 1
+                                for n in neighbors))
+
+
+class TestMapPack(unittest.TestCase):
+    """Test the binary map transfer format and the map cache"""
+
+    def create_test_map(self):
+        """Helper to create a map with tags, smoothing and water"""
+        width, height = 7, 5
+        zdata = np.zeros((width, height))
+        tileProperties = np.zeros((width, height), dtype=object)
+        for x in range(width):
+            for y in range(height):
+                zdata[x, y] = 2 + (x * 3 + y) % 5
+                tileProperties[x, y] = {'tag': ['grass', 'hill', ''][x % 3]}
+        tileProperties[1, 1]['cornerHeights'] = [1, -1, 0.5, 0]
+        tileProperties[2, 3]['waterHeight'] = 9
+        tags = {'grass': {'name': 'grass', 'color': (0.2, 0.8, 0.2),
+                          'colorVar': (0.1, 0.1, 0.0)},
+                'hill': {'name': 'hill', 'smooth': True,
+                         'color': [(0.5, 0.4, 0.3), (0.3, 0.2, 0.1)],
+                         'waterColor': [0.1, 0.2, 0.9]}}
+        return Map(width, height, zdata, tileProperties, 1,
+                   [0.3, 0.3, 0.6], tags)
+
+    def assertSameMap(self, a, b):
+        self.assertEqual((a.width, a.height), (b.width, b.height))
+        self.assertEqual(a.tags, b.tags)
+        for x in range(a.width):
+            for y in range(a.height):
+                sa = a.squares[x][y]
+                sb = b.squares[x][y]
+                for attr in ('z', 'cornerHeights', 'waterHeight',
+                             'waterColor', 'smooth', 'tag'):
+                    self.assertEqual(getattr(sa, attr), getattr(sb, attr),
+                                     (x, y, attr))
+                self.assertEqual(len(sb.color), 5)
+        self.assertTrue(np.array_equal(a.grid.z, b.grid.z))
+        self.assertTrue(np.array_equal(a.grid.tag, b.grid.tag))
+
+    def test_round_trip(self):
+        """Unpacking gives the same terrain and the same hash"""
+        m = self.create_test_map()
+        (digest, data) = MapPack.pack(m)
+        m2 = MapPack.unpack(data)
+        self.assertSameMap(m, m2)
+        self.assertEqual(MapPack.pack(m2)[0], digest)
+        self.assertEqual(MapPack.contentHash(data), digest)
+
+    def test_hash_follows_content(self):
+        """Any terrain change changes the hash"""
+        m = self.create_test_map()
+        (digest, data) = MapPack.pack(m)
+        m.squares[3][2].plusHeight()
+        self.assertNotEqual(MapPack.pack(m)[0], digest)
+
+    def test_bad_data(self):
+        """Data that isn't a packed map is refused"""
+        with self.assertRaises(ValueError):
+            MapPack.unpack(b'not a map at all')
+
+    def test_copy_sends_hash_only_when_client_has_map(self):
+        """Clients that have the map get its hash, others get the map"""
+        m = self.create_test_map()
+        (digest, data) = MapPack.pack(m)
+
+        class Perspective(object):
+            mapHashes = set()
+        perspective = Perspective()
+        self.assertIn('data', m.getStateToCopyFor(perspective))
+        perspective.mapHashes = set([digest])
+        self.assertEqual(m.getStateToCopyFor(perspective), {'hash': digest})
+
+    def test_packed_once(self):
+        """The map is packed once for every client it is sent to, and
+        again only after the terrain changes"""
+        m = self.create_test_map()
+        class Perspective(object):
+            mapHashes = set()
+        first = m.getStateToCopyFor(Perspective())
+        self.assertIs(m.getStateToCopyFor(Perspective())['data'],
+                      first['data'])
+        self.assertEqual(m.packed(), MapPack.pack(m))
+        m.squares[3][2].plusHeight()
+        self.assertNotEqual(m.getStateToCopyFor(Perspective())['hash'],
+                            first['hash'])
+        self.assertEqual(m.packed(), MapPack.pack(m))
+
+    def test_copy_from_cache(self):
+        """A map copied by hash alone comes out of the cache"""
+        oldCache = MapModule.mapCache
+        MapModule.mapCache = MapCache()
+        try:
+            m = self.create_test_map()
+            state = m.getStateToCopy()
+            copy = Map.__new__(Map)
+            with self.assertRaises(ValueError):
+                copy.setCopyableState({'hash': state['hash']})
+            copy.setCopyableState(state)
+            self.assertIn(state['hash'], MapModule.mapCache.hashes())
+            copy2 = Map.__new__(Map)
+            copy2.setCopyableState({'hash': state['hash']})
+            self.assertSameMap(m, copy2)
+            # Tampered maps are refused
+            with self.assertRaises(ValueError):
+                Map.__new__(Map).setCopyableState(
+                    {'hash': '0' * 64, 'data': state['data']})
+        finally:
+            MapModule.mapCache = oldCache
+
+    def test_cache_on_disk(self):
+        """Maps put in the cache are there for the next run"""
+        m = self.create_test_map()
+        (digest, data) = MapPack.pack(m)
+        with tempfile.TemporaryDirectory() as directory:
+            MapCache(directory).put(digest, data)
+            cache = MapCache(directory)
+            self.assertEqual(cache.hashes(), [digest])
+            self.assertEqual(cache.get(digest), data)
+            self.assertIsNone(cache.get('f' * 64))
+
+
+class TestMapIO(unittest.TestCase):
+    """Test loading maps from map file text"""
+
+    MAP = """
+# Constants may be used by the assignments after them
+height = 2
+raised = (height, 0, -height * 2, 0)
+
+VERSION = 1
+WIDTH = 4
+HEIGHT = 3
+WATER_HEIGHT = 1
+TILE_PROPERTIES = {
+    'g': {'color': (0.5, 0.7, 0.5), 'texture': 'grass',
+          'cornerHeights': raised},
+    '': {'color': (0.4, 0.4, 0.4)},
+}
+LAYOUT = '''
+4 5g   6[0, 1, -2, 3.5]wh3g  7wh9
+1  2
+
+'''
+"""
+
+    def test_load_string(self):
+        """Tiles may be one or more blanks apart, short rows are padded"""
+        m = MapModule.MapIO.loadString('test', self.MAP)
+        self.assertEqual((m.width, m.height), (4, 3))
+        self.assertEqual(m.tags['g']['cornerHeights'], (2, 0, -4, 0))
+        self.assertEqual([m.squares[x][0].z for x in range(4)], [4, 5, 6, 7])
+        self.assertEqual([m.squares[x][0].tagName() for x in range(4)],
+                         ['', 'g', 'g', ''])
+        self.assertEqual(m.squares[1][0].cornerHeights, [2, 0, -4, 0])
+        self.assertEqual(m.squares[2][0].cornerHeights, [0, 1, -2, 3])
+        self.assertEqual(m.squares[2][0].waterHeight, 3)
+        self.assertEqual(m.squares[3][0].waterHeight, 9)
+        self.assertEqual([m.squares[x][1].z for x in range(4)], [1, 2, 0, 0])
+        self.assertEqual([m.squares[x][2].z for x in range(4)], [0] * 4)
+
+    def test_layout_arrays(self):
+        """The layout is read into typed [x, y] arrays"""
+        layout = MapParser.parseLayout("1 2a\n3wh4 5[1,2,3,4]a\n", 2, 2)
+        self.assertEqual(layout.z.tolist(), [[1, 3], [2, 5]])
+        self.assertEqual([layout.tagNames[t] for t in layout.tag.ravel()],
+                         ['', '', 'a', 'a'])
+        self.assertEqual(layout.hasWaterHeight.tolist(),
+                         [[False, True], [False, False]])
+        self.assertEqual(layout.waterHeight[0, 1], 4)
+        self.assertEqual(layout.cornerHeights[1, 1].tolist(), [1, 2, 3, 4])
+        self.assertEqual(layout.hasCornerHeights.sum(), 1)
+        self.assertEqual(layout.paddedRows, 0)
+
+    def test_save_and_load(self):
+        """A saved map loads back the same"""
+        m = MapModule.MapIO.loadString('test', self.MAP)
+        m2 = MapModule.MapIO.loadString('saved', m.loadString())
+        for x in range(m.width):
+            for y in range(m.height):
+                for attr in ('z', 'cornerHeights', 'waterHeight', 'tag'):
+                    self.assertEqual(getattr(m.squares[x][y], attr),
+                                     getattr(m2.squares[x][y], attr))
+
+    def test_rejects_bad_maps(self):
+        """Map files can't run code, and bad tiles are reported"""
+        for text in ["X = __import__('os').getcwd()",
+                     "import os",
+                     "X = undefined",
+                     "X = 'a' * 3"]:
+            with self.assertRaises(ValueError):
+                MapModule.MapIO.loadString('bad', text)
+        bad = self.MAP.replace('7wh9', '7-x')
+        with self.assertRaisesRegex(ValueError, r'\(3,0\)'):
+            MapModule.MapIO.loadString('bad', bad)
+        with self.assertRaises(ValueError):
+            MapParser.parseLayout("1\n2\n3\n", 1, 2)
+
+    def test_shipped_maps(self):
+        """Every shipped map loads"""
+        pattern = os.path.join(os.path.dirname(__file__), '..', 'src',
+                               'data', '*', 'maps', '*.py')
+        files = glob.glob(pattern)
+        self.assertTrue(files)
+        for f in files:
+            m = MapModule.MapIO.load(f)
+            self.assertGreater(m.grid.z.max(), 0, f)
+
+
+class TestMapFile(unittest.TestCase):
+    """Test the binary map file format"""
+
+    def setUp(self):
+        self.maps = os.path.join(os.path.dirname(__file__), '..', 'src',
+                                 'data', 'demo', 'maps')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_round_trip(self):
+        """A binary map loads the same as the text map it came from"""
+        import mapconvert
+        for name in ('castle.py', 'lake.py', 'sloping-hills.py'):
+            filename = os.path.join(self.maps, name)
+            output = mapconvert.convert(filename, self.directory.name)
+            self.assertTrue(output.endswith(MapFile.SUFFIX))
+            m = MapModule.MapIO.load(output)
+            self.assertTrue(mapconvert.sameMap(m, MapFile.load(output)))
+            text = MapModule.MapIO.load(filename)
+            self.assertEqual(m.loadString(), text.loadString())
+
+    def test_sections_are_mapped(self):
+        """Sections are read straight out of the file mapping"""
+        filename = os.path.join(self.directory.name, 'castle.gwmb')
+        m = MapModule.MapIO.load(os.path.join(self.maps, 'castle.py'))
+        MapFile.save(m, filename)
+        data = np.memmap(filename, dtype='u1', mode='r')
+        sections = MapFile.sections(data)
+        self.assertTrue(np.shares_memory(sections['z'], data))
+        self.assertEqual(sections['z'].reshape(m.width, m.height).tolist(),
+                         m.grid.z.tolist())
+        self.assertEqual(sections['colors'].size, m.width * m.height * 20)
+
+    def test_lazy_squares(self):
+        """The grid works on the mapped file and squares are only built
+        when they are looked at; edits stay out of the file"""
+        filename = os.path.join(self.directory.name, 'castle.gwmb')
+        text = MapModule.MapIO.load(os.path.join(self.maps, 'castle.py'))
+        MapFile.save(text, filename)
+        m = MapFile.load(filename)
+        base = m.grid.z
+        while not isinstance(base, np.memmap):
+            base = base.base
+        self.assertEqual(base.filename, os.path.abspath(filename))
+        self.assertEqual(MapPack.pack(m), MapPack.pack(text))
+        self.assertEqual(m.squares._columns, [None] * m.width)
+
+        (x, y) = (3, 4)
+        sq = m.squares[x][y]
+        self.assertIs(m.squares[x][y], sq)
+        self.assertEqual(m.squares._columns.count(None), m.width - 1)
+        self.assertEqual((sq.x, sq.y, sq.z), text.squares[x][y].posn())
+        self.assertEqual(sq.cornerColors, text.squares[x][y].cornerColors)
+        sq.plusHeight()
+        self.assertEqual(m.grid.z[x, y], text.squares[x][y].z + 1)
+        self.assertNotEqual(MapPack.pack(m), MapPack.pack(text))
+        text.squares[x][y].plusHeight()
+        self.assertEqual(MapPack.pack(m), MapPack.pack(text))
+        self.assertEqual(MapFile.load(filename).squares[x][y].z,
+                         sq.z - 1)
+
+    def test_bad_files(self):
+        """Files that aren't binary maps are refused"""
+        filename = os.path.join(self.directory.name, 'bad.gwmb')
+        m = MapModule.MapIO.load(os.path.join(self.maps, 'castle.py'))
+        MapFile.save(m, filename)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        for bad in (b'GWMB', b'XXXX' + data[4:], data[:4] + b'\x09' + data[5:],
+                    data[:200]):
+            with open(filename, 'wb') as f:
+                f.write(bad)
+            with self.assertRaises(ValueError):
+                MapFile.load(filename)
+
+    def test_loader_prefers_binary(self):
+        """The map loader picks the binary file unless the text is newer or
+        the binary file is unreadable"""
+        import resources
+        text = os.path.join(self.directory.name, 'castle.py')
+        with open(os.path.join(self.maps, 'castle.py')) as f:
+            source = f.read()
+        with open(text, 'w') as f:
+            f.write(source)
+        binary = os.path.join(self.directory.name, 'castle.gwmb')
+        m = MapModule.MapIO.load(text)
+        m.squares[0][0].plusHeight()
+        MapFile.save(m, binary)
+
+        def getFilename(base, name):
+            return os.path.join(self.directory.name, name)
+        original = resources._getFilename
+        resources._getFilename = getFilename
+        try:
+            loaded = resources.MapLoader()('castle')
+            self.assertEqual(loaded.squares[0][0].z, m.squares[0][0].z)
+            os.utime(binary, (0, 0))
+            loaded = resources.MapLoader()('castle')
+            self.assertEqual(loaded.squares[0][0].z, m.squares[0][0].z - 1)
+            # A binary file that won't load falls back to the text map
+            with open(binary, 'wb') as f:
+                f.write(b'GWMB')
+            loaded = resources.MapLoader()('castle')
+            self.assertEqual(loaded.squares[0][0].z, m.squares[0][0].z - 1)
+        finally:
+            resources._getFilename = original
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,604 @@
+"""
+Unit tests for the game server's state machine
+"""
+import unittest
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pickle
+import subprocess
+import textwrap
+from twisted.internet import task, defer
+from twisted.spread import pb
+from twisted.cred import credentials
+
+import resources
+import util
+from server import (GameState, GameSession, GameServer, ClientInfo, Access,
+                    GameCreator, GamePlayer, GameObserver, UsernameChecker,
+                    loginName, splitLoginName)
+from client import GameClient, AIClient
+from engine import Ability, Display, Effect, Range
+from engine import netsupport
+from engine.Effect import Status
+from engine.Scenario import Scenario
+from engine.Battle import Battle, UnitTurn, NEVER_ENDING
+from engine.Class import Class
+from engine.Map import Map
+import numpy as np
+
+
+class FakeSession(GameSession):
+    """Records what would have been sent to the clients"""
+
+    def __init__(self):
+        GameSession.__init__(self, None, 'test')
+        self.sent = []
+
+    def remote(self, client, methodName, *args):
+        self.sent.append((client, methodName, args))
+
+    def remoteAll(self, methodName, *args):
+        if methodName == 'broadcast':
+            (methodName, args) = netsupport.decodeMessage(*args)
+            args = tuple(args)
+        self.sent.append((None, methodName, args))
+
+    def sentNames(self):
+        return [name for (client, name, args) in self.sent]
+
+
+class OfflineClient(GameClient):
+    """A GameClient that never connects; remote calls are recorded"""
+
+    def start(self):
+        self.calls = []
+
+    def remote(self, methodName, *args):
+        df = defer.Deferred()
+        self.calls.append((methodName, args, df))
+        return df
+
+
+class OfflineAIClient(AIClient):
+    """An AIClient that never connects; remote calls are recorded"""
+
+    start = OfflineClient.start
+    remote = OfflineClient.remote
+
+
+def makeScenario():
+    """A two unit, two faction scenario on a small flat map"""
+    test_class = Class(
+        name="TestClass",
+        abilities=[],
+        spriteRoot="fighter",
+        move=3,
+        jump=2,
+        mhpBase=50,
+        mhpGrowth=5.0,
+        mhpMult=1.0,
+        mspBase=20,
+        mspGrowth=2.0,
+        mspMult=1.0,
+        watkBase=10,
+        watkGrowth=1.0,
+        watkMult=1.0,
+        wdefBase=10,
+        wdefGrowth=1.0,
+        wdefMult=1.0,
+        matkBase=10,
+        matkGrowth=1.0,
+        matkMult=1.0,
+        mdefBase=10,
+        mdefGrowth=1.0,
+        mdefMult=1.0,
+        speedBase=50,
+        speedGrowth=2.0,
+        speedMult=1.0
+    )
+
+    width, height = 8, 8
+    zdata = np.ones((width, height))
+    tileProperties = np.zeros((width, height), dtype=object)
+    for x in range(width):
+        for y in range(height):
+            tileProperties[x, y] = {'tag': ''}
+
+    test_map = Map(
+        width=width,
+        height=height,
+        z=zdata,
+        tileProperties=tileProperties,
+        globalWaterHeight=0,
+        globalWaterColor=[0.3, 0.3, 0.6],
+        tags_={}
+    )
+    units = []
+    for (x, y, faction) in [(1, 1, 0), (6, 6, 1)]:
+        unit = test_class.createUnit(gender=2)
+        unit.setPosn(x, y, 1)
+        unit.setFaction(faction)
+        test_map.squares[x][y].setUnit(unit)
+        units.append(unit)
+    battle = Battle([NEVER_ENDING], units, test_map)
+    scenario = Scenario(test_map, units, None, battle, None, '')
+    scenario.numPlayers = 2
+    return scenario
+
+
+class TestGameState(unittest.TestCase):
+    """Test the event-driven GameState"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.scenario = makeScenario()
+        self.units = self.scenario.units()
+
+        self.session = FakeSession()
+        self.clock = task.Clock()
+        self.state = self.session.state
+        self.state.clock = self.clock
+        self.state.scenario = self.scenario
+        for faction in (0, 1):
+            client = ClientInfo(faction, "player%d" % faction, None,
+                                Access.PLAYER, faction)
+            self.session.clients[faction] = client
+
+    def start(self):
+        for c in self.session.clients.values():
+            c.readyForGame = True
+        self.state.update()
+        self.clock.advance(0)
+        self.clock.advance(0)
+        return self.scenario.battle().activeUnit
+
+    def test_starts_without_polling(self):
+        """The game starts and a unit begins its turn as soon as the
+        players are ready"""
+        self.start()
+        self.assertEqual(self.state.state, GameState.PLAYING)
+        self.assertIn('startGame', self.session.sentNames())
+        self.assertIn('unitBeginTurn', self.session.sentNames())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_no_unit_can_act(self):
+        """The battle ends, with no winner, when no unit can take a
+        turn"""
+        battle = self.scenario.battle()
+        battle.pickNextUnit = lambda: None
+        self.start()
+        self.assertNotIn('unitBeginTurn', self.session.sentNames())
+        self.assertEqual(self.state.state, GameState.DONE)
+        messages = [args for (client, name, args) in self.session.sent
+                    if name == 'serverMessage']
+        self.assertEqual(messages, [('You lose!',)] * 2)
+
+    def test_updates_are_merged(self):
+        """Several events before the reactor gets round to them only
+        cause one update"""
+        for i in range(5):
+            self.state.update()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_command_sent_right_away(self):
+        """A command is broadcast on the next reactor iteration, and the
+        next one waits for the clients to be ready to display again"""
+        unit = self.start()
+        controller = self.session.clients[unit.faction()]
+        (x, y) = unit.posn()
+        target = (x + 1, y) if x < 4 else (x - 1, y)
+        self.assertTrue(self.state.unitMove(controller, *target))
+        self.assertNotIn('unitMoved', self.session.sentNames())
+        self.clock.advance(0)
+        self.assertIn('unitMoved', self.session.sentNames())
+        self.assertEqual(self.state.commandLatency.count, 1)
+
+        self.assertTrue(self.state.unitFacing(controller, 0))
+        self.clock.advance(0)
+        self.assertNotIn('unitSetFacing', self.session.sentNames())
+        for c in self.session.clients.values():
+            c.readyToDisplay = True
+        self.state.update()
+        self.clock.advance(0)
+        self.assertIn('unitSetFacing', self.session.sentNames())
+        self.assertEqual(self.state.commandLatency.count, 2)
+
+    def sent_deltas(self):
+        return [args for (client, name, args) in self.session.sent
+                if name == 'unitDelta']
+
+    def test_unit_deltas(self):
+        """Clients are sent only the changed fields and stay in sync"""
+        active = self.start()
+        client = OfflineClient('localhost', 0, 'watcher')
+        client.remote_startGame(pickle.loads(pickle.dumps(self.scenario)))
+
+        # (not the unit whose turn it is, which has had its turn readied)
+        unit = [u for u in self.units if u is not active][0]
+        unit.damageHP(7, 0)
+        unit.addStatusEffect(Status.HASTE, 2, 0.5)
+        self.state.sendUnitDelta(unit)
+        ((unitID, version, delta),) = self.sent_deltas()
+        self.assertEqual((unitID, version), (unit.unitID, 1))
+        # (CT has moved on since the game started, too)
+        self.assertEqual(set(delta) - set(['_ct']),
+                         set(['_hp', '_statusEffects']))
+        client.remote_unitDelta(unitID, version, delta)
+        copy = client.scenario.unitFromID(unit.unitID)
+        self.assertEqual(copy.battleState(), unit.battleState())
+        self.assertEqual(copy.speed(), unit.speed())
+
+        # Nothing changed, nothing sent
+        self.state.sendUnitDelta(unit)
+        self.assertEqual(len(self.sent_deltas()), 1)
+
+    def test_unit_resync(self):
+        """A client that misses an update asks for the whole state"""
+        self.start()
+        client = OfflineClient('localhost', 0, 'watcher')
+        client.remote_startGame(pickle.loads(pickle.dumps(self.scenario)))
+
+        unit = self.units[0]
+        unit.damageHP(5, 0)
+        self.state.sendUnitDelta(unit)
+        unit.setFacing(unit.facing() + 2)
+        unit.damageHP(3, 0)
+        self.state.sendUnitDelta(unit)
+        # The first delta never arrives
+        (unitID, version, delta) = self.sent_deltas()[1]
+        client.remote_unitDelta(unitID, version, delta)
+        ((methodName, args, df),) = client.calls
+        self.assertEqual((methodName, args), ('unitResync', (unitID,)))
+        df.callback(self.state.unitResync(unitID))
+        copy = client.scenario.unitFromID(unit.unitID)
+        self.assertEqual(copy.battleState(), unit.battleState())
+        self.assertEqual(client.unitVersions[unitID], 2)
+
+    def test_action_resolved(self):
+        """An action goes out as one message carrying its results and the
+        changes to the units it affected"""
+        active = self.start()
+        client = OfflineClient('localhost', 0, 'watcher')
+        client.remote_startGame(pickle.loads(pickle.dumps(self.scenario)))
+        controller = self.session.clients[active.faction()]
+
+        # Bring the client up to date with the turn starting
+        for u in self.units:
+            self.state.sendUnitDelta(u)
+        for args in self.sent_deltas():
+            client.remote_unitDelta(*args)
+
+        target = [u for u in self.units if u is not active][0]
+        target.damageHP(9, 0)
+        del self.session.sent[:]
+        self.state.sendUnitAct(controller, 3, [target, active],
+                               {target.unitID: []})
+        self.assertEqual(self.session.sentNames(),
+                         ['actionResolved', 'unitMoveActCancel'])
+        (abilityID, results, unitDeltas) = self.session.sent[0][2]
+        self.assertEqual((abilityID, results), (3, {target.unitID: []}))
+        # Only the units that changed
+        self.assertEqual([d[0] for d in unitDeltas], [target.unitID])
+
+        client.remote_actionResolved(abilityID, results, unitDeltas)
+        copy = client.scenario.unitFromID(target.unitID)
+        self.assertEqual(copy.battleState(), target.battleState())
+        self.assertEqual(client.calls, [])
+
+    def test_action_results_by_id(self):
+        """Effect results name their target by ID rather than carrying
+        the whole unit"""
+        active = self.start()
+        controller = self.session.clients[active.faction()]
+        target = [u for u in self.units if u is not active][0]
+        results = {target.unitID: [Effect.DamageResult(target, 9),
+                                   Effect.MissResult(target)]}
+        data = netsupport.encodeMessage('actionResolved', 3, results, [])
+        bare = netsupport.encodeMessage('actionResolved', 3, {}, [])
+        self.assertLess(len(data) - len(bare), 500)
+
+        del self.session.sent[:]
+        self.state.sendUnitAct(controller, 3, [target], results)
+        (abilityID, received, unitDeltas) = self.session.sent[0][2]
+        (damage, miss) = received[target.unitID]
+        self.assertIsInstance(damage, Effect.DamageResult)
+        self.assertEqual((damage.target, damage.hit, damage.damage),
+                         (target.unitID, True, 9))
+        self.assertEqual((miss.target, miss.hit), (target.unitID, False))
+
+    def test_regen_display_hook(self):
+        """Regen at the start of a turn goes to whatever display is
+        registered"""
+        for unit in self.units:
+            unit.addStatusEffect(Status.REGEN, 10, 0.1)
+            unit.damageHP(20, 0)
+        shown = []
+        Display.setDamageDisplay(lambda *args: shown.append(args))
+        try:
+            unit = self.scenario.battle().pickNextUnit()
+        finally:
+            Display.setDamageDisplay(None)
+        healed = int(unit.mhp() * 0.1)
+        self.assertEqual(shown, [(unit, healed, Display.BENEFICIAL, 0.5)])
+        self.assertEqual(unit.hp(), unit.mhp() - 20 + healed)
+
+
+class FakeAddress(object):
+    host = '127.0.0.1'
+    port = 0
+
+
+class FakeRef(object):
+    """Stands in for a client's RemoteReference"""
+
+    class broker:
+        class transport:
+            @staticmethod
+            def getPeer():
+                return FakeAddress()
+
+
+class OfflineServer(GameServer):
+    """A GameServer that doesn't listen; remote calls are recorded"""
+
+    def start(self):
+        self.clock = task.Clock()
+        self.sent = []
+
+    def newSession(self, sessionID=None):
+        session = GameServer.newSession(self, sessionID)
+        session.state.clock = self.clock
+        return session
+
+    def remote(self, client, methodName, *args):
+        self.sent.append((client, methodName, args))
+
+    def login(self, name, sessionID=None):
+        """@return: (avatar, logout) for a new client"""
+        ref = FakeRef()
+        login = self.checker.requestAvatarId(
+            credentials.UsernamePassword(loginName(name, sessionID), ''))
+        (interface, avatar, logout) = self.requestAvatar(
+            login.result, ref, pb.IPerspective)
+        return (avatar, logout)
+
+
+class TestGameServer(unittest.TestCase):
+    """Test sessions on a GameServer"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.server = OfflineServer(0)
+
+    def test_login_names(self):
+        """Session IDs are carried in the login name"""
+        self.assertEqual(splitLoginName(loginName('bob', 'duel')),
+                         ('bob', 'duel'))
+        self.assertEqual(splitLoginName(loginName('bob')), ('bob', None))
+        checker = UsernameChecker()
+        checker.requestAvatarId(credentials.UsernamePassword('bob@1', ''))
+        df = checker.requestAvatarId(
+            credentials.UsernamePassword('bob@2', ''))
+        self.assertEqual(df.result, 'bob2@2')
+
+    def test_sessions_fill_up(self):
+        """Clients fill one session after another, each with its own
+        factions, and can ask for a session by ID"""
+        avatars = [self.server.login('p%d' % i)[0] for i in range(5)]
+        self.assertEqual([a.session.sessionID for a in avatars],
+                         ['1', '1', '2', '2', '3'])
+        self.assertEqual([type(a) for a in avatars],
+                         [GameCreator, GamePlayer] * 2 + [GameCreator])
+        self.assertEqual([a.faction for a in avatars], [0, 1, 0, 1, 0])
+
+        (watcher, logout) = self.server.login('watcher', '1')
+        self.assertIsInstance(watcher, GameObserver)
+        self.assertNotIsInstance(watcher, GamePlayer)
+        self.assertEqual(watcher.faction, None)
+        self.assertEqual(len(self.server.sessions['1'].players()), 2)
+
+        (duelist, logout) = self.server.login('duelist', 'duel')
+        self.assertIsInstance(duelist, GameCreator)
+        self.assertEqual(sorted(self.server.sessions),
+                         ['1', '2', '3', 'duel'])
+
+    def test_sessions_are_independent(self):
+        """Each session plays its own battle"""
+        avatars = [self.server.login('p%d' % i)[0] for i in range(4)]
+        sessions = [self.server.sessions['1'], self.server.sessions['2']]
+        for session in sessions:
+            session.state.scenario = makeScenario()
+        for a in avatars:
+            a.perspective_readyForGame()
+        self.server.clock.advance(0)
+        self.server.clock.advance(0)
+        battles = [s.state.scenario.battle() for s in sessions]
+        self.assertIsNot(battles[0], battles[1])
+        for (session, battle) in zip(sessions, battles):
+            self.assertEqual(session.state.state, GameState.PLAYING)
+            self.assertIsNotNone(battle.activeUnit)
+
+        # The first session's unit moves; the second's doesn't notice
+        unit = battles[0].activeUnit
+        mover = [a for a in avatars[:2] if a.faction == unit.faction()][0]
+        posns = [u.posn() for u in battles[1].units()]
+        self.assertTrue(mover.perspective_unitMove(unit.x(), 4))
+        self.assertEqual([u.posn() for u in battles[1].units()], posns)
+        self.assertTrue(battles[1].activeUnit.hasMove())
+
+        stats = dict((s['session'], s) for s in self.server.sessionStats())
+        self.assertGreater(stats['1']['usage']['count'],
+                           stats['2']['usage']['count'])
+        self.assertGreater(stats['1']['usage']['cpu'], 0.0)
+
+    def test_one_campaign(self):
+        """Sessions can't play different campaigns, since the loaded
+        resources are shared"""
+        for i in range(4):
+            self.server.login('p%d' % i)
+        (first, second) = (self.server.sessions['1'], self.server.sessions['2'])
+        self.assertEqual(self.server.campaignsInUse(), set())
+        # As if setScenario had loaded one of its scenarios
+        first.state.campaign = resources.campaign
+        campaign = resources.campaign
+        with self.assertRaises(ValueError):
+            second.state.setScenario('other', 'castle')
+        self.assertEqual(resources.campaign, campaign)
+        self.assertIsNone(second.state.scenario)
+        self.assertEqual(self.server.campaignsInUse(), set([campaign]))
+        # A session may switch if no other session has a campaign
+        self.assertEqual(self.server.campaignsInUse(first), set())
+
+    def test_broadcast(self):
+        """A broadcast is encoded once, and clients act on it as if it
+        had been sent to each of them"""
+        avatars = [self.server.login('p%d' % i, 'many')[0] for i in range(4)]
+        session = self.server.sessions['many']
+        del self.server.sent[:]
+        session.broadcast('chat', 'p0', 'hello')
+        self.assertEqual([name for (ref, name, args) in self.server.sent],
+                         ['broadcast'] * 4)
+        data = self.server.sent[0][2][0]
+        for (ref, name, args) in self.server.sent:
+            self.assertIs(args[0], data)
+
+        class ChatClient(OfflineClient):
+            def remote_chat(self, username, message):
+                self.chat = (username, message)
+        client = ChatClient('localhost', 0, 'p1')
+        client.remote_broadcast(data)
+        self.assertEqual(client.chat, ('p0', 'hello'))
+
+    def test_disconnect_closes_session(self):
+        """A session goes away when its last client leaves, and the
+        names are free again"""
+        (a, logoutA) = self.server.login('a')
+        (b, logoutB) = self.server.login('b')
+        logoutA()
+        self.assertIn('1', self.server.sessions)
+        logoutB()
+        self.assertEqual(self.server.sessions, {})
+        self.assertEqual(self.server.clients, {})
+        self.assertEqual(self.server.checker.users, {})
+
+        (c, logoutC) = self.server.login('a')
+        self.assertEqual((c.name, c.session.sessionID), ('a', '2'))
+
+
+class TestHeadless(unittest.TestCase):
+    """The server runs without a display"""
+
+    def test_no_display_modules(self):
+        """Loading and playing a scenario on the server, or with the
+        headless clients, imports neither pygame, OpenGL nor the GUI"""
+        src = os.path.join(os.path.dirname(__file__), '..', 'src')
+        script = textwrap.dedent("""
+            import sys
+            import server
+            import loadtest
+            import resources
+            from translate import Translate
+            Translate().setLanguage()
+            scenario = resources.scenario('castle')
+            battle = scenario.battle()
+            for i in range(5):
+                battle.pickNextUnit()
+                battle.unitDone()
+            loaded = [m for m in sys.modules
+                      if m.split('.')[0] in ('pygame', 'OpenGL', 'gui')]
+            print(','.join(loaded))
+            """)
+        result = subprocess.run([sys.executable, '-c', script], cwd=src,
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '')
+
+
+class TestAIClient(unittest.TestCase):
+    """Test the commands the AI client sends for a turn"""
+
+    def setUp(self):
+        self.client = OfflineAIClient('localhost', 0, useWorker=False)
+        self.client.scenario = makeScenario()
+        self.unit = self.client.scenario.units()[0]
+        self.client.fsm.unit = self.unit
+        self.strike = Ability.Ability("Strike", "", 0, Ability.HOSTILE, [],
+                                      Range.Cross(1, 1), Range.Single(),
+                                      [Effect.Damage()], None)
+
+    def sent(self):
+        return [(name, args) for (name, args, df) in self.client.calls]
+
+    def test_move_first(self):
+        self.client.fsm.executeTurn(UnitTurn(UnitTurn.MOVE_FIRST, (2, 1),
+                                             self.strike, (3, 1), 1))
+        self.assertEqual(self.sent(),
+                         [('unitMove', (2, 1)),
+                          ('unitAct', (self.strike.abilityID, 3, 1)),
+                          ('unitFacing', (1,))])
+
+    def test_act_first(self):
+        """Act-first turns act, then move"""
+        self.client.fsm.executeTurn(UnitTurn(UnitTurn.ACT_FIRST, (1, 2),
+                                             self.strike, (2, 1), 2))
+        self.assertEqual(self.sent(),
+                         [('unitAct', (self.strike.abilityID, 2, 1)),
+                          ('unitMove', (1, 2)),
+                          ('unitFacing', (2,))])
+
+    def test_no_facing(self):
+        """With no enemy to face, the unit keeps its facing"""
+        self.client.fsm.executeTurn(UnitTurn())
+        self.assertEqual(self.sent(),
+                         [('unitFacing', (self.unit.facing(),))])
+
+
+class TestClientLogin(unittest.TestCase):
+    """Test what clients tell the server once logged in"""
+
+    def test_maps_after_scenario(self):
+        """A client that sets the scenario says which maps it has once
+        the scenario is loaded, so a server in the same process can have
+        put its map in the cache"""
+        class CreatorClient(OfflineClient):
+            def chooseScenario(self):
+                return self.remote('setScenario', 'demo', 'castle')
+        client = CreatorClient('localhost', 0, 'creator')
+        client.gotInfo(('creator', Access.CREATOR, 0, 'test'))
+        ((methodName, args, df),) = client.calls
+        self.assertEqual(methodName, 'setScenario')
+        df.callback(None)
+        self.assertEqual([c[0] for c in client.calls[1:]],
+                         ['haveMaps', 'readyForGame'])
+
+        client = OfflineClient('localhost', 0, 'player')
+        client.gotInfo(('player', Access.PLAYER, 1, 'test'))
+        self.assertEqual([c[0] for c in client.calls],
+                         ['haveMaps', 'readyForGame'])
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    """Test the latency histogram"""
+
+    def test_histogram(self):
+        """Buckets, mean and percentile bounds"""
+        h = util.LatencyHistogram()
+        self.assertEqual(h.percentile(50), 0.0)
+        for latency in [0.0005] * 90 + [0.03] * 9 + [7.0]:
+            h.record(latency)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.counts[0], 90)
+        self.assertEqual(h.counts[-1], 1)
+        self.assertAlmostEqual(h.mean(), (0.045 + 0.27 + 7.0) / 100)
+        self.assertEqual(h.percentile(50), 0.001)
+        self.assertEqual(h.percentile(95), 0.05)
+        self.assertEqual(h.percentile(100), 7.0)
+        self.assertEqual(h.snapshot()['count'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 from engine.Unit import Unit
 from engine.Class import Class
 from engine.Effect import Status
+from engine.Equipment import Equipment
 
 
 class TestUnit(unittest.TestCase):
@@ -153,6 +154,45 @@ class TestUnit(unittest.TestCase):
         self.assertEqual(unit.posn(), (5, 7))
         self.assertEqual(unit.posn3d(), (5, 7, 2))
 
+    def assertStatsCurrent(self, unit):
+        for stat in ('mhp', 'msp', 'watk', 'wdef', 'matk', 'mdef',
+                     'speed', 'move', 'jump'):
+            getter = getattr(Unit, stat)
+            self.assertEqual(getter(unit), getter.uncached(unit), stat)
+
+    def test_unit_derived_stats_cache(self):
+        """Test cached stats follow every change to what they're made of"""
+        unit = self.test_class.createUnit(gender=2)
+        unit.battleInit()
+        self.assertStatsCurrent(unit)
+
+        stats = {'mhp': 5, 'msp': 3, 'watk': 7, 'wdef': 2, 'matk': 1,
+                 'mdef': 4, 'speed': 6, 'move': 1, 'jump': 1}
+        unit.equipWeapon(Equipment("Blade", stats))
+        self.assertStatsCurrent(unit)
+        unit.equipArmor(Equipment("Mail", stats))
+        self.assertStatsCurrent(unit)
+
+        unit.addStatusEffect(Status.HASTE, duration=2, power=0.5)
+        unit.addStatusEffect(Status.PLUS_WATK, duration=1, power=0.25)
+        unit.addStatusEffect(Status.TRIPPED, duration=2, power=1.0)
+        unit.addStatusEffect(Status.MINUS_MOVE, duration=1, power=2)
+        self.assertStatsCurrent(unit)
+        unit.statusEffects().update()
+        self.assertStatsCurrent(unit)
+        unit.statusEffects().update()
+        self.assertStatsCurrent(unit)
+
+        state = unit.battleState()
+        unit.addStatusEffect(Status.HASTE, duration=2, power=0.5)
+        self.assertStatsCurrent(unit)
+        unit.setBattleState(state, None)
+        self.assertStatsCurrent(unit)
+
+        for i in range(5):
+            self.test_class.levelUp(unit)
+            self.assertStatsCurrent(unit)
+
 
 if __name__ == '__main__':
     unittest.main()